@@ -1,5 +1,7 @@
 __version__ = '1.1.2'
 from asyncnsq.tcp.writer import create_writer
 from asyncnsq.tcp.reader import create_reader
+from asyncnsq.tcp.writer_pool import create_writer_pool
 
-__all__ = ['create_writer', 'create_reader', 'tcp', 'http']
+__all__ = ['create_writer', 'create_reader', 'create_writer_pool', 'tcp',
+           'http']
@@ -34,6 +34,7 @@ class NsqHTTPConnection:
                                                data=_body)
         except Exception as tmp:
             print('exception', tmp)
+            raise
         resp_body = await resp.text()
         try:
             response = json.loads(resp_body)
@@ -7,57 +7,160 @@ from collections import deque
 
 from . import consts
 from .messages import NsqMessage
-from .exceptions import ProtocolError, make_error
+from .exceptions import ProtocolError, NSQCommandTimeout, make_error
 from .protocol import Reader, DeflateReader, SnappyReader
+from .timer_wheel import get_timer_wheel
 from .consts import SUB
 
 logger = logging.getLogger(__package__)
 
 
-async def create_connection(host='localhost', port=4151, queue=None, loop=None):
-    """XXX"""
-    reader, writer = await asyncio.open_connection(
-        host, port, loop=loop)
-    conn = TcpConnection(reader, writer, host, port, queue=queue, loop=loop)
+# asyncio.BufferedProtocol is available since python 3.7
+HAS_BUFFERED_PROTOCOL = hasattr(asyncio, 'BufferedProtocol')
+
+
+async def create_connection(host='localhost', port=4151, queue=None, loop=None,
+                            buffered=HAS_BUFFERED_PROTOCOL,
+                            write_coalescing=False,
+                            coalesce_max_bytes=consts.COALESCE_MAX_BYTES,
+                            coalesce_delay=0, write_high_water=None,
+                            command_timeout=None):
+    """XXX
+
+    param: buffered: read with ``NsqProtocol`` straight into a reusable
+        receive buffer, ``False`` falls back to a ``StreamReader`` task.
+    param: write_coalescing: gather commands and write them at once,
+        see ``TcpConnection.flush``.
+    param: write_high_water: bytes buffered by the transport before
+        ``TcpConnection.drain`` waits, asyncio default if not set.
+    param: command_timeout: seconds nsqd has to respond to a command,
+        see ``TcpConnection``.
+    """
+    loop = loop or asyncio.get_event_loop()
+    options = dict(queue=queue, loop=loop, write_coalescing=write_coalescing,
+                   coalesce_max_bytes=coalesce_max_bytes,
+                   coalesce_delay=coalesce_delay,
+                   command_timeout=command_timeout)
+    if buffered:
+        conn = TcpConnection(None, None, host, port, **options)
+        await loop.create_connection(
+            lambda: NsqProtocol(conn), host, port)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+        conn = TcpConnection(reader, writer, host, port, **options)
+    if write_high_water is not None:
+        conn._transport.set_write_buffer_limits(high=write_high_water)
     conn.connect()
     return conn
 
 
+class NsqProtocol(getattr(asyncio, 'BufferedProtocol', asyncio.Protocol)):
+    """Feeds the connection parser directly from the event loop callbacks,
+    the socket is read into one preallocated buffer.
+    """
+
+    def __init__(self, conn, buffer_size=consts.READ_BUFFER_SIZE):
+        self._conn = conn
+        self._buffer = memoryview(bytearray(buffer_size))
+
+    def connection_made(self, transport):
+        self._conn._connection_made(transport, self)
+
+    def get_buffer(self, sizehint):
+        return self._buffer
+
+    def buffer_updated(self, nbytes):
+        self._conn._data_received(self._buffer[:nbytes])
+
+    def pause_writing(self):
+        self._conn._pause_writing()
+
+    def resume_writing(self):
+        self._conn._resume_writing()
+
+    def eof_received(self):
+        self._conn._connection_lost(None)
+
+    def connection_lost(self, exc):
+        self._conn._connection_lost(exc)
+
+
 class TcpConnection:
     """
     base nsq connection class ,used for manipulate reader/writer content
+
+    With ``write_coalescing`` commands are not written one by one but
+    gathered until the end of the current event loop iteration (or
+    ``coalesce_delay`` seconds) and sent, compressed once, in a single
+    write. ``coalesce_max_bytes`` of pending commands force an early flush.
+
+    Responses are matched to commands in order. If the oldest command is
+    not answered in ``command_timeout`` seconds, or a response arrives with
+    no command waiting for it, the stream can not be trusted anymore: all
+    waiting commands fail and the connection is closed.
     """
 
     def __init__(self, reader, writer, host, port, *, on_message=None,
-                 queue=None, loop=None, log_level=None):
+                 queue=None, loop=None, log_level=None,
+                 write_coalescing=False,
+                 coalesce_max_bytes=consts.COALESCE_MAX_BYTES,
+                 coalesce_delay=0, command_timeout=None):
         self._reader, self._writer = reader, writer
         self._host, self._port = host, port
 
         self._loop = loop or asyncio.get_event_loop()
 
         assert isinstance(queue, asyncio.Queue) or queue is None
-        self._queue = queue or asyncio.Queue(loop=self._loop)
+        self._queue = queue or asyncio.Queue()
 
-        self._parser = Reader()
-        # next queue is used for nsq commands
+        self._parser = Reader(raw_messages=True)
+        # (future, callback, deadline) of commands waiting for a response
         self._cmd_waiters = deque()
+        self._command_timeout = command_timeout
+        self._timeout_timer = None
         self._closing = False
         self._closed = False
-        self._reader_task = asyncio.Task(self._read_data(), loop=self._loop)
+        # without a StreamReader data is pushed by NsqProtocol
+        self._transport = writer and writer.transport
+        self._protocol = None
+        self._eof = False
+        self._reader_task = None
+        if reader is not None:
+            self._reader_task = asyncio.Task(self._read_data(),
+                                             loop=self._loop)
+        self._upgrade_waiter = None
         # mark connection in upgrading state to ssl socket
         self._is_upgrading = False
         self._on_message = on_message
+        # called with connection id and success of every finished or
+        # re-queued message
+        self._on_processed = None
+        # called with every message finished or re-queued
+        self._on_done = None
+        # called with the connection once it is closed
         self._on_close = None
 
         # number of received but not acked or req messages
         self._in_flight = 0
 
+        self._write_coalescing = write_coalescing
+        self._coalesce_max_bytes = coalesce_max_bytes
+        self._coalesce_delay = coalesce_delay
+        self._write_buffer = []
+        self._write_buffer_size = 0
+        self._flush_handle = None
+        self._flushes = self._flushed_commands = self._flushed_bytes = 0
+        # set while the transport buffer is over its high-water mark
+        self._drain_waiter = None
+        # IDENTIFY response, empty without feature negotiation
+        self._server_config = {}
+
     def connect(self):
         self._send_magic()
 
     def execute(self, command, *args, data=None, cb=None):
         """XXX"""
-        assert self._reader and not self._reader.at_eof(), (
+        assert self._transport and not self._at_eof(), (
             "Connection closed or corrupted")
         if command is None:
             raise TypeError("command must not be None")
@@ -65,20 +168,152 @@ class TcpConnection:
             raise TypeError("args must not contain None")
         fut = asyncio.Future(loop=self._loop)
 
-        if command in (b'NOP', b'FIN', b'RDY', b'REQ', b'TOUCH'):
+        if command in consts.NO_RESPONSE_COMMANDS:
             fut.set_result(b'OK')
         else:
-            self._cmd_waiters.append((fut, cb))
+            self._add_waiter(fut, cb)
 
-        command_raw = self._parser.encode_command(command, *args, data=data)
+        command_raw = self._parser.encoder.encode_command(
+            command, *args, data=data)
         logger.debug('execute command %s' % command_raw)
-        self._writer.write(command_raw)
+        self._write(command_raw)
 
         # track all processed and requeued messages
         if command in (b'FIN', b'REQ', 'FIN', 'REQ'):
             self._in_flight = max(0,  self._in_flight - 1)
         return fut
 
+    def _add_waiter(self, fut, cb=None):
+        deadline = None
+        if self._command_timeout is not None:
+            deadline = self._loop.time() + self._command_timeout
+            if self._timeout_timer is None:
+                self._timeout_timer = get_timer_wheel(self._loop).call_later(
+                    self._command_timeout, self._check_timeout)
+        self._cmd_waiters.append((fut, cb, deadline))
+
+    def _check_timeout(self):
+        # responses come in order, only the oldest command can be late
+        self._timeout_timer = None
+        if not self._cmd_waiters or self._closed:
+            return
+        deadline = self._cmd_waiters[0][2]
+        now = self._loop.time()
+        if deadline > now:
+            self._timeout_timer = get_timer_wheel(self._loop).call_later(
+                deadline - now, self._check_timeout)
+            return
+        self._break(NSQCommandTimeout('No response from {} in {} sec'.format(
+            self.endpoint, self._command_timeout)))
+
+    def _break(self, exc):
+        """Response stream is broken, fail all commands and close."""
+        logger.error('%s, closing connection', exc)
+        self._fail_waiters(exc)
+        self._closing = True
+        self._do_close()
+
+    def _fail_waiters(self, exc):
+        waiters, self._cmd_waiters = self._cmd_waiters, deque()
+        for waiter, _, _ in waiters:
+            waiter.done() or waiter.set_exception(exc)
+
+    def execute_many(self, command, args_list):
+        """Write ``command`` once for every tuple of ``args_list`` in a
+        single buffer. Only for commands nsqd does not respond to:
+        FIN, REQ, TOUCH and RDY.
+        """
+        assert self._transport and not self._at_eof(), (
+            "Connection closed or corrupted")
+        assert command in consts.NO_RESPONSE_COMMANDS, command
+        encode = self._parser.encoder.encode_command
+        self._write(b''.join(encode(command, *args) for args in args_list))
+        if command in (consts.FIN, consts.REQ):
+            self._in_flight = max(0, self._in_flight - len(args_list))
+
+    def _write(self, command_raw):
+        if not self._write_coalescing:
+            self._transport.write(self._parser.compress(command_raw))
+            return
+        self._write_buffer.append(command_raw)
+        self._write_buffer_size += len(command_raw)
+        if self._write_buffer_size >= self._coalesce_max_bytes:
+            self.flush()
+        elif self._flush_handle is None:
+            if self._coalesce_delay:
+                self._flush_handle = self._loop.call_later(
+                    self._coalesce_delay, self.flush)
+            else:
+                self._flush_handle = self._loop.call_soon(self.flush)
+
+    def flush(self):
+        """Write out all commands gathered by write coalescing."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._write_buffer:
+            return
+        data = self._parser.compress(b''.join(self._write_buffer))
+        self._flushes += 1
+        self._flushed_commands += len(self._write_buffer)
+        self._flushed_bytes += len(data)
+        self._write_buffer = []
+        self._write_buffer_size = 0
+        self._transport.write(data)
+
+    async def drain(self):
+        """Wait until the transport buffer is below its high-water mark."""
+        self.flush()
+        if self._writer is not None:
+            await self._writer.drain()
+            return
+        if self._drain_waiter is not None:
+            # a cancelled caller must not cancel the other ones
+            await asyncio.shield(self._drain_waiter)
+        if self._closed or self._eof:
+            raise ConnectionError('Connection closed')
+
+    def _pause_writing(self):
+        if self._drain_waiter is None:
+            self._drain_waiter = self._loop.create_future()
+
+    def _resume_writing(self):
+        waiter, self._drain_waiter = self._drain_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    @property
+    def write_stats(self):
+        """Counters of coalesced writes."""
+        flushes = max(1, self._flushes)
+        return {
+            'flushes': self._flushes,
+            'commands': self._flushed_commands,
+            'bytes': self._flushed_bytes,
+            'commands_per_flush': self._flushed_commands / flushes,
+            'bytes_per_flush': self._flushed_bytes / flushes,
+        }
+
+    @property
+    def server_config(self):
+        """Settings and limits nsqd negotiated in IDENTIFY."""
+        return self._server_config
+
+    @property
+    def max_rdy_count(self):
+        return self._server_config.get('max_rdy_count', consts.MAX_RDY_COUNT)
+
+    @property
+    def msg_timeout(self):
+        """Milliseconds before nsqd re-queues a message in flight."""
+        return self._server_config.get('msg_timeout', consts.MSG_TIMEOUT)
+
+    @property
+    def max_msg_timeout(self):
+        """Milliseconds a message may stay in flight with TOUCH."""
+        return self._server_config.get('max_msg_timeout',
+                                       consts.MAX_MSG_TIMEOUT)
+
     @property
     def in_flight(self):
         return self._in_flight
@@ -95,7 +330,7 @@ class TcpConnection:
     def closed(self):
         """True if connection is closed."""
         closed = self._closing or self._closed
-        if not closed and self._reader and self._reader.at_eof():
+        if not closed and self._at_eof():
             self._closing = closed = True
             self._loop.call_soon(self._do_close, None)
         return closed
@@ -117,8 +352,11 @@ class TcpConnection:
             self._finish_upgrading()
             return resp
         resp_config = json.loads(resp.decode('utf-8'))
+        self._server_config = resp_config
         fut = None
-        if resp_config.get('tls_v1'):
+        if resp_config.get('tls_v1') and self._protocol is not None:
+            await self._upgrade_transport_to_tls()
+        elif resp_config.get('tls_v1'):
             await self._upgrade_to_tls()
 
         if resp_config.get('snappy'):
@@ -138,17 +376,58 @@ class TcpConnection:
             return
         self._closed = True
         self._closing = False
-        self._writer.transport.close()
-        self._reader_task.cancel()
+        if not self._transport.is_closing():
+            self.flush()
+        self._transport.close()
+        self._reader_task and self._reader_task.cancel()
+        self._resume_writing()
+        # commands sent but not answered will never be
+        self._fail_waiters(ConnectionError('Connection closed'))
+        if self._timeout_timer is not None:
+            self._timeout_timer.cancel()
+            self._timeout_timer = None
+        if self._upgrade_waiter and not self._upgrade_waiter.done():
+            self._upgrade_waiter.set_exception(
+                ConnectionError('Connection closed during upgrade'))
+        if self._on_close is not None:
+            self._on_close(self)
+
+    def _at_eof(self):
+        if self._reader is not None:
+            return self._reader.at_eof()
+        return self._eof
 
     def _send_magic(self):
-        self._writer.write(consts.MAGIC_V2)
+        self._transport.write(consts.MAGIC_V2)
 
     def _pulse(self):
-        nop = self._parser.encode_command(b'NOP')
-        self._writer.write(nop)
+        nop = self._parser.encoder.encode_command(b'NOP')
+        self._write(nop)
+
+    def _connection_made(self, transport, protocol):
+        self._transport, self._protocol = transport, protocol
+
+    def _data_received(self, data):
+        self._parser.feed(data)
+        waiter = self._upgrade_waiter
+        if waiter is not None:
+            # first frame after TLS handshake is plain, even if compression
+            # was negotiated as well
+            frame = self._parser.gets()
+            if frame is False:
+                return
+            self._upgrade_waiter = None
+            waiter.done() or waiter.set_result(frame)
+        not self._is_upgrading and self._read_buffer()
+
+    def _connection_lost(self, exc):
+        self._eof = True
+        if not self._closed:
+            self._closing = True
+            self._loop.call_soon(self._do_close, exc)
 
     async def _upgrade_to_tls(self):
+        self.flush()
         self._reader_task.cancel()
         transport = self._writer.transport
         transport.pause_reading()
@@ -160,26 +439,40 @@ class TcpConnection:
         self._reader, self._writer = await asyncio.open_connection(
             sock=raw_sock, ssl=ssl_context, loop=self._loop,
             server_hostname=self._host)
+        self._transport = self._writer.transport
         bin_ok = await self._reader.readexactly(10)
         if bin_ok != consts.BIN_OK:
             raise RuntimeError('Upgrade to TLS failed, got: {}'.format(bin_ok))
         self._reader_task = asyncio.Task(self._read_data(), loop=self._loop)
         self._reader_task.add_done_callback(self._on_reader_task_stopped)
 
+    async def _upgrade_transport_to_tls(self):
+        self.flush()
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+        self._upgrade_waiter = waiter = asyncio.Future(loop=self._loop)
+        self._transport = await self._loop.start_tls(
+            self._transport, self._protocol, ssl_context,
+            server_hostname=self._host)
+        frame = await waiter
+        if frame != (consts.FRAME_TYPE_RESPONSE, b'OK'):
+            raise RuntimeError('Upgrade to TLS failed, got: {}'.format(frame))
+
     def _on_reader_task_stopped(self, future):
         exc = future.exception()
         logger.error('DONE: TASK {}'.format(exc))
 
     def _upgrade_to_snappy(self):
-        self._parser = SnappyReader(self._parser.buffer)
+        self.flush()
+        self._parser = SnappyReader(self._parser.buffer, raw_messages=True)
         fut = asyncio.Future(loop=self._loop)
-        self._cmd_waiters.append((fut, None))
+        self._add_waiter(fut)
         return fut
 
     def _upgrade_to_deflate(self):
-        self._parser = DeflateReader(self._parser.buffer)
+        self.flush()
+        self._parser = DeflateReader(self._parser.buffer, raw_messages=True)
         fut = asyncio.Future(loop=self._loop)
-        self._cmd_waiters.append((fut, None))
+        self._add_waiter(fut)
         return fut
 
     async def _read_data(self):
@@ -227,43 +520,62 @@ class TcpConnection:
             if resp_type == consts.FRAME_TYPE_RESPONSE and resp == hb:
                 self._pulse()
             elif resp_type == consts.FRAME_TYPE_RESPONSE:
-                waiter, cb = self._cmd_waiters.popleft()
-                if not waiter.cancelled():
+                if not self._cmd_waiters:
+                    self._break(ProtocolError(
+                        'Response {!r} from {} to no command'.format(
+                            resp, self.endpoint)))
+                    return False
+                waiter, cb, _ = self._cmd_waiters.popleft()
+                if not waiter.done():
                     waiter.set_result(resp)
                     cb is not None and cb(resp)
             elif resp_type == consts.FRAME_TYPE_ERROR:
-                waiter, cb = self._cmd_waiters.popleft()
                 error = make_error(*resp)
-                if not waiter.cancelled():
-                    waiter.set_result(resp)
-                    cb is not None and cb(resp)
+                if not error.fatal:
+                    # FIN, REQ and TOUCH failures, these commands do not
+                    # wait for a response
+                    logger.warning('%s: %s', self.endpoint, error)
+                elif not self._cmd_waiters:
+                    self._break(error)
+                    return False
+                else:
+                    waiter, _, _ = self._cmd_waiters.popleft()
+                    waiter.done() or waiter.set_exception(error)
             elif resp_type == consts.FRAME_TYPE_MESSAGE:
 
                 # track number in flight messages
                 self._in_flight += 1
 
-                ts, att, msg_id, body = resp
-                self._on_message_hook(ts, att, msg_id, body)
+                header, body = resp
+                self._on_message_hook(header, body)
                 # self._queue.put_nowait(msg)
             return True
 
-    def _on_message_hook(self, ts, att, msg_id, body):
-        msg = NsqMessage(ts, att, msg_id, body, self)
+    def message_processed(self, success):
+        """Report outcome of a message, drives reader backoff."""
+        if self._on_processed is not None:
+            self._on_processed(self.id, success)
+
+    def _on_message_hook(self, header, body):
+        msg = NsqMessage.from_frame(header, body, self)
         if self._on_message:
+            # hook returns None when it took care of the message itself
             msg = self._on_message(msg)
-        self._queue.put_nowait(msg)
+        msg is not None and self._queue.put_nowait(msg)
 
     def _read_buffer(self):
+        # stop as soon as a response switches the stream to TLS or
+        # compression, the rest of the buffer is not plain anymore
         is_continue = True
-        while is_continue:
+        while is_continue and not self._is_upgrading:
             is_continue = self._parse_data()
 
     def _start_upgrading(self, resp=None):
         self._is_upgrading = True
 
     def _finish_upgrading(self, resp=None):
-        self._read_buffer()
         self._is_upgrading = False
+        self._read_buffer()
 
     def __repr__(self):
         return '<NsqConnection: {}:{}'.format(self._host, self._port)
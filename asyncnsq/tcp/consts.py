@@ -3,6 +3,12 @@ DATA_SIZE = 4
 FRAME_SIZE = 4
 HEADER_SIZE = DATA_SIZE + FRAME_SIZE
 MAX_CHUNK_SIZE = 65536
+# size of the reusable socket receive buffer
+READ_BUFFER_SIZE = 65536
+# pending bytes forcing a flush of coalesced writes
+COALESCE_MAX_BYTES = 65536
+# parsed bytes kept in front of the parser buffer before it is compacted
+COMPACT_SIZE = 65536
 
 TIMESTAMP_SIZE = 8
 ATTEMPTS_SIZE = 2
@@ -30,6 +36,17 @@ AUTH = b'AUTH'
 SUB = b'SUB'
 PUB = b'PUB'
 DPUB = b'DPUB'
+NOP = b'NOP'
+# commands nsqd does not send a response to
+NO_RESPONSE_COMMANDS = (NOP, FIN, RDY, REQ, TOUCH)
+
+# nsqd defaults of limits negotiated with IDENTIFY
+MAX_RDY_COUNT = 2500
+MSG_TIMEOUT = 60000
+MAX_MSG_TIMEOUT = 900000
+
+# seconds nsqd has to answer a command before the connection is dropped
+COMMAND_TIMEOUT = 10.0
 
 # connection status
 CLOSED = 0
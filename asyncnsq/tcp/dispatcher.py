@@ -0,0 +1,233 @@
+"""Push based delivery of messages to a handler, see ``Reader.consume``."""
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__package__)
+
+
+__all__ = ['MessageDispatcher', 'KeyedDispatcher']
+
+
+class MessageDispatcher:
+    """Runs ``handler`` for every dispatched message.
+
+    Coroutine handlers are run by at most ``concurrency`` worker tasks,
+    workers are started on demand and exit once there is nothing left to
+    do. Plain functions are called synchronously from ``dispatch``, so they
+    should be cheap.
+
+    Messages the handler did not finish or re-queue itself are finished
+    when it returns anything but ``False``, and re-queued with
+    ``requeue_delay`` when it returns ``False`` or raises. ``on_start`` is
+    called with every message right before the handler.
+    """
+
+    def __init__(self, handler, concurrency=1, requeue_delay=None,
+                 loop=None, on_start=None):
+        if concurrency < 1:
+            raise ValueError('concurrency must be positive')
+        self._handler = handler
+        self._is_coroutine = asyncio.iscoroutinefunction(handler)
+        self._concurrency = concurrency
+        self._requeue_delay = requeue_delay
+        self._on_start = on_start
+        self._loop = loop or asyncio.get_event_loop()
+        self._pending = deque()
+        self._workers = set()
+        # workers leave the set in a done callback, one iteration after
+        # they stopped taking messages, so count them separately
+        self._active_workers = 0
+
+    @property
+    def pending(self):
+        """Number of dispatched messages not passed to handler yet."""
+        return len(self._pending)
+
+    @property
+    def stats(self):
+        return {'pending': self.pending, 'workers': self._active_workers}
+
+    def dispatch(self, msg):
+        if not self._is_coroutine:
+            self._handle_sync(msg)
+            return
+        self._pending.append(msg)
+        if self._active_workers < self._concurrency:
+            self._active_workers += 1
+            worker = self._loop.create_task(self._worker())
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+
+    def _handle_sync(self, msg):
+        self._on_start is not None and self._on_start(msg)
+        try:
+            result = self._handler(msg)
+        except Exception:
+            logger.exception('Message handler failed')
+            result = False
+        self._complete(msg, result)
+
+    async def _worker(self):
+        try:
+            while self._pending:
+                msg = self._pending.popleft()
+                self._on_start is not None and self._on_start(msg)
+                try:
+                    result = await self._handler(msg)
+                except Exception:
+                    logger.exception('Message handler failed')
+                    result = False
+                self._complete(msg, result)
+        finally:
+            self._active_workers -= 1
+
+    def _complete(self, msg, result):
+        if msg.processed:
+            return
+        try:
+            if result is False and self._requeue_delay is not None:
+                msg.req(self._requeue_delay)
+            elif result is False:
+                msg.req()
+            else:
+                msg.fin()
+        except (ConnectionError, AssertionError) as exc:
+            # connection is gone, nsqd re-delivers the message itself
+            logger.error('Can not complete {}: {}'.format(msg, exc))
+
+    def take_pending(self):
+        """Remove and return messages not passed to handler yet."""
+        pending, self._pending = list(self._pending), deque()
+        return pending
+
+    async def join(self):
+        """Wait until running handlers return."""
+        while self._workers:
+            await asyncio.wait(list(self._workers))
+
+
+class KeyedDispatcher(MessageDispatcher):
+    """Runs ``handler`` in order for messages with the same key.
+
+    ``key(msg)`` picks the lane of a message, lanes are served one message
+    at a time by up to ``concurrency`` worker tasks, so messages of a key
+    are handled in the order they were dispatched and different keys run
+    in parallel. Lanes exist only while they have messages.
+
+    A lane of ``lane_size`` messages is full, ``on_full`` is called when
+    the first lane fills up and ``on_drained`` once all full lanes are down
+    to ``lane_size * low_water``, to stop and restart delivery.
+    """
+
+    def __init__(self, handler, key, concurrency=1, requeue_delay=None,
+                 loop=None, on_start=None, lane_size=None, low_water=0.5,
+                 on_full=None, on_drained=None):
+        super().__init__(handler, concurrency=concurrency,
+                         requeue_delay=requeue_delay, loop=loop,
+                         on_start=on_start)
+        self._key = key
+        self._lane_size = lane_size
+        self._low_water = 0 if lane_size is None else int(
+            lane_size * low_water)
+        self._on_full = on_full
+        self._on_drained = on_drained
+        self._lanes = {}
+        # keys with messages and no worker, in the order they are served
+        self._ready = deque()
+        self._running = set()
+        self._full = set()
+        self._count = 0
+        self._max_depth = 0
+        self._pauses = 0
+
+    @property
+    def pending(self):
+        return self._count
+
+    @property
+    def stats(self):
+        """Lane depths: number of lanes, messages waiting in them, the
+        deepest lane now and ever, full lanes and times delivery was
+        paused."""
+        return {
+            'pending': self._count,
+            'workers': self._active_workers,
+            'lanes': len(self._lanes),
+            'depth': max(map(len, self._lanes.values()), default=0),
+            'max_depth': self._max_depth,
+            'full': len(self._full),
+            'pauses': self._pauses,
+        }
+
+    def dispatch(self, msg):
+        if not self._is_coroutine:
+            # handled right away, the order is kept anyway
+            self._handle_sync(msg)
+            return
+        try:
+            key = self._key(msg)
+        except Exception:
+            logger.exception('Message key function failed')
+            self._complete(msg, False)
+            return
+        lane = self._lanes.get(key)
+        if lane is None:
+            self._lanes[key] = lane = deque()
+        lane.append(msg)
+        self._count += 1
+        self._max_depth = max(self._max_depth, len(lane))
+        if len(lane) == 1 and key not in self._running:
+            self._ready.append(key)
+        if self._lane_size is not None and len(lane) >= self._lane_size:
+            if not self._full:
+                self._pauses += 1
+                self._on_full is not None and self._on_full()
+            self._full.add(key)
+        if self._ready and self._active_workers < self._concurrency:
+            self._active_workers += 1
+            worker = self._loop.create_task(self._worker())
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+
+    async def _worker(self):
+        try:
+            while self._ready:
+                key = self._ready.popleft()
+                lane = self._lanes[key]
+                msg = lane.popleft()
+                self._count -= 1
+                self._running.add(key)
+                self._on_start is not None and self._on_start(msg)
+                try:
+                    result = await self._handler(msg)
+                except Exception:
+                    logger.exception('Message handler failed')
+                    result = False
+                finally:
+                    self._running.discard(key)
+                self._complete(msg, result)
+                if lane:
+                    # other keys waiting go first
+                    self._ready.append(key)
+                elif self._lanes.get(key) is lane:
+                    del self._lanes[key]
+                if key in self._full and len(lane) <= self._low_water:
+                    self._drained(key)
+        finally:
+            self._active_workers -= 1
+
+    def _drained(self, key):
+        self._full.discard(key)
+        if not self._full and self._on_drained is not None:
+            self._on_drained()
+
+    def take_pending(self):
+        pending = []
+        for lane in self._lanes.values():
+            pending.extend(lane)
+            lane.clear()
+        self._lanes, self._ready, self._count = {}, deque(), 0
+        for key in list(self._full):
+            self._drained(key)
+        return pending
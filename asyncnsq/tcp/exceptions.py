@@ -23,6 +23,14 @@ class NSQFrameError(NSQException):
     pass
 
 
+class NSQSpoolFull(NSQException):
+    """Writer spool reached its size limit"""
+
+
+class NSQCommandTimeout(NSQException, TimeoutError):
+    """nsqd did not respond to a command in time"""
+
+
 class NSQErrorCode(NSQException):
     fatal = True
 
@@ -1,56 +1,178 @@
-import asyncio
+import struct
+import weakref
 from collections import namedtuple
-from .consts import TOUCH, REQ, FIN
+from .consts import TOUCH, REQ, FIN, MSG_HEADER
 
 
-__all__ = ['NsqMessage', 'NsqErrorMessage']
+__all__ = ['NsqMessage', 'NsqMessageBatch', 'NsqErrorMessage']
 
 
 NsqErrorMessage = namedtuple('NsqError', ['code', 'msg'])
-BaseMessage = namedtuple('NsqMessage',
-                         'timestamp attempts message_id body conn')
 
+_HEADER = struct.Struct('>qh16s')
+_TIMESTAMP = struct.Struct('>q')
+_ATTEMPTS = struct.Struct('>h')
+_ATTEMPTS_OFFSET = _TIMESTAMP.size
 
-class NsqMessage(BaseMessage):
 
-    def __new__(cls, *args, **kwargs):
-        self = super().__new__(cls, *args, **kwargs)
+class NsqMessage:
+    """Message received from nsqd.
+
+    The raw message header is kept as is, ``timestamp``, ``attempts`` and
+    ``message_id`` are decoded from it on access. Only a weak reference to
+    the connection is held.
+    """
+
+    __slots__ = ('_header', 'body', '_conn', '_is_processed', '_touch_timer',
+                 '_received_at', '_started_at')
+
+    def __init__(self, timestamp, attempts, message_id, body, conn):
+        self._header = _HEADER.pack(timestamp, attempts, message_id)
+        self.body = body
+        self._conn = weakref.ref(conn)
         self._is_processed = False
+        # auto-touch timer of a Reader
+        self._touch_timer = None
+        # loop time of arrival and of a handler taking it, adaptive Reader
+        self._received_at = self._started_at = None
+
+    @classmethod
+    def from_frame(cls, header, body, conn):
+        """Build message from raw header (timestamp, attempts and id)."""
+        self = cls.__new__(cls)
+        self._header = header
+        self.body = body
+        self._conn = weakref.ref(conn)
+        self._is_processed = False
+        # auto-touch timer of a Reader
+        self._touch_timer = None
+        # loop time of arrival and of a handler taking it, adaptive Reader
+        self._received_at = self._started_at = None
         return self
 
+    @property
+    def timestamp(self):
+        return _TIMESTAMP.unpack_from(self._header)[0]
+
+    @property
+    def attempts(self):
+        return _ATTEMPTS.unpack_from(self._header, _ATTEMPTS_OFFSET)[0]
+
+    @property
+    def message_id(self):
+        return self._header[_ATTEMPTS_OFFSET + _ATTEMPTS.size:MSG_HEADER]
+
+    @property
+    def conn(self):
+        """Connection message was received from, ``None`` once it is
+        garbage collected."""
+        return self._conn()
+
     @property
     def processed(self):
         """True if message has been processed: finished or re-queued."""
         return self._is_processed
 
-    async def fin(self):
+    def _get_conn(self):
+        conn = self._conn()
+        if conn is None:
+            raise ConnectionError("Message connection is gone")
+        return conn
+
+    def fin(self):
         """Finish a message (indicate successful processing)
 
+        Command is written immediately, returned future may be awaited
+        but it does not have to be.
+
         :raises RuntimeWarning: in case message was processed earlier.
         """
         if self._is_processed:
             raise RuntimeWarning("Message has already been processed")
-        resp = await self.conn.execute(FIN, self.message_id)
-        self._is_processed = True
-        return resp
+        conn = self._get_conn()
+        fut = conn.execute(FIN, self.message_id)
+        self._processed()
+        conn.message_processed(True)
+        return fut
 
-    async def req(self, timeout=10):
+    def req(self, timeout=10, backoff=True):
         """Re-queue a message (indicate failure to process)
 
         :param timeout: ``int`` configured max timeout  0 is a special case
             that will not defer re-queueing.
+        :param backoff: ``bool`` count it as a failure, which slows the
+            reader down
         :raises RuntimeWarning: in case message was processed earlier.
         """
         if self._is_processed:
             raise RuntimeWarning("Message has already been processed")
-        resp = await self.conn.execute(REQ, self.message_id, timeout)
+        conn = self._get_conn()
+        fut = conn.execute(REQ, self.message_id, timeout)
+        self._processed()
+        if backoff:
+            conn.message_processed(False)
+        return fut
+
+    def _processed(self):
         self._is_processed = True
-        return resp
+        if self._touch_timer is not None:
+            self._touch_timer.cancel()
+            self._touch_timer = None
+        conn = self._conn()
+        if conn is not None and conn._on_done is not None:
+            conn._on_done(self)
 
-    async def touch(self):
+    def touch(self):
         """Reset the timeout for an in-flight message.
         :raises RuntimeWarning: in case message was processed earlier.
         """
         if self._is_processed:
             raise RuntimeWarning("Message has already been processed")
-        return await self.conn.execute(TOUCH, self.message_id)
+        return self._get_conn().execute(TOUCH, self.message_id)
+
+    def __repr__(self):
+        return '<NsqMessage: {} attempts={}>'.format(
+            self.message_id, self.attempts)
+
+
+class NsqMessageBatch(list):
+    """List of messages acknowledged together.
+
+    ``fin_all`` and ``req_all`` write the commands for all messages of a
+    connection with a single write, messages already processed one by
+    one are skipped.
+    """
+
+    @property
+    def nbytes(self):
+        """Total size of message bodies."""
+        return sum(len(msg.body) for msg in self)
+
+    def fin_all(self):
+        """Finish all messages of the batch."""
+        self._complete(FIN)
+
+    def req_all(self, timeout=10, backoff=True):
+        """Re-queue all messages of the batch.
+
+        :param timeout: ``int`` re-queue delay in milliseconds.
+        :param backoff: ``bool`` count them as failures
+        """
+        self._complete(REQ, timeout, success=False if backoff else None)
+
+    def _complete(self, command, *args, success=True):
+        by_conn = {}
+        for msg in self:
+            if msg._is_processed:
+                continue
+            conn = msg._conn()
+            if conn is None:
+                raise ConnectionError("Message connection is gone")
+            by_conn.setdefault(conn, []).append(msg)
+        for conn, msgs in by_conn.items():
+            conn.execute_many(
+                command, [(msg.message_id,) + args for msg in msgs])
+            for msg in msgs:
+                msg._processed()
+                if success is not None:
+                    conn.message_processed(success)
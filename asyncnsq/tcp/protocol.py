@@ -3,6 +3,7 @@
 :see: http://nsq.io/clients/tcp_protocol_spec.html
 """
 import abc
+import functools
 import struct
 import zlib
 import snappy
@@ -31,6 +32,15 @@ class BaseReader(metaclass=abc.ABCMeta):
         :return:
         """
 
+    def gets_all(self):
+        """Return list of all complete frames available in the buffer."""
+        frames = []
+        frame = self.gets()
+        while frame is not False:
+            frames.append(frame)
+            frame = self.gets()
+        return frames
+
     @abc.abstractmethod   # pragma: no cover
     def encode_command(self, cmd, *args, data=None):
         """
@@ -38,6 +48,14 @@ class BaseReader(metaclass=abc.ABCMeta):
         :return:
         """
 
+    @property
+    def encoder(self):
+        """Parser encoding commands without compression."""
+        return self
+
+    def compress(self, data):
+        return data
+
 
 class BaseCompressReader(BaseReader):
 
@@ -66,6 +84,10 @@ class BaseCompressReader(BaseReader):
     def gets(self):
         return self._parser.gets()
 
+    @property
+    def encoder(self):
+        return self._parser
+
     def encode_command(self, cmd, *args, data=None):
         cmd = self._parser.encode_command(cmd, *args, data=data)
         # print(cmd)
@@ -74,8 +96,8 @@ class BaseCompressReader(BaseReader):
 
 class DeflateReader(BaseCompressReader):
 
-    def __init__(self, buffer=None, level=6):
-        self._parser = Reader()
+    def __init__(self, buffer=None, level=6, raw_messages=False):
+        self._parser = Reader(raw_messages=raw_messages)
         wbits = -zlib.MAX_WBITS
         self._decompressor = zlib.decompressobj(wbits)
         self._compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
@@ -92,8 +114,8 @@ class DeflateReader(BaseCompressReader):
 
 class SnappyReader(BaseCompressReader):
 
-    def __init__(self, buffer=None):
-        self._parser = Reader()
+    def __init__(self, buffer=None, raw_messages=False):
+        self._parser = Reader(raw_messages=raw_messages)
         self._decompressor = snappy.StreamDecompressor()
         self._compressor = snappy.StreamCompressor()
         buffer and self.feed(buffer)
@@ -103,28 +125,45 @@ class SnappyReader(BaseCompressReader):
         return compressed
 
     def decompress(self, chunk):
-        return self._decompressor.decompress(chunk)
+        # StreamDecompressor works with bytes only, not memoryview
+        return self._decompressor.decompress(bytes(chunk))
+
+
+_LEN = struct.Struct('>l')
+_MSG_HEADER = struct.Struct('>qh16s')
 
 
 def _encode_body(data):
     _data = _convert_to_bytes(data)
-    result = struct.pack('>l', len(_data)) + _data
+    result = _LEN.pack(len(_data)) + _data
     return result
 
 
 class Reader(BaseReader):
-
-    def __init__(self, buffer=None):
-
+    """Cursor based frame parser.
+
+    Parsed frames are not cut from the head of the buffer, instead a read
+    offset is advanced, the consumed prefix is dropped only once it grows
+    past ``compact_size`` bytes. With ``zero_copy=True`` message bodies are
+    returned as ``memoryview`` slices of the receive buffer, otherwise
+    every body is copied exactly once. With ``raw_messages=True`` message
+    frames are returned as ``(header, body)``, the header (timestamp,
+    attempts and message id) is left undecoded.
+    """
+
+    def __init__(self, buffer=None, zero_copy=False,
+                 compact_size=consts.COMPACT_SIZE, raw_messages=False):
         self._buffer = bytearray()
-        self._payload_size = None
-        self._is_header = False
-        self._frame_type = None
+        self._offset = 0
+        self._zero_copy = zero_copy
+        self._raw_messages = raw_messages
+        self._compact_size = compact_size
         buffer and self.feed(buffer)
 
     @property
     def buffer(self):
-        return self._buffer
+        """Not yet parsed part of the buffer."""
+        return bytes(self._buffer[self._offset:])
 
     def feed(self, chunk):
         """Put raw chunk of data obtained from connection to buffer.
@@ -132,69 +171,78 @@ class Reader(BaseReader):
         """
         if not chunk:
             return
-        self._buffer.extend(chunk)
+        if self._offset and (self._offset == len(self._buffer) or
+                             self._offset >= self._compact_size):
+            self._compact()
+        try:
+            self._buffer.extend(chunk)
+        except BufferError:
+            # memoryview bodies handed out earlier still point to this
+            # buffer, so it can not be resized: continue in a fresh one
+            self._buffer = self._buffer[self._offset:] + chunk
+            self._offset = 0
+
+    def _compact(self):
+        try:
+            del self._buffer[:self._offset]
+        except BufferError:
+            self._buffer = self._buffer[self._offset:]
+        self._offset = 0
 
     def gets(self):
-        buffer_size = len(self._buffer)
-        if not self._is_header and buffer_size >= consts.DATA_SIZE:
-            size = struct.unpack('>l', self._buffer[:consts.DATA_SIZE])[0]
-            self._payload_size = size
-            self._is_header = True
-
-        if (self._is_header and buffer_size >=
-                consts.DATA_SIZE + self._payload_size):
-
-            start, end = consts.DATA_SIZE, consts.DATA_SIZE + consts.FRAME_SIZE
-
-            self._frame_type = struct.unpack('>l', self._buffer[start:end])[0]
-            resp = self._parse_payload()
-            self._reset()
-            return resp
-        return False
-
-    def _reset(self):
-        start = consts.DATA_SIZE + self._payload_size
-        self._buffer = self._buffer[start:]
-        self._is_header = False
-        self._payload_size = None
-        self._frame_type = None
-
-    def _parse_payload(self):
-        response_type, response = self._frame_type, None
-        if response_type == consts.FRAME_TYPE_RESPONSE:
-            response = self._unpack_response()
-        elif response_type == consts.FRAME_TYPE_ERROR:
-            response = self._unpack_error()
-        elif response_type == consts.FRAME_TYPE_MESSAGE:
-            response = self._unpack_message()
+        buffer, pos = self._buffer, self._offset
+        if len(buffer) - pos < consts.DATA_SIZE:
+            return False
+        size = _LEN.unpack_from(buffer, pos)[0]
+        end = pos + consts.DATA_SIZE + size
+        if len(buffer) < end:
+            return False
+        frame_type = _LEN.unpack_from(buffer, pos + consts.DATA_SIZE)[0]
+        start = pos + consts.HEADER_SIZE
+        if frame_type == consts.FRAME_TYPE_RESPONSE:
+            response = self._copy(start, end)
+        elif frame_type == consts.FRAME_TYPE_ERROR:
+            response = self._unpack_error(start, end)
+        elif frame_type == consts.FRAME_TYPE_MESSAGE:
+            response = self._unpack_message(start, end)
         else:
             raise ProtocolError()
-        return response_type, response
+        self._offset = end
+        return frame_type, response
 
-    def _unpack_error(self):
-        start = consts.DATA_SIZE + consts.FRAME_SIZE
-        end = consts.DATA_SIZE + self._payload_size
-        error = bytes(self._buffer[start:end])
+    def _unpack_error(self, start, end):
+        error = self._copy(start, end)
         code, msg = error.split(None, 1)
         return code, msg
 
-    def _unpack_response(self):
-        start = consts.DATA_SIZE + consts.FRAME_SIZE
-        end = consts.DATA_SIZE + self._payload_size
-        body = bytes(self._buffer[start:end])
-        return body
-
-    def _unpack_message(self):
-        start = consts.DATA_SIZE + consts.FRAME_SIZE
-        end = consts.DATA_SIZE + self._payload_size
-        msg_len = end - start - consts.MSG_HEADER
-        fmt = '>qh16s{}s'.format(msg_len)
-        payload = struct.unpack(fmt, self._buffer[start:end])
-        timestamp, attempts, msg_id, body = payload
+    def _unpack_message(self, start, end):
+        body_start = start + consts.MSG_HEADER
+        if self._zero_copy:
+            body = memoryview(self._buffer)[body_start:end]
+        else:
+            body = self._copy(body_start, end)
+        if self._raw_messages:
+            return self._copy(start, body_start), body
+        timestamp, attempts, msg_id = _MSG_HEADER.unpack_from(
+            self._buffer, start)
         return timestamp, attempts, msg_id, body
 
+    def _copy(self, start, end):
+        # slicing a bytearray copies, so slice a view to copy only once
+        with memoryview(self._buffer) as view:
+            return bytes(view[start:end])
+
     def encode_command(self, cmd, *args, data=None):
         """XXX"""
+        fast = _FAST_ENCODERS.get(cmd)
+        if fast is not None:
+            encode, arity, with_data = fast
+            if len(args) == arity and bool(data) == with_data:
+                return encode(self, *args, data) if with_data else \
+                    encode(self, *args)
+        return self._encode_generic(cmd, *args, data=data)
+
+    def _encode_generic(self, cmd, *args, data=None):
         _cmd = _convert_to_bytes(cmd.upper().strip())
         _args = [_convert_to_bytes(a) for a in args]
         body_data, params_data = b'', b''
@@ -205,9 +253,84 @@ class Reader(BaseReader):
         if data and isinstance(data, (list, tuple)):
             data_encoded = [_encode_body(part) for part in data]
             num_parts = len(data_encoded)
-            payload = struct.pack('>l', num_parts) + b''.join(data_encoded)
-            body_data = struct.pack('>l', len(payload)) + payload
+            payload = _LEN.pack(num_parts) + b''.join(data_encoded)
+            body_data = _LEN.pack(len(payload)) + payload
         elif data:
             body_data = _encode_body(data)
 
         return b''.join((_cmd, params_data, consts.NL, body_data))
+
+    def encode_fin(self, msg_id):
+        return b''.join((_FIN_PREFIX, _to_bytes(msg_id), consts.NL))
+
+    def encode_req(self, msg_id, timeout):
+        return b''.join((_REQ_PREFIX, _to_bytes(msg_id), b' ',
+                         _to_bytes(timeout), consts.NL))
+
+    def encode_touch(self, msg_id):
+        return b''.join((_TOUCH_PREFIX, _to_bytes(msg_id), consts.NL))
+
+    def encode_rdy(self, count):
+        if type(count) is int:
+            return _encode_rdy(count)
+        return b''.join((_RDY_PREFIX, _to_bytes(count), consts.NL))
+
+    def encode_pub(self, topic, data):
+        body = _to_bytes(data)
+        return b''.join((_PUB_PREFIX, _to_bytes(topic), consts.NL,
+                         _LEN.pack(len(body)), body))
+
+    def encode_dpub(self, topic, delay, data):
+        body = _to_bytes(data)
+        return b''.join((_DPUB_PREFIX, _to_bytes(topic), b' ',
+                         _to_bytes(delay), consts.NL,
+                         _LEN.pack(len(body)), body))
+
+    def encode_mpub(self, topic, messages):
+        """Encode MPUB, every message body is copied exactly once: join
+        sizes the output buffer up front and fills it in one pass.
+        """
+        if not isinstance(messages, (list, tuple)):
+            return self._encode_generic(consts.MPUB, topic, data=messages)
+        pack = _LEN.pack
+        parts = [_MPUB_PREFIX, _to_bytes(topic), consts.NL, None, None]
+        size = _LEN.size
+        for message in messages:
+            body = _to_bytes(message)
+            size += _LEN.size + len(body)
+            parts.append(pack(len(body)))
+            parts.append(body)
+        parts[3:5] = pack(size), pack(len(messages))
+        return b''.join(parts)
+
+
+def _to_bytes(value):
+    return value if type(value) is bytes else _convert_to_bytes(value)
+
+
+_FIN_PREFIX = consts.FIN + b' '
+_REQ_PREFIX = consts.REQ + b' '
+_TOUCH_PREFIX = consts.TOUCH + b' '
+_RDY_PREFIX = consts.RDY + b' '
+_PUB_PREFIX = consts.PUB + b' '
+_DPUB_PREFIX = consts.DPUB + b' '
+_MPUB_PREFIX = consts.MPUB + b' '
+
+
+@functools.lru_cache(maxsize=1024)
+def _encode_rdy(count):
+    return b'%b%d%b' % (_RDY_PREFIX, count, consts.NL)
+
+
+# command -> (encoder, number of args, has body)
+_FAST_ENCODERS = {
+    consts.FIN: (Reader.encode_fin, 1, False),
+    consts.REQ: (Reader.encode_req, 2, False),
+    consts.TOUCH: (Reader.encode_touch, 1, False),
+    consts.RDY: (Reader.encode_rdy, 1, False),
+    consts.PUB: (Reader.encode_pub, 1, True),
+    consts.DPUB: (Reader.encode_dpub, 2, True),
+    consts.MPUB: (Reader.encode_mpub, 1, True),
+}
+_FAST_ENCODERS.update({cmd.decode('ascii'): fast
+                       for cmd, fast in _FAST_ENCODERS.items()})
@@ -1,38 +1,109 @@
 import asyncio
 import random
 import logging
-import time
 from asyncnsq.http import NsqLookupd
+from asyncnsq.tcp import reader_rdy
 from asyncnsq.tcp.reader_rdy import RdyControl
+from asyncnsq.tcp.reader_adaptive import AdaptiveInFlight
+from asyncnsq.tcp.reader_queue import MessageQueue
 from functools import partial
 
 from . import consts
 from .connection import create_connection
-from .consts import SUB
+from .writer import create_writer
+from .dispatcher import MessageDispatcher, KeyedDispatcher
+from .messages import NsqMessageBatch
+from .consts import SUB, RDY, CLS
+from .exceptions import NSQException
+from .timer_wheel import get_timer_wheel
 from ..utils import retry_iterator
 
 logger = logging.getLogger(__package__)
 
+# share of msg_timeout left when a message is auto-touched
+AUTO_TOUCH_MARGIN = 0.1
+# seconds between checks of messages in flight while draining
+DRAIN_POLL_INTERVAL = 0.1
+# default limit of message bodies waiting in the queue
+MAX_QUEUE_BYTES = 64 * 1024 * 1024
+# weight of the latest message in the body size average
+BODY_SIZE_SMOOTHING = 0.1
+# change of the RDY cap from body size worth sending RDY for
+BODY_SIZE_CAP_CHANGE = 0.1
+
 
 async def create_reader(nsqd_tcp_addresses=None, loop=None,
-                        max_in_flight=42, lookupd_http_addresses=None):
+                        max_in_flight=42, lookupd_http_addresses=None,
+                        write_coalescing=False, auto_touch=False,
+                        command_timeout=consts.COMMAND_TIMEOUT,
+                        max_attempts=None, dead_letter_topic=None,
+                        rate_limit=None, rate_burst=None, adaptive=False,
+                        min_in_flight=1, max_in_flight_limit=2500,
+                        target_queue_wait=1.0, target_latency=None,
+                        max_queue_size=None,
+                        max_queue_bytes=MAX_QUEUE_BYTES):
     """"
     initial function to get consumer
     param: nsqd_tcp_addresses: tcp addrs with no protocol.
         such as ['127.0.0.1:4150','182.168.1.1:4150']
     param: max_in_flight: number of messages get but not finish or req
     param: lookupd_http_addresses: first priority.if provided nsqd will neglected
+    param: write_coalescing: send FIN, REQ, RDY and other commands issued
+        in one loop iteration with a single write
+    param: auto_touch: TOUCH messages in flight before nsqd times them
+        out, until they are finished or re-queued
+    param: command_timeout: seconds nsqd has to answer SUB, CLS and other
+        commands before the connection is dropped
+    param: max_attempts: deliveries of a message before it is given up,
+        it is published to ``dead_letter_topic`` if set and finished
+        without reaching the handler
+    param: dead_letter_topic: topic of given up messages, published to
+        the nsqd they came from
+    param: rate_limit: messages per second received over all connections,
+        enforced with RDY, see ``Reader.set_rate_limit``
+    param: rate_burst: messages received at once after idling
+    param: adaptive: adjust max in flight between ``min_in_flight`` and
+        ``max_in_flight_limit`` to keep the time messages wait for a
+        handler under ``target_queue_wait`` and, if set, handler time
+        under ``target_latency`` seconds, see ``reader_adaptive``
+    param: max_queue_size: messages waiting for ``messages()``, RDY is held
+        at 0 when reached until the queue is half empty
+    param: max_queue_bytes: bytes of message bodies waiting, likewise
     """
     loop = loop or asyncio.get_event_loop()
     if lookupd_http_addresses:
         reader = Reader(lookupd_http_addresses=lookupd_http_addresses,
-                        max_in_flight=max_in_flight, loop=loop)
+                        max_in_flight=max_in_flight, loop=loop,
+                        write_coalescing=write_coalescing,
+                        auto_touch=auto_touch,
+                        command_timeout=command_timeout,
+                        max_attempts=max_attempts,
+                        dead_letter_topic=dead_letter_topic,
+                        rate_limit=rate_limit, rate_burst=rate_burst,
+                        adaptive=adaptive, min_in_flight=min_in_flight,
+                        max_in_flight_limit=max_in_flight_limit,
+                        target_queue_wait=target_queue_wait,
+                        target_latency=target_latency,
+                        max_queue_size=max_queue_size,
+                        max_queue_bytes=max_queue_bytes)
     else:
         if nsqd_tcp_addresses is None:
             nsqd_tcp_addresses = ['127.0.0.1:4150']
         nsqd_tcp_addresses = [i.split(':') for i in nsqd_tcp_addresses]
         reader = Reader(nsqd_tcp_addresses=nsqd_tcp_addresses,
-                        max_in_flight=max_in_flight, loop=loop)
+                        max_in_flight=max_in_flight, loop=loop,
+                        write_coalescing=write_coalescing,
+                        auto_touch=auto_touch,
+                        command_timeout=command_timeout,
+                        max_attempts=max_attempts,
+                        dead_letter_topic=dead_letter_topic,
+                        rate_limit=rate_limit, rate_burst=rate_burst,
+                        adaptive=adaptive, min_in_flight=min_in_flight,
+                        max_in_flight_limit=max_in_flight_limit,
+                        target_queue_wait=target_queue_wait,
+                        target_latency=target_latency,
+                        max_queue_size=max_queue_size,
+                        max_queue_bytes=max_queue_bytes)
     await reader.connect()
     return reader
 
@@ -46,7 +117,19 @@ class Reader:
                  max_in_flight=42, loop=None, heartbeat_interval=30000,
                  feature_negotiation=True,
                  tls_v1=False, snappy=False, deflate=False, deflate_level=6,
-                 sample_rate=0, consumer=False, log_level=None):
+                 sample_rate=0, consumer=False, log_level=None,
+                 write_coalescing=False,
+                 backoff_interval=reader_rdy.BACKOFF_INTERVAL,
+                 backoff_multiplier=reader_rdy.BACKOFF_MULTIPLIER,
+                 max_backoff=reader_rdy.MAX_BACKOFF,
+                 connect_timeout=5.0, identify_timeout=5.0,
+                 lookupd_poll_interval=30, lookupd_poll_jitter=0.3,
+                 lookupd_cache_ttl=300, auto_touch=False,
+                 command_timeout=consts.COMMAND_TIMEOUT, max_attempts=None,
+                 dead_letter_topic=None, rate_limit=None, rate_burst=None,
+                 adaptive=False, min_in_flight=1, max_in_flight_limit=2500,
+                 target_queue_wait=1.0, target_latency=None,
+                 max_queue_size=None, max_queue_bytes=MAX_QUEUE_BYTES):
         self._config = {
             "deflate": deflate,
             "deflate_level": deflate_level,
@@ -56,16 +139,31 @@ class Reader:
             "heartbeat_interval": heartbeat_interval,
             'feature_negotiation': feature_negotiation,
         }
+        self._conn_config = {'write_coalescing': write_coalescing,
+                             'command_timeout': command_timeout}
         self._nsqd_tcp_addresses = nsqd_tcp_addresses or []
         self._lookupd_http_addresses = lookupd_http_addresses or []
 
+        self._connect_timeout = connect_timeout
+        self._identify_timeout = identify_timeout
         self._max_in_flight = max_in_flight
         self._loop = loop or asyncio.get_event_loop()
-        self._queue = asyncio.Queue(loop=self._loop)
+        self._queue = MessageQueue(
+            max_count=max_queue_size, max_bytes=max_queue_bytes,
+            on_full=self._queue_full, on_drained=self._queue_drained)
+        self._max_queue_bytes = max_queue_bytes
+        # moving average of message body sizes, RDY cap it gives
+        self._body_size = None
+        self._body_size_cap = None
         self._redistribute_task = None
-        self._reconnect_task = None
+        self._dispatcher = None
+        self._consume_waiter = None
 
         self._connections = {}
+        # background connect retries by endpoint
+        self._connect_tasks = {}
+        # reconnect count and downtime by endpoint
+        self._nodes = {}
 
         self._idle_timeout = 10
 
@@ -75,13 +173,48 @@ class Reader:
         self._status = consts.INIT
 
         self._is_subscribe = False
-        self._redistribute_timeout = 5  # sec
-        self._lookupd_poll_time = 30  # sec
+        self._redistribute_timeout = 1  # sec
+        self._lookupd_poll_interval = lookupd_poll_interval
+        self._lookupd_poll_jitter = lookupd_poll_jitter
+        self._lookupd_cache_ttl = lookupd_cache_ttl
+        # last producers of every lookupd with response time
+        self._lookupd_cache = {}
+        self._lookupd_conns = {}
+        self._lookupd_task = None
+        # time to process in flight messages of a node which left
+        self._drain_timeout = 60  # sec
+        # drains of nodes which left the topic
+        self._drain_tasks = set()
+        # report of close()
+        self._drain_stats = None
+        self._auto_touch = auto_touch
+        self._timer_wheel = get_timer_wheel(self._loop)
+        self._touches = 0
+        self._max_attempts = max_attempts
+        self._dead_letter_topic = dead_letter_topic
+        # batching writers to nsqd given up messages came from
+        self._dead_letter_writers = {}
+        self._dead_letter_tasks = set()
+        self._dead_letter_stats = {'published': 0, 'dropped': 0,
+                                   'failed': 0}
         self.topic = None
         self.channel = None
         self._rdy_control = RdyControl(idle_timeout=self._idle_timeout,
                                        max_in_flight=self._max_in_flight,
-                                       loop=self._loop)
+                                       loop=self._loop,
+                                       backoff_interval=backoff_interval,
+                                       backoff_multiplier=backoff_multiplier,
+                                       max_backoff=max_backoff,
+                                       rate_limit=rate_limit,
+                                       burst=rate_burst)
+        self._adaptive = None
+        if adaptive:
+            self._adaptive = AdaptiveInFlight(
+                self._rdy_control, self._in_flight, self._loop,
+                min_in_flight=min_in_flight,
+                max_in_flight=max_in_flight_limit,
+                target_queue_wait=target_queue_wait,
+                target_latency=target_latency)
 
     async def connect(self):
         logging.info('reader connecting')
@@ -92,66 +225,311 @@ class Reader:
             """
             pass
         if self._nsqd_tcp_addresses:
-            for host, port in self._nsqd_tcp_addresses:
-                conn = await create_connection(
-                    host, port, queue=self._queue,
-                    loop=self._loop)
-                await self.prepare_conn(conn)
-            self._connections[conn.id] = conn
-            self._rdy_control.add_connections(self._connections)
+            await self._connect_nodes(self._nsqd_tcp_addresses)
             self._status = consts.CONNECTED
-        self._loop.create_task(self.auto_reconnect())
+
+    async def _connect_nodes(self, addresses):
+        """Connect to all nodes concurrently. Returns number of nodes
+        connected, the others are retried in background."""
+        results = await asyncio.gather(
+            *[self._connect_node(host, port) for host, port in addresses])
+        if addresses and not any(results):
+            logger.error('Can not connect to any of nsqd %s', addresses)
+        return sum(results)
+
+    async def _connect_node(self, host, port, retry=True):
+        """Connect, identify and, when subscribed, subscribe to a node
+        within the configured timeouts. Returns ``False`` on failure, a
+        background retry is started when ``retry`` is true."""
+        conn = None
+        try:
+            conn = await asyncio.wait_for(create_connection(
+                host, port, queue=self._queue, loop=self._loop,
+                **self._conn_config), self._connect_timeout)
+            await asyncio.wait_for(self.prepare_conn(conn),
+                                   self._identify_timeout)
+            if self._is_subscribe:
+                await asyncio.wait_for(
+                    self.sub(conn, self.topic, self.channel),
+                    self._identify_timeout)
+        except Exception as exc:
+            if isinstance(exc, (asyncio.TimeoutError, OSError,
+                                NSQException)):
+                logger.error('Can not connect to tcp://%s:%s: %r',
+                             host, port, exc)
+            else:
+                # a single node must not abort connect() for the others
+                logger.exception('Can not connect to tcp://%s:%s',
+                                 host, port)
+            if conn is not None:
+                conn.close()
+            if retry:
+                self._retry_node(host, port)
+            return False
+        self._connections[conn.id] = conn
+        self._rdy_control.add_connection(conn)
+        if self._is_subscribe:
+            # RDY 1 for the new node too while message size is unknown
+            self._cap_until_body_size()
+            self._rdy_control.redistribute()
+        node = self._nodes.get(conn.id)
+        if node is not None and node['down_since'] is not None:
+            node['reconnects'] += 1
+            node['downtime'] += self._loop.time() - node['down_since']
+            node['down_since'] = None
+        return True
+
+    def _on_conn_closed(self, conn):
+        if self._connections.get(conn.id) is not conn:
+            # closed on purpose or before it was set up
+            return
+        logger.warning('Connection %s lost, reconnecting', conn.id)
+        del self._connections[conn.id]
+        self._rdy_control.remove_connection(conn)
+        node = self._nodes.setdefault(
+            conn.id, {'reconnects': 0, 'downtime': 0.0, 'down_since': None})
+        node['down_since'] = self._loop.time()
+        self._retry_node(conn._host, conn._port, now=True)
+
+    def _retry_node(self, host, port, now=False):
+        endpoint = 'tcp://{}:{}'.format(host, port)
+        if endpoint not in self._connect_tasks:
+            self._connect_tasks[endpoint] = self._loop.create_task(
+                self._retry_connect(endpoint, host, port, now))
+
+    async def _retry_connect(self, endpoint, host, port, now):
+        # every node backs off on its own, from scratch once connected
+        delays = retry_iterator(init_delay=0.1, max_delay=10.0, now=now)
+        task = asyncio.current_task()
+        try:
+            for delay in delays:
+                await asyncio.sleep(delay)
+                # wait_for() may swallow cancellation, stop() and pruning
+                # unregister the task as well
+                if self._connect_tasks.get(endpoint) is not task:
+                    return
+                if await self._connect_node(host, port, retry=False):
+                    logger.info('Connection %s established', endpoint)
+                    return
+        finally:
+            if self._connect_tasks.get(endpoint) is task:
+                del self._connect_tasks[endpoint]
 
     async def prepare_conn(self, conn):
-        conn.rdy_state = 2
         conn._on_message = partial(self._on_message, conn)
+        conn._on_close = self._on_conn_closed
+        conn._on_processed = self._rdy_control.message_processed
+        if self._adaptive is not None:
+            conn._on_done = self._adaptive.message_done
         result = await conn.identify(**self._config)
 
     def _on_message(self, conn, msg):
         # should not be coroutine
-        # update connections rdy state
-        conn.rdy_state = int(conn.rdy_state) - 1
-
-        conn._last_message = time.time()
-        if conn._on_rdy_changed_cb is not None:
-            conn._on_rdy_changed_cb(conn.id)
+        self._rdy_control.message_received(conn.id)
+        if self._max_queue_bytes is not None:
+            self._cap_by_body_size(len(msg.body))
+        if (self._max_attempts is not None
+                and msg.attempts > self._max_attempts):
+            task = self._loop.create_task(self._dead_letter(conn, msg))
+            self._dead_letter_tasks.add(task)
+            task.add_done_callback(self._dead_letter_tasks.discard)
+            return None
+        if self._adaptive is not None:
+            self._adaptive.message_received(msg)
+        if self._auto_touch:
+            self._schedule_touch(conn, msg, self._loop.time())
+        if self._dispatcher is not None:
+            self._dispatcher.dispatch(msg)
+            return None
         return msg
 
-    async def _poll_lookupd(self, host, port):
-        nsqlookup_conn = NsqLookupd(host, port, loop=self._loop)
+    async def _dead_letter(self, conn, msg):
+        """Publish a message delivered too many times to the dead letter
+        topic, then finish it."""
+        stats = self._dead_letter_stats
+        if self._dead_letter_topic is None:
+            logger.warning('Giving up on %r', msg)
+            stats['dropped'] += 1
+        else:
+            try:
+                writer = await self._dead_letter_writer(conn)
+                await writer.pub(self._dead_letter_topic, msg.body)
+            except (asyncio.TimeoutError, AssertionError, OSError,
+                    NSQException) as exc:
+                logger.error('Dead letter publish of %r failed: %r',
+                             msg, exc)
+                stats['failed'] += 1
+                # given up again on the next delivery
+                if not conn.closed:
+                    msg.req(backoff=False)
+                return
+            stats['published'] += 1
+        if not conn.closed:
+            msg.fin()
+
+    async def _dead_letter_writer(self, conn):
+        endpoint = conn.id
+        writer = self._dead_letter_writers.get(endpoint)
+        if writer is None:
+            writer = self._loop.create_task(asyncio.wait_for(create_writer(
+                conn._host, conn._port, loop=self._loop, batching=True,
+                **self._config, **self._conn_config), self._connect_timeout))
+            self._dead_letter_writers[endpoint] = writer
+        try:
+            return await asyncio.shield(writer)
+        except BaseException:
+            if writer.done() and self._dead_letter_writers.get(
+                    endpoint) is writer:
+                # connected again by the next dead letter
+                del self._dead_letter_writers[endpoint]
+            raise
+
+    def _close_dead_letter_writers(self):
+        writers, self._dead_letter_writers = self._dead_letter_writers, {}
+        for writer in writers.values():
+            if not writer.done():
+                writer.cancel()
+            elif not writer.cancelled() and writer.exception() is None:
+                writer.result().close()
+
+    def _schedule_touch(self, conn, msg, received):
+        """TOUCH a message shortly before nsqd would time it out."""
+        delay = conn.msg_timeout / 1000 * (1 - AUTO_TOUCH_MARGIN)
+        msg._touch_timer = self._timer_wheel.call_later(
+            delay, self._touch, msg, received)
+
+    def _touch(self, msg, received):
+        msg._touch_timer = None
+        conn = msg.conn
+        if msg.processed or conn is None or conn.closed:
+            return
+        # nsqd does not keep a message in flight past max_msg_timeout
+        if self._loop.time() - received >= conn.max_msg_timeout / 1000:
+            return
+        msg.touch()
+        self._touches += 1
+        self._schedule_touch(conn, msg, received)
+
+    async def _query_lookupd(self, address):
+        conn = self._lookupd_conns.get(address)
+        if conn is None:
+            conn = NsqLookupd(*address, loop=self._loop)
+            self._lookupd_conns[address] = conn
+        res = await asyncio.wait_for(conn.lookup(self.topic),
+                                     self._connect_timeout)
+        # nsqlookupd before 1.0 wraps response into data
+        res = res.get('data', res)
+        return {(p['broadcast_address'], p['tcp_port'])
+                for p in res['producers']}
+
+    async def _lookup_producers(self):
+        """Query all lookupd concurrently and merge producers they know.
+
+        A failed lookupd contributes its last response until it is older
+        than the cache TTL. Returns ``None`` when there is nothing to go
+        by, so that connections are not pruned because lookupd is down.
+        """
+        addresses = [tuple(address)
+                     for address in self._lookupd_http_addresses]
+        results = await asyncio.gather(
+            *[self._query_lookupd(address) for address in addresses],
+            return_exceptions=True)
+        now = self._loop.time()
+        for address, result in zip(addresses, results):
+            if isinstance(result, Exception):
+                logger.error('lookupd %s:%s query failed: %r',
+                             *address, result)
+            else:
+                self._lookupd_cache[address] = (now, result)
+        producers = None
+        for address in addresses:
+            cached = self._lookupd_cache.get(address)
+            if cached is None:
+                continue
+            updated, nodes = cached
+            if now - updated > self._lookupd_cache_ttl:
+                del self._lookupd_cache[address]
+                continue
+            producers = (producers or set()) | nodes
+        return producers
+
+    async def _lookupd(self):
+        """Connect to new producers of the topic, drain and close
+        connections to nodes which left it."""
+        producers = await self._lookup_producers()
+        if producers is None:
+            return
+        endpoints = {'tcp://{}:{}'.format(*p): p for p in producers}
+        static = {'tcp://{}:{}'.format(host, port)
+                  for host, port in self._nsqd_tcp_addresses}
+        for endpoint, conn in list(self._connections.items()):
+            if endpoint not in endpoints and endpoint not in static:
+                logger.info('nsqd %s left topic %s', endpoint, self.topic)
+                del self._connections[endpoint]
+                self._rdy_control.remove_connection(conn)
+                task = self._loop.create_task(self._drain_conn(conn))
+                self._drain_tasks.add(task)
+                task.add_done_callback(self._drain_tasks.discard)
+        for endpoint in list(self._connect_tasks):
+            if endpoint not in endpoints and endpoint not in static:
+                self._connect_tasks.pop(endpoint).cancel()
+        new = [producer for endpoint, producer in endpoints.items()
+               if endpoint not in self._connections
+               and endpoint not in self._connect_tasks]
+        if new:
+            await self._connect_nodes(sorted(new))
+
+    async def _poll_lookupd(self):
+        while self._is_subscribe:
+            jitter = random.uniform(-1, 1) * self._lookupd_poll_jitter
+            await asyncio.sleep(self._lookupd_poll_interval * (1 + jitter))
+            try:
+                await self._lookupd()
+            except Exception as exc:
+                logger.exception(exc)
+
+    async def _drain_conn(self, conn, timeout=None, close=True):
+        """Stop receiving from a connection, wait until messages in
+        flight are processed or ``timeout`` passes, drain timeout by
+        default, then close it unless ``close`` is false."""
+        if timeout is None:
+            timeout = self._drain_timeout
+        deadline = self._loop.time() + timeout
         try:
-            res = await nsqlookup_conn.lookup(self.topic)
-            logger.info('lookupd response')
-            logger.info(res)
-        except Exception as tmp:
-            logger.error(tmp)
-            logger.exception(tmp)
-
-        for producer in res['producers']:
-            host = producer['broadcast_address']
-            port = producer['tcp_port']
-            tmp_id = "tcp://{}:{}".format(host, port)
-            if tmp_id not in self._connections:
-                logger.debug(('host, port', host, port))
-                conn = await create_connection(
-                    host, port, queue=self._queue,
-                    loop=self._loop)
-                logger.debug(('conn.id:', conn.id))
-                self._connections[conn.id] = conn
-                self._rdy_control.add_connection(conn)
-        await nsqlookup_conn.close()
+            conn.execute(RDY, 0)
+            await asyncio.wait_for(conn.execute(CLS), timeout)
+            while (conn.in_flight and not conn.closed
+                   and self._loop.time() < deadline):
+                await asyncio.sleep(DRAIN_POLL_INTERVAL)
+        except (asyncio.TimeoutError, AssertionError, OSError,
+                NSQException) as exc:
+            logger.error('Drain of %s failed: %r', conn.id, exc)
+        finally:
+            close and conn.close()
+
+    async def _close_lookupd(self):
+        conns, self._lookupd_conns = self._lookupd_conns, {}
+        for conn in conns.values():
+            await conn.close()
 
     async def subscribe(self, topic, channel):
         self.topic = topic
         self.channel = channel
+        # nodes connected from now on subscribe on their own
         self._is_subscribe = True
-
+        conns = list(self._connections.values())
+        await asyncio.gather(*[self._sub_conn(conn) for conn in conns])
+        # no RDY before SUB, nsqd would close the connection, the cap is
+        # in place before lookupd nodes connect and get their first RDY
+        self._cap_until_body_size()
         if self._lookupd_http_addresses:
             await self._lookupd()
-        for conn in self._connections.values():
-            await self.sub(conn, topic, channel)
-            if conn._on_rdy_changed_cb is not None:
-                conn._on_rdy_changed_cb(conn.id)
+            if self._lookupd_task is None:
+                self._lookupd_task = self._loop.create_task(
+                    self._poll_lookupd())
+        self._rdy_control.redistribute()
+        if self._adaptive is not None:
+            self._adaptive.start()
         if not self._redistribute_task:
             self._redistribute_task = self._loop.create_task(
                 self._redistribute()
@@ -160,6 +538,17 @@ class Reader:
     async def sub(self, conn, topic, channel):
         await conn.execute(SUB, topic, channel)
 
+    async def _sub_conn(self, conn):
+        try:
+            await asyncio.wait_for(self.sub(conn, self.topic, self.channel),
+                                   self._identify_timeout)
+        except (asyncio.TimeoutError, OSError, NSQException) as exc:
+            logger.error('Can not subscribe %s: %r', conn.id, exc)
+            self._connections.pop(conn.id, None)
+            self._rdy_control.remove_connection(conn)
+            conn.close()
+            self._retry_node(conn._host, conn._port)
+
     def wait_messages(self):
         if not self._is_subscribe:
             raise ValueError('You must subscribe to the topic first')
@@ -174,66 +563,295 @@ class Reader:
 
         while self._is_subscribe:
             result = await self._queue.get()
+            self._message_started(result)
             yield result
 
+    async def messages_batch(self, max_size, max_bytes=None, max_wait=1.0):
+        """Yield ``NsqMessageBatch`` lists of up to ``max_size`` messages
+        and ``max_bytes`` of bodies.
+
+        A batch is yielded once it is full or ``max_wait`` seconds after its
+        first message arrived, it is never empty. Max in flight is raised
+        to ``max_size`` if needed, so that nsqd can fill a batch.
+        Acknowledge a batch with ``fin_all()`` / ``req_all()``.
+        """
+        if not self._is_subscribe:
+            raise ValueError('You must subscribe to the topic first')
+        if max_size > self._rdy_control.max_in_flight:
+            self._rdy_control.set_max_in_flight(max_size)
+        queue = self._queue
+        # message which did not fit into max_bytes of the previous batch
+        carry = None
+        # get() waiting for a message, kept between batches because
+        # cancelling it could lose a message
+        getter = None
+        try:
+            while self._is_subscribe:
+                batch = NsqMessageBatch()
+                nbytes = 0
+                deadline = None
+                while len(batch) < max_size:
+                    if carry is not None:
+                        msg, carry = carry, None
+                    elif not queue.empty():
+                        msg = queue.get_nowait()
+                    else:
+                        if getter is None:
+                            getter = asyncio.ensure_future(queue.get())
+                        timeout = None
+                        if deadline is not None:
+                            timeout = deadline - self._loop.time()
+                            if timeout <= 0:
+                                break
+                        done, _ = await asyncio.wait([getter],
+                                                     timeout=timeout)
+                        if not done:
+                            break
+                        msg, getter = getter.result(), None
+                    if (max_bytes is not None and batch
+                            and nbytes + len(msg.body) > max_bytes):
+                        carry = msg
+                        break
+                    batch.append(msg)
+                    nbytes += len(msg.body)
+                    if deadline is None:
+                        deadline = self._loop.time() + max_wait
+                for msg in batch:
+                    self._message_started(msg)
+                yield batch
+        finally:
+            if getter is not None:
+                if getter.done() and not getter.cancelled():
+                    queue.put_nowait(getter.result())
+                else:
+                    getter.cancel()
+            if carry is not None:
+                queue.put_nowait(carry)
+
+    async def consume(self, handler, concurrency=1, requeue_delay=None,
+                      key=None, lane_size=None):
+        """Push messages to ``handler`` as they are parsed, bypassing the
+        queue ``messages()`` reads from.
+
+        A coroutine ``handler`` runs in up to ``concurrency`` tasks, a plain
+        function is called right from the connection read callback. Unless
+        the handler finishes or re-queues the message itself, it is
+        finished when the handler returns, and re-queued with
+        ``requeue_delay`` when it returns ``False`` or raises.
+
+        With a ``key`` function messages of the same key are handled one
+        at a time in the order they arrived, see ``KeyedDispatcher``. Once
+        a key has ``lane_size`` messages waiting, RDY is held at 0 until
+        its lane is half empty.
+
+        Runs until cancelled or ``stop()``, messages not handed to the
+        handler by then go back to the ``messages()`` queue.
+        """
+        if not self._is_subscribe:
+            raise ValueError('You must subscribe to the topic first')
+        if self._dispatcher is not None:
+            raise RuntimeError('Reader is already consuming')
+        if key is None:
+            dispatcher = MessageDispatcher(
+                handler, concurrency=concurrency,
+                requeue_delay=requeue_delay, loop=self._loop,
+                on_start=self._message_started)
+        else:
+            dispatcher = KeyedDispatcher(
+                handler, key, concurrency=concurrency,
+                requeue_delay=requeue_delay, loop=self._loop,
+                on_start=self._message_started, lane_size=lane_size,
+                on_full=partial(self._rdy_control.pause, 'lanes'),
+                on_drained=partial(self._rdy_control.resume, 'lanes'))
+        self._dispatcher = dispatcher
+        self._consume_waiter = self._loop.create_future()
+        while not self._queue.empty():
+            dispatcher.dispatch(self._queue.get_nowait())
+        try:
+            await self._consume_waiter
+        finally:
+            self._dispatcher = self._consume_waiter = None
+            for msg in dispatcher.take_pending():
+                self._queue.put_nowait(msg)
+            await dispatcher.join()
+
+    def _cap_by_body_size(self, size):
+        """Keep messages in flight to what fits in max_queue_bytes, so
+        that nsqd does not send more than the queue takes."""
+        if self._body_size is None:
+            self._body_size = size
+        else:
+            self._body_size += BODY_SIZE_SMOOTHING * (size - self._body_size)
+        cap = max(1, int(self._max_queue_bytes / max(1, self._body_size)))
+        current = self._body_size_cap
+        if current is None or abs(cap - current) > max(
+                1, current * BODY_SIZE_CAP_CHANGE):
+            self._body_size_cap = cap
+            self._rdy_control.set_cap('bytes', cap)
+
+    def _cap_until_body_size(self):
+        if self._max_queue_bytes is not None and self._body_size is None:
+            # RDY 1 per connection until message size is known
+            self._rdy_control.set_cap(
+                'bytes', max(1, len(self._connections)))
+
+    def _queue_full(self):
+        logger.warning('Message queue is full, %d messages of %d bytes',
+                       self._queue.qsize(), self._queue.nbytes)
+        self._rdy_control.pause('queue')
+
+    def _queue_drained(self):
+        self._rdy_control.resume('queue')
+
+    def _in_flight(self):
+        return sum(conn.in_flight for conn in self._connections.values())
+
+    def _message_started(self, msg):
+        if self._adaptive is not None:
+            self._adaptive.message_started(msg)
+
     async def reconnect(self, conn):
+        """Replace closed connection, lost connections are reconnected
+        automatically."""
         logger.debug(f'reader reconnect {conn.id}')
 
         if not conn.closed:
             return
 
-        conn = await create_connection(
-            conn._host, conn._port, queue=self._queue, loop=self._loop)
-        await self.prepare_conn(conn)
-
-        logger.info(f'Connection {conn.id} established')
-        self._connections[conn.id] = conn
-        self._rdy_control.add_connections(self._connections)
-
-        await self.subscribe(self.topic, self.channel)
-        # TODO: _cmd_queue is not working here...
-        await self._rdy_control._update_rdy(conn.id)
-
-    async def auto_reconnect(self):
-        logger.debug('reader autoreconnect')
-        timeout_generator = retry_iterator(init_delay=0.1, max_delay=10.0)
-        while True:
-            logger.debug('autoreconnect check loop')
-
-            if self._status != consts.RECONNECTING:
-                for conn in list(self._connections.values()).copy():
-                    if conn.closed:
-                        logger.info('Reconnect reader {}'.format(conn.id))
-                        self._status = consts.RECONNECTING
+        self._connections.pop(conn.id, None)
+        self._rdy_control.remove_connection(conn)
+        # retried in background on failure
+        if await self._connect_node(conn._host, conn._port):
+            logger.info(f'Connection {conn.id} established')
+
+    @property
+    def stats(self):
+        """Reader metrics, ``rdy`` has RDY and backoff state."""
+        return {
+            'rdy': self._rdy_control.stats,
+            'connections': len(self._connections),
+            # nodes retried in background
+            'connecting': len(self._connect_tasks),
+            'nodes': {endpoint: self._node_stats(node)
+                      for endpoint, node in self._nodes.items()},
+            'touches': self._touches,
+            'dead_letter': dict(self._dead_letter_stats),
+            'dispatcher': (None if self._dispatcher is None
+                           else self._dispatcher.stats),
+            'queue': self._queue.stats,
+            'max_in_flight': self._rdy_control.max_in_flight,
+            'adaptive': (None if self._adaptive is None
+                         else self._adaptive.stats),
+            'drain': self._drain_stats,
+        }
 
-                        try:
-                            await self.reconnect(conn)
-                        except ConnectionError:
-                            logger.error(f'Can not connect to: {conn.id}')
-                self._status = consts.CONNECTED
+    def _node_stats(self, node):
+        downtime = node['downtime']
+        if node['down_since'] is not None:
+            downtime += self._loop.time() - node['down_since']
+        return {'reconnects': node['reconnects'], 'downtime': downtime,
+                'connected': node['down_since'] is None}
 
-            t = next(timeout_generator)
-            await asyncio.sleep(t, loop=self._loop)
+    def set_rate_limit(self, rate_limit, burst=None):
+        """Change messages per second and burst, ``None`` lifts the limit."""
+        self._rdy_control.set_rate_limit(rate_limit, burst)
 
     def is_starved(self):
-        conns = self._connections.values()
-        return any(conn.is_starved() for conn in conns)
+        return self._rdy_control.is_starved()
 
     async def _redistribute(self):
         while self._is_subscribe:
             self._rdy_control.redistribute()
-            await asyncio.sleep(self._redistribute_timeout,
-                                loop=self._loop)
+            await asyncio.sleep(self._redistribute_timeout)
 
-    async def _lookupd(self):
-        host, port = random.choice(self._lookupd_http_addresses)
-        await self._poll_lookupd(host, port)
+    def _stop_tasks(self):
+        if self._redistribute_task:
+            self._redistribute_task.cancel()
+        if self._adaptive is not None:
+            self._adaptive.stop()
+        tasks, self._connect_tasks = self._connect_tasks, {}
+        for task in tasks.values():
+            task.cancel()
+        if self._lookupd_task:
+            self._lookupd_task.cancel()
 
     def stop(self):
+        """Close all connections right away, messages in flight are
+        re-delivered by nsqd, see ``close()`` to drain them first."""
         self._is_subscribe = False
-        if self._redistribute_task:
-            self._redistribute_task.cancel()
-        self._reconnect_task.cancel()
-        for connection in self._connections:
+        if (self._dispatcher is not None
+                and not self._consume_waiter.done()):
+            self._consume_waiter.set_result(None)
+        self._stop_tasks()
+        self._loop.create_task(self._close_lookupd())
+        conns, self._connections = self._connections, {}
+        for connection in conns.values():
             connection.close()
-        self._loop.run_until_complete(self._rdy_control.stop())
+        for task in self._drain_tasks | self._dead_letter_tasks:
+            task.cancel()
+        self._close_dead_letter_writers()
+        if self._loop.is_running():
+            self._loop.create_task(self._rdy_control.stop())
+        else:
+            self._loop.run_until_complete(self._rdy_control.stop())
+
+    async def close(self, drain_timeout=None):
+        """Drain and close all connections.
+
+        Sends RDY 0 and CLS to every nsqd, then waits up to
+        ``drain_timeout`` seconds, drain timeout by default, for messages
+        in flight to be finished or re-queued by handlers still running.
+        Messages not handed to a handler by then are re-queued with REQ 0,
+        those still in a handler are abandoned, nsqd re-delivers them once
+        the connection is closed.
+
+        :return: ``dict`` with drain time in seconds, requeued and
+            abandoned message counts, also in ``stats['drain']``
+        """
+        started = self._loop.time()
+        self._stop_tasks()
+        # RDY stays 0 whatever resumes, nsqd is told with CLS as well
+        self._rdy_control.pause('close')
+        conns, self._connections = self._connections, {}
+        await asyncio.gather(*[
+            self._drain_conn(conn, drain_timeout, close=False)
+            for conn in conns.values()])
+        self._is_subscribe = False
+        # nodes which left the topic got as long to drain, their
+        # connections are closed by the cancelled drains
+        drains = list(self._drain_tasks)
+        for task in drains:
+            task.cancel()
+        await asyncio.gather(*drains, return_exceptions=True)
+        leftovers = []
+        if self._dispatcher is not None:
+            leftovers = self._dispatcher.take_pending()
+            if not self._consume_waiter.done():
+                self._consume_waiter.set_result(None)
+        while not self._queue.empty():
+            leftovers.append(self._queue.get_nowait())
+        requeued = 0
+        for msg in leftovers:
+            conn = msg.conn
+            if msg.processed or conn is None or conn.closed:
+                continue
+            msg.req(0, backoff=False)
+            requeued += 1
+        abandoned = sum(conn.in_flight for conn in conns.values()
+                        if not conn.closed)
+        for conn in conns.values():
+            conn.close()
+        for task in self._dead_letter_tasks:
+            task.cancel()
+        self._close_dead_letter_writers()
+        await self._close_lookupd()
+        await self._rdy_control.stop()
+        self._drain_stats = {
+            'time': self._loop.time() - started,
+            'requeued': requeued,
+            'abandoned': abandoned,
+        }
+        logger.info('Reader closed in %.3f sec, %d messages re-queued, '
+                    '%d abandoned', self._drain_stats['time'], requeued,
+                    abandoned)
+        return dict(self._drain_stats)
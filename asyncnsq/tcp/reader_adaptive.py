@@ -0,0 +1,146 @@
+"""Adaptive max in flight of a Reader.
+
+Every ``interval`` the time messages waited before a handler took them
+and the time handlers took are averaged. Over ``target_queue_wait`` or
+``target_latency`` the in flight budget is cut by ``decrease``, otherwise
+it grows by ``increase`` as long as the reader uses most of it and
+throughput did not drop since the last step (AIMD). The budget stays
+within ``min_in_flight`` and ``max_in_flight``.
+"""
+import logging
+
+logger = logging.getLogger(__package__)
+
+
+# seconds between adjustments
+INTERVAL = 1.0
+# budget added per step and share of it kept after a cut
+INCREASE = 5
+DECREASE = 0.5
+# share of the budget in flight at once for it to be the bottleneck
+SATURATION = 0.8
+# throughput drop still considered as not worse
+THROUGHPUT_TOLERANCE = 0.05
+
+
+class AdaptiveInFlight:
+    """
+    :param rdy_control: ``RdyControl`` whose max in flight is adjusted
+    :param in_flight: function returning messages in flight right now
+    :param target_queue_wait: seconds a message may wait for a handler
+    :param target_latency: seconds a handler may take, ``None`` to ignore
+    """
+
+    def __init__(self, rdy_control, in_flight, loop, min_in_flight=1,
+                 max_in_flight=2500, target_queue_wait=1.0,
+                 target_latency=None, interval=INTERVAL, increase=INCREASE,
+                 decrease=DECREASE):
+        if not 1 <= min_in_flight <= max_in_flight:
+            raise ValueError('min_in_flight must be between 1 and '
+                             'max_in_flight')
+        self._rdy_control = rdy_control
+        self._get_in_flight = in_flight
+        self._loop = loop
+        self._min = min_in_flight
+        self._max = max_in_flight
+        self._target_queue_wait = target_queue_wait
+        self._target_latency = target_latency
+        self._interval = interval
+        self._increase = increase
+        self._decrease = decrease
+        self._timer = None
+        self._last_rate = None
+        self._increases = 0
+        self._decreases = 0
+        # averages of the last interval, reported by stats
+        self._queue_wait = 0.0
+        self._latency = 0.0
+        self._rate = 0.0
+        self._reset()
+
+    def _reset(self):
+        self._started_at = self._loop.time()
+        self._peak = 0
+        self._done = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._latency_total = 0.0
+
+    def start(self):
+        if self._timer is None:
+            self._reset()
+            self._timer = self._loop.call_later(self._interval, self._adjust)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def message_received(self, msg):
+        msg._received_at = self._loop.time()
+        self._peak = max(self._peak, self._get_in_flight())
+
+    def message_started(self, msg):
+        """A handler took the message."""
+        if msg._received_at is not None and msg._started_at is None:
+            msg._started_at = self._loop.time()
+            self._waits += 1
+            self._wait_total += msg._started_at - msg._received_at
+
+    def message_done(self, msg):
+        """Message was finished or re-queued."""
+        if msg._received_at is None:
+            return
+        self._done += 1
+        started = msg._started_at
+        if started is None:
+            started = msg._received_at
+        self._latency_total += self._loop.time() - started
+
+    @property
+    def budget(self):
+        return self._rdy_control.max_in_flight
+
+    def _adjust(self):
+        self._timer = self._loop.call_later(self._interval, self._adjust)
+        elapsed = self._loop.time() - self._started_at
+        if not self._done and not self._get_in_flight():
+            # idle, nothing to learn from
+            self._reset()
+            return
+        self._queue_wait = self._wait_total / max(1, self._waits)
+        self._latency = self._latency_total / max(1, self._done)
+        self._rate = self._done / elapsed
+        budget = self.budget
+        if ((self._target_queue_wait is not None
+                and self._queue_wait > self._target_queue_wait)
+                or (self._target_latency is not None
+                    and self._latency > self._target_latency)):
+            budget = max(self._min, int(budget * self._decrease))
+            self._decreases += 1
+        elif (self._peak >= budget * SATURATION
+                and (self._last_rate is None or self._rate >=
+                     self._last_rate * (1 - THROUGHPUT_TOLERANCE))):
+            budget = min(self._max, budget + self._increase)
+            self._increases += 1
+        budget = min(self._max, max(self._min, budget))
+        if budget != self.budget:
+            logger.debug('max in flight %d -> %d, queue wait %.3f, '
+                         'latency %.3f', self.budget, budget,
+                         self._queue_wait, self._latency)
+            self._rdy_control.set_max_in_flight(budget)
+        self._last_rate = self._rate
+        self._reset()
+
+    @property
+    def stats(self):
+        """Budget and the averages of the last interval it is based on."""
+        return {
+            'budget': self.budget,
+            'queue_wait': self._queue_wait,
+            'latency': self._latency,
+            'rate': self._rate,
+            'in_flight': self._get_in_flight(),
+            'increases': self._increases,
+            'decreases': self._decreases,
+        }
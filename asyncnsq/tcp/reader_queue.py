@@ -0,0 +1,81 @@
+"""Message queue of a Reader bounded by count and body bytes.
+
+Messages nsqd sent can not be refused, so the queue never blocks nor
+raises on put. Once it holds ``max_count`` messages or ``max_bytes`` of
+bodies it calls ``on_full``, the reader holds RDY at 0, and ``on_drained``
+once both are down to ``low_water`` of the limits. The overshoot is at
+most the messages already in flight when RDY 0 was sent.
+"""
+import asyncio
+
+
+class MessageQueue(asyncio.Queue):
+    """
+    :param max_count: messages in the queue, ``None`` for no limit
+    :param max_bytes: bytes of message bodies, ``None`` for no limit
+    :param low_water: share of the limits to drain to before resuming
+    """
+
+    def __init__(self, max_count=None, max_bytes=None, low_water=0.5,
+                 on_full=None, on_drained=None):
+        super().__init__()
+        self._max_count = max_count
+        self._max_bytes = max_bytes
+        self._low_water = low_water
+        self._on_full = on_full
+        self._on_drained = on_drained
+        self._nbytes = 0
+        self._is_full = False
+        self._peak_count = 0
+        self._peak_bytes = 0
+        self._pauses = 0
+
+    @property
+    def nbytes(self):
+        """Bytes of message bodies in the queue."""
+        return self._nbytes
+
+    @property
+    def is_full(self):
+        """True from reaching a limit until drained to the low water."""
+        return self._is_full
+
+    def _put(self, msg):
+        super()._put(msg)
+        self._nbytes += len(msg.body)
+        count = len(self._queue)
+        self._peak_count = max(self._peak_count, count)
+        self._peak_bytes = max(self._peak_bytes, self._nbytes)
+        if self._is_full:
+            return
+        if ((self._max_count is not None and count >= self._max_count)
+                or (self._max_bytes is not None
+                    and self._nbytes >= self._max_bytes)):
+            self._is_full = True
+            self._pauses += 1
+            self._on_full is not None and self._on_full()
+
+    def _get(self):
+        msg = super()._get()
+        self._nbytes -= len(msg.body)
+        if not self._is_full:
+            return msg
+        if ((self._max_count is None
+                or len(self._queue) <= self._max_count * self._low_water)
+                and (self._max_bytes is None or
+                     self._nbytes <= self._max_bytes * self._low_water)):
+            self._is_full = False
+            self._on_drained is not None and self._on_drained()
+        return msg
+
+    @property
+    def stats(self):
+        return {
+            'depth': len(self._queue),
+            'bytes': self._nbytes,
+            'max_depth': self._peak_count,
+            'max_bytes': self._peak_bytes,
+            'full': self._is_full,
+            # times RDY was held because the queue filled up
+            'pauses': self._pauses,
+        }
@@ -1,105 +1,463 @@
+"""RDY count management of a Reader connected to several nsqd.
+
+RDY is sent to a connection once most of its previous count is used up,
+not after every message. Max in flight is split between connections in
+proportion to the rate they deliver messages at, every connection gets at
+least 1 and at most the ``max_rdy_count`` its nsqd reported in IDENTIFY.
+When there are more connections than max in flight, RDY 1 is rotated
+across connections, taken away from the idle ones first.
+
+Failed messages put the reader into backoff: RDY 0 on all connections for
+a growing interval, then RDY 1 on a single connection to test the waters.
+Every success shortens the interval, once it is back to zero max in
+flight is distributed again. Outcomes reported during the RDY 0 interval
+are not counted, these messages were received before it started.
+
+Consumers falling behind ``pause`` the reader: RDY 0 on all connections
+until every pause is lifted with ``resume``. ``set_cap`` limits total RDY
+below max in flight, for as long as needed.
+
+A rate limit is a token bucket shared by all connections: every message
+received takes a token, RDY is held at 0 while the bucket is empty and
+total RDY never exceeds the burst. Messages already on their way when
+the bucket runs dry are charged too, the bucket goes into debt and the
+average rate holds.
+"""
+import math
 import asyncio
-import random
-import time
+from collections import deque
 
 from .consts import RDY
 
-CHANGE_CONN_RDY = 0
-REDISTRIBUTE = 1
+
+# RDY is sent again once the remaining count drops to this share of it
+RDY_LOW_WATER = 0.25
+# weight of the latest sample in the per connection message rate average
+RATE_SMOOTHING = 0.3
+# rate samples taken more often than this (sec) are too noisy
+RATE_MIN_INTERVAL = 0.1
+# connections get at least this share of the average rate as weight, so
+# that a slow connection can still show it has more messages
+MIN_WEIGHT = 0.2
+# seconds of the first backoff interval, its growth per failure and limit
+BACKOFF_INTERVAL = 1.0
+BACKOFF_MULTIPLIER = 2.0
+MAX_BACKOFF = 128.0
+# share of the burst refilled before a rate limited reader resumes
+RATE_RESUME = 0.5
+
+
+class ConnectionRdy:
+    """RDY bookkeeping of a single connection."""
+
+    __slots__ = ('conn', 'rdy', 'remaining', 'rate', 'received',
+                 'sampled_at', 'rdy_at', 'last_message')
+
+    def __init__(self, conn, now):
+        self.conn = conn
+        # last RDY sent and how much of it is left
+        self.rdy = 0
+        self.remaining = 0
+        # moving average of messages per second
+        self.rate = None
+        self.received = 0
+        self.sampled_at = now
+        self.rdy_at = now
+        self.last_message = 0
+
+    def sample_rate(self, now):
+        elapsed = now - self.sampled_at
+        if elapsed < RATE_MIN_INTERVAL:
+            return
+        sample = self.received / elapsed
+        if self.rate is None:
+            self.rate = sample
+        else:
+            self.rate += RATE_SMOOTHING * (sample - self.rate)
+        self.received = 0
+        self.sampled_at = now
 
 
 class RdyControl:
+    """
+    :param idle_timeout: seconds without messages after which a connection
+        gives its RDY 1 away, when max in flight is lower than the number
+        of connections
+    :param max_in_flight: total RDY of all connections
+    :param low_water: share of the last RDY which triggers sending RDY
+    :param backoff_interval: seconds of RDY 0 after the first failure
+    :param backoff_multiplier: growth of the interval per failure
+    :param max_backoff: longest interval in seconds, ``0`` disables backoff
+    :param rate_limit: messages per second over all connections
+    :param burst: messages received at once after idling, one second
+        worth of ``rate_limit`` by default
+    """
 
-    def __init__(self, idle_timeout, max_in_flight, loop=None):
+    def __init__(self, idle_timeout, max_in_flight, loop=None,
+                 low_water=RDY_LOW_WATER, backoff_interval=BACKOFF_INTERVAL,
+                 backoff_multiplier=BACKOFF_MULTIPLIER,
+                 max_backoff=MAX_BACKOFF, rate_limit=None, burst=None):
         self._connections = {}
+        self._states = {}
         self._idle_timeout = idle_timeout
-        self._total_ready_count = 0
         self._max_in_flight = max_in_flight
+        self._low_water = low_water
         self._loop = loop or asyncio.get_event_loop()
+        self._clock = self._loop.time
+        # connection ids in the order they get RDY 1 when rotating
+        self._rotation = deque()
+        # connection ids having RDY 1 when rotating
+        self._holders = set()
+        self._messages = 0
+        self._rdy_commands = 0
+
+        self._backoff_interval = backoff_interval
+        self._backoff_multiplier = backoff_multiplier
+        self._max_backoff = max_backoff
+        # failures not yet compensated by successes
+        self._backoff_counter = 0
+        # timer of the RDY 0 interval, None when testing with RDY 1
+        self._backoff_timer = None
+        self._backoff_started = None
+        self._backoffs = 0
+        self._backoff_time = 0.0
+        # reasons RDY is held at 0 for, see pause()
+        self._pauses = set()
+        # limits of total RDY by reason, see set_cap()
+        self._caps = {}
+
+        self._rate_limit = None
+        self._burst = None
+        self._tokens = 0.0
+        self._tokens_at = self._clock()
+        self._rate_timer = None
+        self._throttles = 0
+        self.set_rate_limit(rate_limit, burst)
+
+    @property
+    def max_in_flight(self):
+        return self._max_in_flight
+
+    def set_max_in_flight(self, max_in_flight):
+        """Change max in flight and update RDY of all connections."""
+        self._max_in_flight = max_in_flight
+        self.redistribute()
+
+    @property
+    def rate_limit(self):
+        return self._rate_limit
+
+    def set_rate_limit(self, rate_limit, burst=None):
+        """Change messages per second and burst, ``None`` lifts the limit.
+        The bucket starts full."""
+        if self._rate_timer is not None:
+            self._rate_timer.cancel()
+            self._rate_timer = None
+        if rate_limit is None:
+            self._rate_limit = self._burst = None
+            self.resume('rate')
+            self.redistribute()
+            return
+        if rate_limit <= 0:
+            raise ValueError('rate_limit must be positive')
+        self._rate_limit = rate_limit
+        self._burst = max(1, int(burst or math.ceil(rate_limit)))
+        self._tokens = self._burst
+        self._tokens_at = self._clock()
+        self.resume('rate')
+        self.redistribute()
+
+    def set_cap(self, reason, count):
+        """Limit total RDY to ``count`` below max in flight, ``None``
+        lifts the cap. The lowest cap applies."""
+        if count is None:
+            if self._caps.pop(reason, None) is None:
+                return
+        elif self._caps.get(reason) == count:
+            return
+        else:
+            self._caps[reason] = count
+        self.redistribute()
 
-        self._cmd_queue = asyncio.PriorityQueue(loop=self._loop)
+    def _limit(self):
+        # total RDY, never more than the bucket can pay for
+        limit = self._max_in_flight
+        if self._burst is not None:
+            limit = min(limit, self._burst)
+        if self._caps:
+            limit = min(limit, min(self._caps.values()))
+        return limit
 
-        self._expected_rdy_state = {}
+    def _take_token(self):
+        now = self._clock()
+        self._tokens = min(self._burst, self._tokens + self._rate_limit * (
+            now - self._tokens_at)) - 1
+        self._tokens_at = now
+        if self._tokens >= 1 or self._rate_timer is not None:
+            return
+        self._throttles += 1
+        self.pause('rate')
+        resume_at = max(1, self._burst * RATE_RESUME)
+        self._rate_timer = self._loop.call_later(
+            (resume_at - self._tokens) / self._rate_limit, self._rate_resume)
 
-        self._is_working = True
+    def _rate_resume(self):
+        self._rate_timer = None
+        self.resume('rate')
 
-        self._distributor_task = self._loop.create_task(self._distributor())
+    @property
+    def in_backoff(self):
+        return self._backoff_counter > 0
+
+    @property
+    def backoff_interval(self):
+        """Length of the current RDY 0 interval, 0 when not in backoff."""
+        if not self._backoff_counter:
+            return 0
+        return min(self._max_backoff, self._backoff_interval *
+                   self._backoff_multiplier ** (self._backoff_counter - 1))
+
+    @property
+    def paused(self):
+        return bool(self._pauses)
+
+    def pause(self, reason):
+        """Send RDY 0 to all connections until ``resume(reason)``, pauses
+        with different reasons stack."""
+        if reason in self._pauses:
+            return
+        self._pauses.add(reason)
+        for state in self._states.values():
+            if state.rdy:
+                self._send_rdy(state, 0)
+
+    def resume(self, reason):
+        if reason not in self._pauses:
+            return
+        self._pauses.discard(reason)
+        if self._pauses:
+            return
+        if self._backoff_counter and self._backoff_timer is None:
+            # the RDY 1 test may have been skipped while paused
+            self._test_backoff()
+        else:
+            self.redistribute()
+
+    @property
+    def stats(self):
+        """Messages received, RDY commands sent and backoff state."""
+        backoff_time = self._backoff_time
+        if self._backoff_started is not None:
+            backoff_time += self._clock() - self._backoff_started
+        return {
+            'messages': self._messages,
+            'rdy_commands': self._rdy_commands,
+            'paused': sorted(self._pauses),
+            'caps': dict(self._caps),
+            'rate_limit': {
+                'rate': self._rate_limit,
+                'burst': self._burst,
+                'tokens': self._tokens if self._burst is not None else None,
+                # times the bucket ran dry
+                'throttles': self._throttles,
+            },
+            'backoff': {
+                'in_backoff': self.in_backoff,
+                'counter': self._backoff_counter,
+                'interval': self.backoff_interval,
+                'paused': self._backoff_timer is not None,
+                # number of times backoff was entered, seconds spent in it
+                'count': self._backoffs,
+                'time': backoff_time,
+            },
+            'rdy': {conn_id: state.rdy
+                    for conn_id, state in self._states.items()},
+            'rates': {conn_id: state.rate or 0.0
+                      for conn_id, state in self._states.items()},
+        }
 
     def add_connections(self, connections):
         self._connections = connections
-        for conn in self._connections.values():
-            conn._on_rdy_changed_cb = self.rdy_changed
+        for conn in connections.values():
+            if conn.id not in self._states:
+                self.add_connection(conn)
 
     def add_connection(self, connection):
-        connection._on_rdy_changed_cb = self.rdy_changed
         self._connections[connection.id] = connection
+        if connection.id not in self._states:
+            self._states[connection.id] = ConnectionRdy(
+                connection, self._clock())
+            self._rotation.append(connection.id)
+
+    def remove_connection(self, conn):
+        self._connections.pop(conn.id, None)
+        self._states.pop(conn.id, None)
+        self._holders.discard(conn.id)
+        if conn.id in self._rotation:
+            self._rotation.remove(conn.id)
+
+    def remove_all(self):
+        self._connections = {}
+        self._states.clear()
+        self._rotation.clear()
+        self._holders.clear()
+
+    def message_received(self, conn_id):
+        """Account a message, send RDY if the connection runs low."""
+        state = self._states.get(conn_id)
+        if state is None:
+            return
+        self._messages += 1
+        state.received += 1
+        state.remaining -= 1
+        state.last_message = self._clock()
+        if self._rate_limit is not None:
+            self._take_token()
+        if (state.remaining <= state.rdy * self._low_water
+                and not self._backoff_counter and not self._pauses):
+            state.sample_rate(state.last_message)
+            self._refill(state)
+
+    def message_processed(self, conn_id, success):
+        """Drive backoff by the outcome of a message: finished or
+        re-queued with backoff."""
+        if not self._max_backoff or self._backoff_timer is not None:
+            # messages received before the RDY 0 interval do not count
+            return
+        if success:
+            if not self._backoff_counter:
+                return
+            self._backoff_counter -= 1
+            if not self._backoff_counter:
+                self._finish_backoff()
+            else:
+                self._start_backoff()
+        else:
+            # the interval does not grow past max_backoff
+            if self.backoff_interval < self._max_backoff:
+                self._backoff_counter += 1
+            self._start_backoff()
+
+    def _start_backoff(self):
+        if self._backoff_started is None:
+            self._backoff_started = self._clock()
+            self._backoffs += 1
+        if self._backoff_timer is not None:
+            self._backoff_timer.cancel()
+        self._backoff_timer = self._loop.call_later(
+            self.backoff_interval, self._test_backoff)
+        for state in self._states.values():
+            if state.rdy:
+                self._send_rdy(state, 0)
+
+    def _test_backoff(self):
+        # RDY 1 on the next connection in turn, its outcome decides
+        self._backoff_timer = None
+        if not self._rotation or self._pauses:
+            return
+        conn_id = self._rotation[0]
+        self._rotation.rotate(-1)
+        self._send_rdy(self._states[conn_id], 1)
 
-    def rdy_changed(self, conn_id):
-        self._cmd_queue.put_nowait((CHANGE_CONN_RDY, (conn_id,)))
+    def _finish_backoff(self):
+        if self._backoff_timer is not None:
+            self._backoff_timer.cancel()
+            self._backoff_timer = None
+        if self._backoff_started is not None:
+            self._backoff_time += self._clock() - self._backoff_started
+            self._backoff_started = None
+        self.redistribute()
+
+    def is_starved(self):
+        """True if any connection used up most of its RDY."""
+        return any(
+            state.rdy and state.remaining <= state.rdy * self._low_water
+            for state in self._states.values())
 
     def redistribute(self):
-        self._cmd_queue.put_nowait((REDISTRIBUTE, ()))
+        """Recompute RDY of all connections from their rates, rotate RDY
+        away from idle connections. Called periodically."""
+        if self._backoff_counter or self._pauses:
+            return
+        now = self._clock()
+        for state in self._states.values():
+            state.sample_rate(now)
+        if self._limit() < len(self._states):
+            self._rotate(now)
+        else:
+            self._holders.clear()
+        targets = self._targets()
+        # lower counts first so that the total never exceeds max in flight
+        for state in sorted(self._states.values(),
+                            key=lambda s: targets[s.conn.id] - s.rdy):
+            target = targets[state.conn.id]
+            if target != state.rdy:
+                self._send_rdy(state, target)
 
-    async def _distributor(self):
-        while self._is_working:
-            cmd, args = await self._cmd_queue.get()
-            if cmd == REDISTRIBUTE:
-                await self._redistribute_rdy_state()
-            elif cmd == CHANGE_CONN_RDY:
-                await self._update_rdy(*args)
-            self._cmd_queue.task_done()
+    def _refill(self, state):
+        target = self._targets()[state.conn.id]
+        if not target and not state.rdy:
+            return
+        others = sum(s.rdy for s in self._states.values() if s is not state)
+        self._send_rdy(
+            state, max(0, min(target, self._limit() - others)))
 
-    def remove_connection(self, conn):
-        self._connections.pop(conn.id)
+    def _send_rdy(self, state, count):
+        if state.conn.closed:
+            # removed once reconnected
+            return
+        state.rdy = state.remaining = count
+        state.rdy_at = self._clock()
+        self._rdy_commands += 1
+        state.conn.execute(RDY, count)
 
-    def remove_all(self):
-        self._connections = {}
+    def _targets(self):
+        states = list(self._states.values())
+        if not states:
+            return {}
+        limit = self._limit()
+        if len(states) > limit:
+            return {s.conn.id: int(s.conn.id in self._holders)
+                    for s in states}
+        spare = limit - len(states)
+        rates = [s.rate or 0.0 for s in states]
+        floor = sum(rates) / len(states) * MIN_WEIGHT
+        weights = [max(rate, floor) for rate in rates]
+        total = sum(weights)
+        if total <= 0:
+            weights, total = [1] * len(states), len(states)
+        shares = [spare * w / total for w in weights]
+        counts = [int(share) for share in shares]
+        # largest remainders get what rounding down left over
+        left = spare - sum(counts)
+        by_remainder = sorted(range(len(states)),
+                              key=lambda i: counts[i] - shares[i])
+        for i in by_remainder[:left]:
+            counts[i] += 1
+        # nsqd refuses RDY over its max_rdy_count
+        return {s.conn.id: min(1 + count, s.conn.max_rdy_count)
+                for s, count in zip(states, counts)}
 
-    async def _redistribute_rdy_state(self):
-        # We redistribute RDY counts in a few cases:
-        #
-        # 1. our # of connections exceeds our configured max_in_flight
-        # 2. we're in backoff mode (but not in a current backoff block)
-        # 3. something out-of-band has set the need_rdy_redistributed flag
-        # (connection closed
-        # that was about to get RDY during backoff)
-        #
-        # At a high level, we're trying to mitigate stalls related to
-        # -volume
-        # producers when we're unable (by configuration or backoff) to provide
-        # a RDY count
-        # of (at least) 1 to all of our connections.
-
-        connections = self._connections.values()
-
-        rdy_coros = [
-            conn.execute(RDY, 0) for conn in connections
-            if not (
-                    conn.rdy_state == 0
-                    or time.time() - getattr(conn, '_last_message', 0)
-                    < self._idle_timeout
-            )
-        ]
-
-        distributed_rdy = sum(c.rdy_state for c in connections)
-        not_distributed_rdy = self._max_in_flight - distributed_rdy
-
-        random_connections = random.sample(list(connections),
-                                           min(not_distributed_rdy,
-                                               len(connections)))
-
-        rdy_coros += [conn.execute(RDY, 1) for conn in random_connections]
-
-        await asyncio.gather(*rdy_coros)
-
-    async def _update_rdy(self, conn_id):
-        conn = self._connections[conn_id]
-
-        rdy_state = max(1, self._max_in_flight /
-                        max(1, len(self._connections)))
-        await conn.execute(RDY, int(rdy_state))
+    def _rotate(self, now):
+        # idle holders give RDY 1 away and go to the end of the line
+        for conn_id in list(self._rotation):
+            state = self._states[conn_id]
+            last_active = max(state.last_message, state.rdy_at)
+            if (conn_id in self._holders
+                    and now - last_active >= self._idle_timeout):
+                self._holders.discard(conn_id)
+                self._rotation.remove(conn_id)
+                self._rotation.append(conn_id)
+        for conn_id in self._rotation:
+            if len(self._holders) >= self._limit():
+                break
+            self._holders.add(conn_id)
 
     async def stop(self):
-        self._is_working = False
-        self._distributor_task.cancel()
-        await self._distributor_task
+        if self._backoff_timer is not None:
+            self._backoff_timer.cancel()
+            self._backoff_timer = None
+        if self._rate_timer is not None:
+            self._rate_timer.cancel()
+            self._rate_timer = None
+        self.remove_all()
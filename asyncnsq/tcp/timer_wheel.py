@@ -0,0 +1,124 @@
+"""Hashed timer wheel for timers by the thousand.
+
+Timers are hashed by their expiry tick into a fixed number of slots, the
+wheel wakes up once per tick, only while it has timers, and fires the
+expired timers of the slots it passed. Scheduling and cancelling are
+O(1) and a single ``loop.call_later`` handle is pending however many
+timers there are. Timers fire at most one tick late, never early.
+"""
+import logging
+import math
+import weakref
+
+logger = logging.getLogger(__package__)
+
+
+# seconds per tick and number of slots of the shared wheels
+TICK = 0.1
+SLOTS = 512
+
+_wheels = weakref.WeakKeyDictionary()
+
+
+def get_timer_wheel(loop):
+    """The timer wheel shared by everything running on ``loop``."""
+    wheel = _wheels.get(loop)
+    if wheel is None:
+        _wheels[loop] = wheel = TimerWheel(loop)
+    return wheel
+
+
+class Timer:
+
+    __slots__ = ('tick', 'callback', 'args', '_wheel')
+
+    def __init__(self, tick, callback, args, wheel):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self._wheel = wheel
+
+    @property
+    def active(self):
+        """False once fired or cancelled."""
+        return self._wheel is not None
+
+    def cancel(self):
+        if self._wheel is not None:
+            self._wheel._remove(self)
+            self._wheel = None
+
+
+class TimerWheel:
+    """
+    :param tick: seconds per tick, the precision of the timers
+    :param slots: number of slots, timers further than ``tick * slots``
+        wait for as many turns of the wheel
+    """
+
+    def __init__(self, loop, tick=TICK, slots=SLOTS):
+        self._loop = loop
+        self._tick = tick
+        # dicts keep timers of a tick in the order they were scheduled
+        self._slots = [{} for _ in range(slots)]
+        self._start = loop.time()
+        # last tick processed
+        self._current = 0
+        self._handle = None
+        self._count = 0
+
+    def _now_tick(self):
+        # a wake up right at a tick boundary must not miss it by rounding
+        return int((self._loop.time() - self._start) / self._tick + 1e-9)
+
+    def call_later(self, delay, callback, *args):
+        """Call ``callback(*args)`` in ``delay`` seconds, returns ``Timer``."""
+        if not self._count:
+            # idle wheel did not turn, skip the ticks it slept through
+            self._current = max(self._current, self._now_tick())
+        tick = math.ceil(
+            (self._loop.time() + delay - self._start) / self._tick)
+        timer = Timer(max(tick, self._current + 1), callback, args, self)
+        self._slots[timer.tick % len(self._slots)][timer] = None
+        self._count += 1
+        if self._handle is None:
+            self._arm()
+        return timer
+
+    def _remove(self, timer):
+        self._slots[timer.tick % len(self._slots)].pop(timer, None)
+        self._count -= 1
+        if not self._count and self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _arm(self):
+        due = self._start + (self._current + 1) * self._tick
+        self._handle = self._loop.call_later(
+            max(0, due - self._loop.time()), self._run)
+
+    def _run(self):
+        self._handle = None
+        now_tick = self._now_tick()
+        first = max(self._current + 1, now_tick - len(self._slots) + 1)
+        expired = []
+        for tick in range(first, now_tick + 1):
+            slot = self._slots[tick % len(self._slots)]
+            fired = [timer for timer in slot if timer.tick <= now_tick]
+            for timer in fired:
+                del slot[timer]
+            expired.extend(fired)
+        self._current = max(self._current, now_tick)
+        self._count -= len(expired)
+        expired.sort(key=lambda timer: timer.tick)
+        for timer in expired:
+            timer._wheel = None
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception('Timer callback %r failed', timer.callback)
+        if self._count and self._handle is None:
+            self._arm()
+
+    def __len__(self):
+        return self._count
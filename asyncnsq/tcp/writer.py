@@ -1,19 +1,43 @@
 import asyncio
+from collections import deque
 import time
 import logging
 from . import consts
-from ..utils import retry_iterator
+from ..utils import (
+    retry_iterator, valid_topic_name, _convert_to_bytes, _convert_to_str)
 from .connection import create_connection
 from .consts import TOUCH, REQ, FIN, RDY, CLS, MPUB, PUB, SUB, AUTH, DPUB
+from .writer_batch import (
+    PubBatcher, check_message, split_mpub, MAX_MSG_SIZE, MAX_BODY_SIZE)
+from .writer_spool import Spool, SPOOLED, FSYNC_INTERVAL, OVERFLOW_ERROR
+from .exceptions import (
+    NSQException, NSQErrorCode, NSQBadTopic, NSQBadMessage, NSQBadBody)
 
 logger = logging.getLogger(__package__)
 
+# errors of an unavailable nsqd, messages are spooled if enabled
+SPOOL_ERRORS = (OSError, AssertionError)
+# nsqd refuses spooled messages for good, they are dropped on replay
+REJECT_ERRORS = (NSQBadTopic, NSQBadMessage, NSQBadBody)
+
+
+async def _aiter(iterable):
+    for item in iterable:
+        yield item
+
 
 async def create_writer(
         host='127.0.0.1', port=4150, loop=None, queue=None,
         heartbeat_interval=30000, feature_negotiation=True,
         tls_v1=False, snappy=False, deflate=False, deflate_level=6,
-        consumer=False, sample_rate=0, log_level=None):
+        consumer=False, sample_rate=0, log_level=None,
+        write_coalescing=False, batching=False, batch_size=100,
+        batch_bytes=64 * 1024, linger=0.005, max_msg_size=MAX_MSG_SIZE,
+        max_body_size=MAX_BODY_SIZE, window=100, write_high_water=None,
+        spool_dir=None, spool_max_bytes=1024 * 1024 * 1024,
+        spool_fsync=FSYNC_INTERVAL, spool_fsync_interval=1.0,
+        spool_overflow=OVERFLOW_ERROR,
+        command_timeout=consts.COMMAND_TIMEOUT):
     """"
     param: host: host addr with no protocol. 127.0.0.1 
     param: port: host port 
@@ -21,18 +45,51 @@ async def create_writer(
     param: heartbeat_interval: heartbeat interval with nsq, set -1 to disable nsq heartbeat check
     params: snappy: snappy compress
     params: deflate: deflate compress  can't set True both with snappy
+    params: write_coalescing: send commands issued in one loop iteration
+        with a single write
+    params: batching: buffer pub() per topic and send it as MPUB
+    params: batch_size: messages flushing a batch
+    params: batch_bytes: bytes of MPUB body flushing a batch
+    params: linger: seconds a batch waits for more messages
+    params: max_msg_size: nsqd --max-msg-size
+    params: max_body_size: nsqd --max-body-size, batches are never bigger
+    params: window: publishes in flight with pub_pipelined/publish_stream
+    params: write_high_water: socket buffer bytes pausing pipelined writes
+    params: spool_dir: directory of the disk spool taking publishes while
+        nsqd is unavailable or the window is full, see ``writer_spool``
+    params: spool_max_bytes: size limit of the spool
+    params: spool_fsync: ``always``, ``interval`` or ``never``
+    params: spool_fsync_interval: seconds spooled messages stay unsynced
+        with ``interval``
+    params: spool_overflow: ``error``, ``drop_new`` or ``drop_oldest``
+    params: command_timeout: seconds nsqd has to answer a publish before
+        the connection is considered broken and reconnected
     """
     # TODO: add parameters type and value validation
     loop = loop or asyncio.get_event_loop()
-    queue = queue or asyncio.Queue(loop=loop)
+    queue = queue or asyncio.Queue()
     writer = Writer(
         host=host, port=port, queue=queue,
         heartbeat_interval=heartbeat_interval,
         feature_negotiation=feature_negotiation,
         tls_v1=tls_v1, snappy=snappy, deflate=deflate,
         deflate_level=deflate_level, log_level=log_level,
-        sample_rate=sample_rate, consumer=consumer, loop=loop)
-    await writer.connect()
+        sample_rate=sample_rate, consumer=consumer, loop=loop,
+        write_coalescing=write_coalescing, batching=batching,
+        batch_size=batch_size, batch_bytes=batch_bytes, linger=linger,
+        max_msg_size=max_msg_size, max_body_size=max_body_size,
+        window=window, write_high_water=write_high_water,
+        spool_dir=spool_dir, spool_max_bytes=spool_max_bytes,
+        spool_fsync=spool_fsync, spool_fsync_interval=spool_fsync_interval,
+        spool_overflow=spool_overflow, command_timeout=command_timeout)
+    try:
+        await writer.connect()
+    except OSError as exc:
+        if spool_dir is None:
+            raise
+        # publishes are spooled until nsqd is reachable
+        logger.error('Can not connect to %s:%s: %r', host, port, exc)
+        writer._start_tasks()
     return writer
 
 
@@ -42,7 +99,14 @@ class Writer:
                  heartbeat_interval=30000, feature_negotiation=True,
                  tls_v1=False, snappy=False, deflate=False, deflate_level=6,
                  sample_rate=0, consumer=False, max_in_flight=42,
-                 log_level=None):
+                 log_level=None, write_coalescing=False, batching=False,
+                 batch_size=100, batch_bytes=64 * 1024, linger=0.005,
+                 max_msg_size=MAX_MSG_SIZE, max_body_size=MAX_BODY_SIZE,
+                 window=100, write_high_water=None, spool_dir=None,
+                 spool_max_bytes=1024 * 1024 * 1024,
+                 spool_fsync=FSYNC_INTERVAL, spool_fsync_interval=1.0,
+                 spool_overflow=OVERFLOW_ERROR,
+                 command_timeout=consts.COMMAND_TIMEOUT):
         # TODO: add parameters type and value validation
         self._config = {
             "deflate": deflate,
@@ -54,24 +118,166 @@ class Writer:
             'feature_negotiation': feature_negotiation,
         }
 
+        self._conn_config = {'write_coalescing': write_coalescing,
+                             'write_high_water': write_high_water,
+                             'command_timeout': command_timeout}
         self._host = host
         self._port = port
         self._conn = None
         self._loop = loop
-        self._queue = queue or asyncio.Queue(loop=self._loop)
+        self._queue = queue or asyncio.Queue()
         self._status = consts.INIT
         self._on_rdy_changed_cb = None
         self._reconnect_task = None
+        # publishes sent by pub_pipelined and not answered yet
+        self._window = asyncio.Semaphore(window)
+        self._batcher = None
+        if batching:
+            self._batcher = PubBatcher(
+                self._execute_or_spool, self._loop, max_count=batch_size,
+                max_bytes=batch_bytes, linger=linger,
+                max_msg_size=max_msg_size, max_body_size=max_body_size)
+        self._max_msg_size = max_msg_size
+        self._max_body_size = max_body_size
+        self._batch_size = batch_size
+        self._spool = None
+        if spool_dir is not None:
+            self._spool = Spool(spool_dir, max_bytes=spool_max_bytes,
+                                fsync=spool_fsync,
+                                fsync_interval=spool_fsync_interval,
+                                overflow=spool_overflow)
+        self._spool_fsync = spool_fsync
+        self._spool_fsync_interval = spool_fsync_interval
+        # syncs messages spooled after the last sync once a burst stops
+        self._spool_sync_timer = None
+        self._spool_event = asyncio.Event()
+        self._conn_closed = asyncio.Event()
+        self._replay_task = None
 
     async def connect(self):
         logger.debug("writer init connect")
         self._conn = await create_connection(self._host, self._port,
-                                             self._queue, loop=self._loop)
+                                             self._queue, loop=self._loop,
+                                             **self._conn_config)
 
         self._conn._on_message = self._on_message
+        self._conn._on_close = lambda conn: self._conn_closed.set()
         await self._conn.identify(**self._config)
         self._status = consts.CONNECTED
-        self._reconnect_task = self._loop.create_task(self.auto_reconnect())
+        self._spool_event.set()
+        self._start_tasks()
+
+    def _start_tasks(self):
+        if self._reconnect_task is None:
+            self._reconnect_task = self._loop.create_task(
+                self.auto_reconnect())
+        if self._spool is not None and self._replay_task is None:
+            self._replay_task = self._loop.create_task(self._replay_spool())
+
+    @property
+    def _connected(self):
+        return (self._status == consts.CONNECTED and self._conn is not None
+                and not self._conn.closed)
+
+    def _spooling(self):
+        """Publishes go to the spool, keeping the order of spooled ones."""
+        return self._spool is not None and (
+            len(self._spool) > 0 or not self._connected)
+
+    def _spool_messages(self, topic, messages):
+        # nsqd would refuse them on replay, the caller learns it now
+        if not valid_topic_name(_convert_to_str(topic)):
+            raise NSQBadTopic('invalid topic name: {}'.format(topic))
+        messages = [_convert_to_bytes(message) for message in messages]
+        for message in messages:
+            check_message(message, self._max_msg_size, self._max_body_size)
+        for message in messages:
+            self._spool.append(topic, message)
+        if (self._spool_fsync == FSYNC_INTERVAL
+                and self._spool_sync_timer is None):
+            self._spool_sync_timer = self._loop.call_later(
+                self._spool_fsync_interval, self._sync_spool)
+        self._spool_event.set()
+        return SPOOLED
+
+    def _sync_spool(self):
+        self._spool_sync_timer = None
+        self._spool.sync()
+
+    async def _execute_or_spool(self, command, topic, data):
+        """PUB or MPUB, spooled if nsqd is unavailable."""
+        messages = data if command == MPUB else [data]
+        if self._spooling():
+            return self._spool_messages(topic, messages)
+        try:
+            return await self.execute(command, topic, data=data)
+        except SPOOL_ERRORS as exc:
+            if self._spool is None:
+                raise
+            logger.warning('Spooling %d messages to %s: %r',
+                           len(messages), topic, exc)
+            return self._spool_messages(topic, messages)
+
+    def _spool_on_error(self, fut, topic, message):
+        """Future of a pipelined publish, spooled if it fails."""
+        result = self._loop.create_future()
+
+        def done(fut):
+            if result.done():
+                return
+            if fut.cancelled():
+                result.cancel()
+            elif isinstance(fut.exception(), SPOOL_ERRORS):
+                try:
+                    result.set_result(self._spool_messages(topic, [message]))
+                except Exception as exc:
+                    result.set_exception(exc)
+            elif fut.exception() is not None:
+                result.set_exception(fut.exception())
+            else:
+                result.set_result(fut.result())
+        fut.add_done_callback(done)
+        return result
+
+    async def _replay_spool(self):
+        """Publish spooled messages in MPUB batches once nsqd is up."""
+        delays = retry_iterator(init_delay=0.1, max_delay=10.0)
+        # one by one after a refused batch, to drop only the bad message
+        batch_size = self._batch_size
+        while True:
+            if not self._connected or not len(self._spool):
+                # set by connect() and by spooled publishes
+                self._spool_event.clear()
+                await self._spool_event.wait()
+                continue
+            # spool records are larger than MPUB ones, the batch fits
+            topic, messages = self._spool.peek(
+                max_count=batch_size, max_bytes=self._max_body_size)
+            if not messages:
+                logger.error('Dropping spooled message to %s over %d bytes',
+                             topic, self._max_body_size)
+                self._spool.reject(1)
+                continue
+            try:
+                await self._conn.execute(MPUB, topic, data=messages)
+            except SPOOL_ERRORS + (NSQErrorCode,) as exc:
+                if not isinstance(exc, REJECT_ERRORS):
+                    # nsqd is unavailable or failed to store them for now
+                    logger.error('Replay of %d spooled messages to %s '
+                                 'failed: %r', len(messages), topic, exc)
+                    await asyncio.sleep(next(delays))
+                    continue
+                if len(messages) > 1:
+                    batch_size = 1
+                    continue
+                # retrying would block the spool for good
+                logger.error('nsqd refused spooled message to %s, '
+                             'dropping it: %r', topic, exc)
+                self._spool.reject(1)
+                continue
+            self._spool.ack(len(messages))
+            batch_size = self._batch_size
+            delays = retry_iterator(init_delay=0.1, max_delay=10.0)
 
     def _on_message(self, msg):
         # should not be coroutine
@@ -105,23 +311,31 @@ class Writer:
         timeout_generator = retry_iterator(init_delay=0.1, max_delay=10.0)
         while True:
             logger.debug("autoreconnect check loop")
-            if not (self._status == consts.CONNECTED):
-                logger.debug(
-                    f"writer close({self._status}) detected, reconnect")
-                conn_id = self.id if self._conn else 'init'
-                logger.info('reconnect writer{}'.format(conn_id))
-                try:
-                    await self.reconnect()
-                except ConnectionError:
-                    logger.error("Can not connect to: {}:{} ".format(
-                        self._host, self._port))
-                else:
-                    self._status = consts.CONNECTED
+            if self._connected:
+                # woken up by the connection once it is closed
+                self._conn_closed.clear()
+                await self._conn_closed.wait()
+                continue
+            logger.debug(
+                f"writer close({self._status}) detected, reconnect")
+            conn_id = self.id if self._conn else 'init'
+            logger.info('reconnect writer{}'.format(conn_id))
+            try:
+                await self.reconnect()
+            except (OSError, asyncio.TimeoutError, NSQException) as exc:
+                logger.error("Can not connect to: {}:{} {!r}".format(
+                    self._host, self._port, exc))
+            else:
+                self._status = consts.CONNECTED
+                timeout_generator = retry_iterator(init_delay=0.1,
+                                                   max_delay=10.0)
+                continue
             t = next(timeout_generator)
-            await asyncio.sleep(t, loop=self._loop)
+            await asyncio.sleep(t)
 
     async def execute(self, command, *args, data=None):
-        if self._conn.closed:
+        # no connection yet if nsqd was down when the writer was created
+        if self._conn is None or self._conn.closed:
             logger.debug(
                 f"execute found conn closed, reconnect()")
             await self.reconnect()
@@ -152,9 +366,75 @@ class Writer:
 
         :param topic:
         :param message:
-        :return:
+        :return: nsqd response, ``SPOOLED`` if the message was spooled
+        """
+        if self._spool is not None and self._window.locked():
+            return self._spool_messages(topic, [message])
+        if self._batcher is not None:
+            return await self._batcher.pub(topic, message)
+        return await self._execute_or_spool(PUB, topic, message)
+
+    async def pub_pipelined(self, topic, message):
+        """Send PUB without waiting for the response.
+
+        Waits while ``window`` publishes are in flight or the socket buffer
+        is over its high-water mark, returns the future of the response.
+        With a spool the message is spooled instead of waiting for the
+        window and if nsqd is unavailable.
+        """
+        if self._spool is not None and (
+                self._window.locked() or self._spooling()):
+            fut = self._loop.create_future()
+            fut.set_result(self._spool_messages(topic, [message]))
+            return fut
+        await self._window.acquire()
+        try:
+            if self._batcher is not None:
+                fut = self._batcher.pub(topic, message)
+            else:
+                if self._conn is None or self._conn.closed:
+                    await self.reconnect()
+                await self._conn.drain()
+                fut = self._conn.execute(PUB, topic, data=message)
+        except BaseException:
+            self._window.release()
+            raise
+        fut.add_done_callback(lambda _: self._window.release())
+        if self._spool is not None and self._batcher is None:
+            fut = self._spool_on_error(fut, topic, message)
+        return fut
+
+    async def publish_stream(self, topic, messages):
+        """Publish an iterable or async iterable of messages pipelined.
+
+        :return: number of published messages, the first failed publish
+            raises its error
         """
-        return await self.execute(PUB, topic, data=message)
+        if not hasattr(messages, '__aiter__'):
+            messages = _aiter(messages)
+        pending = deque()
+        count = 0
+        try:
+            async for message in messages:
+                pending.append(await self.pub_pipelined(topic, message))
+                while pending and pending[0].done():
+                    pending.popleft().result()
+                    count += 1
+            for fut in pending:
+                await fut
+                count += 1
+        except BaseException:
+            # publishes after the failure are not waited for
+            for fut in pending:
+                fut.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            raise
+        return count
+
+    async def flush(self):
+        """Send messages buffered in batching mode and wait for them."""
+        if self._batcher is not None:
+            await self._batcher.flush()
 
     async def dpub(self, topic, delay_time, message):
         """
@@ -176,17 +456,41 @@ class Writer:
         :param messages:
         :return:
         """
-        msgs = list(messages)
-        return await self.execute(MPUB, topic, data=msgs)
+        resp = None
+        # several MPUB if the messages do not fit nsqd --max-body-size
+        for msgs in split_mpub(messages, self._max_body_size):
+            resp = await self._execute_or_spool(MPUB, topic, msgs)
+            if resp not in (b'OK', SPOOLED):
+                break
+        return resp
 
     @property
     def id(self):
         return self._conn.endpoint
 
     def close(self):
-        self._reconnect_task.cancel()
-        self._conn.close()
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        if self._batcher is not None:
+            self._batcher.close()
+        if self._replay_task is not None:
+            self._replay_task.cancel()
+            self._replay_task = None
+        if self._spool_sync_timer is not None:
+            self._spool_sync_timer.cancel()
+            self._spool_sync_timer = None
+        if self._spool is not None:
+            self._spool.close()
+        self._conn and self._conn.close()
         self._status = consts.CLOSED
 
+    @property
+    def stats(self):
+        return {
+            'batching': None if self._batcher is None else self._batcher.stats,
+            'spool': None if self._spool is None else self._spool.stats,
+        }
+
     def __repr__(self):
         return '<Writer{}>'.format(self._conn.__repr__())
@@ -0,0 +1,172 @@
+"""Coalescing ``pub()`` calls into ``MPUB``.
+
+Messages published to a topic are buffered and sent as a single ``MPUB``
+once the buffer holds ``max_count`` messages, ``max_bytes`` of bodies or
+after ``linger`` seconds, whichever comes first. Every message gets a
+future resolved with the response of its batch.
+"""
+import asyncio
+import logging
+
+from ..utils import _convert_to_bytes
+from .consts import MPUB
+from .exceptions import NSQBadMessage
+
+logger = logging.getLogger(__package__)
+
+
+# nsqd defaults of --max-msg-size and --max-body-size, nsqd does not
+# report them in IDENTIFY
+MAX_MSG_SIZE = 1024 * 1024
+MAX_BODY_SIZE = 5 * 1024 * 1024
+
+# MPUB body: message count, then size and body of every message
+_MPUB_HEADER = 4
+_MPUB_MSG_HEADER = 4
+
+
+def check_message(message, max_msg_size=MAX_MSG_SIZE,
+                  max_body_size=MAX_BODY_SIZE):
+    """Raise ``NSQBadMessage`` if nsqd would refuse the message."""
+    size = len(message)
+    if (size > max_msg_size or _MPUB_HEADER + _MPUB_MSG_HEADER + size
+            > max_body_size):
+        raise NSQBadMessage('message of {} bytes is too big'.format(size))
+
+
+def split_mpub(messages, max_body_size=MAX_BODY_SIZE):
+    """Split messages into lists each fitting a single ``MPUB`` body,
+    raises before anything is sent if a message can not fit."""
+    batches, batch, body_size = [], [], _MPUB_HEADER
+    for message in messages:
+        message = _convert_to_bytes(message)
+        size = _MPUB_MSG_HEADER + len(message)
+        if _MPUB_HEADER + size > max_body_size:
+            raise NSQBadMessage('message of {} bytes is too big'.format(
+                len(message)))
+        if batch and body_size + size > max_body_size:
+            batches.append(batch)
+            batch, body_size = [], _MPUB_HEADER
+        batch.append(message)
+        body_size += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class TopicBatch:
+    """Messages of a topic waiting for the next ``MPUB``."""
+
+    __slots__ = ('messages', 'futures', 'body_size', 'timer')
+
+    def __init__(self):
+        self.messages = []
+        self.futures = []
+        self.body_size = _MPUB_HEADER
+        self.timer = None
+
+    def append(self, message, future):
+        self.messages.append(message)
+        self.futures.append(future)
+        self.body_size += _MPUB_MSG_HEADER + len(message)
+
+
+class PubBatcher:
+    """
+    :param execute: coroutine function sending a command, ``Writer.execute``
+    :param max_count: messages in a batch
+    :param max_bytes: bytes of ``MPUB`` body flushing a batch
+    :param linger: seconds the first message of a batch waits for others
+    :param max_msg_size: nsqd ``--max-msg-size``
+    :param max_body_size: nsqd ``--max-body-size``
+    """
+
+    def __init__(self, execute, loop, max_count=100, max_bytes=64 * 1024,
+                 linger=0.005, max_msg_size=MAX_MSG_SIZE,
+                 max_body_size=MAX_BODY_SIZE):
+        self._execute = execute
+        self._loop = loop
+        self._max_count = max_count
+        self._max_bytes = min(max_bytes, max_body_size)
+        self._linger = linger
+        self._max_msg_size = max_msg_size
+        self._max_body_size = max_body_size
+        self._batches = {}
+        self._sending = set()
+        self._sent_batches = 0
+        self._sent_messages = 0
+
+    def pub(self, topic, message):
+        """Buffer a message, returns future of the batch response."""
+        message = _convert_to_bytes(message)
+        check_message(message, self._max_msg_size, self._max_body_size)
+        size = len(message)
+        batch = self._batches.get(topic)
+        if (batch is not None and batch.body_size + _MPUB_MSG_HEADER + size
+                > self._max_body_size):
+            self._flush(topic)
+            batch = None
+        if batch is None:
+            self._batches[topic] = batch = TopicBatch()
+            batch.timer = self._loop.call_later(
+                self._linger, self._flush, topic)
+        future = self._loop.create_future()
+        batch.append(message, future)
+        if (len(batch.messages) >= self._max_count
+                or batch.body_size >= self._max_bytes):
+            self._flush(topic)
+        return future
+
+    def _flush(self, topic):
+        batch = self._batches.pop(topic, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        # callers which gave up do not get their message published
+        pending = [(message, future) for message, future
+                   in zip(batch.messages, batch.futures)
+                   if not future.cancelled()]
+        if not pending:
+            return
+        messages, futures = zip(*pending)
+        task = self._loop.create_task(self._send(topic, messages, futures))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _send(self, topic, messages, futures):
+        try:
+            resp = await self._execute(MPUB, topic, data=list(messages))
+        except Exception as exc:
+            logger.error('MPUB of %d messages to %s failed: %r',
+                         len(messages), topic, exc)
+            for future in futures:
+                future.done() or future.set_exception(exc)
+            return
+        self._sent_batches += 1
+        self._sent_messages += len(messages)
+        for future in futures:
+            future.done() or future.set_result(resp)
+
+    async def flush(self):
+        """Send every buffered message and wait for the responses."""
+        for topic in list(self._batches):
+            self._flush(topic)
+        if self._sending:
+            await asyncio.wait(list(self._sending))
+
+    def close(self):
+        batches, self._batches = self._batches, {}
+        for batch in batches.values():
+            batch.timer.cancel()
+            for future in batch.futures:
+                future.done() or future.set_exception(
+                    ConnectionError('Writer is closed'))
+
+    @property
+    def stats(self):
+        return {
+            'batches': self._sent_batches,
+            'messages': self._sent_messages,
+            'buffered': sum(len(b.messages) for b in self._batches.values()),
+            'sending': len(self._sending),
+        }
@@ -0,0 +1,314 @@
+"""Publishing over several nsqd nodes.
+
+Every node has its own ``Writer``. A publish goes to the node picked by
+the strategy and fails over to the other nodes when the node is down.
+Nodes failing repeatedly are ejected by a circuit breaker, after a while
+a single publish probes whether they are back.
+"""
+import asyncio
+import itertools
+import logging
+import random
+
+from asyncnsq.http import NsqLookupd
+from .consts import PUB, DPUB, MPUB
+from .exceptions import (
+    NSQNoConnections, NSQErrorCode, NSQPubFailed, NSQMPubFailed,
+    NSQPutFailed)
+from .writer import Writer
+from .writer_batch import split_mpub, MAX_BODY_SIZE
+
+logger = logging.getLogger(__package__)
+
+
+ROUND_ROBIN = 'round_robin'
+LEAST_OUTSTANDING = 'least_outstanding'
+EWMA = 'ewma'
+
+# circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# errors of a node, the publish is retried on another one
+FAILOVER_ERRORS = (ConnectionError, OSError, AssertionError,
+                   asyncio.TimeoutError, NSQPubFailed, NSQMPubFailed,
+                   NSQPutFailed)
+
+# weight of the latest publish in the latency average
+LATENCY_SMOOTHING = 0.3
+
+
+async def create_writer_pool(nsqd_tcp_addresses=None,
+                             lookupd_http_addresses=None,
+                             strategy=ROUND_ROBIN, loop=None, **kwargs):
+    """"
+    initial function to get a pool of writers
+    param: nsqd_tcp_addresses: tcp addrs with no protocol.
+        such as ['127.0.0.1:4150','182.168.1.1:4150']
+    param: lookupd_http_addresses: (host, port) of lookupd to discover
+        nsqd with ``/nodes``
+    param: strategy: ``round_robin``, ``least_outstanding`` or ``ewma``
+    other parameters are passed to ``WriterPool``
+    """
+    loop = loop or asyncio.get_event_loop()
+    if nsqd_tcp_addresses:
+        nsqd_tcp_addresses = [i.split(':') if isinstance(i, str) else i
+                              for i in nsqd_tcp_addresses]
+    pool = WriterPool(nsqd_tcp_addresses=nsqd_tcp_addresses,
+                      lookupd_http_addresses=lookupd_http_addresses,
+                      strategy=strategy, loop=loop, **kwargs)
+    await pool.connect()
+    return pool
+
+
+class PoolNode:
+    """Writer of a single nsqd with its load and health."""
+
+    def __init__(self, writer, endpoint):
+        self.writer = writer
+        self.endpoint = endpoint
+        self.outstanding = 0
+        # publish latency moving average, seconds
+        self.latency = None
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.published = 0
+        self.errors = 0
+
+    def available(self, now, reset_timeout):
+        if self.state == CLOSED:
+            return True
+        # a single probe at a time once the circuit is half open
+        return (self.state == OPEN
+                and now - self.opened_at >= reset_timeout)
+
+    def succeeded(self, latency):
+        self.published += 1
+        self.failures = 0
+        self.state = CLOSED
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+
+    def failed(self, now, failure_threshold):
+        self.errors += 1
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= failure_threshold:
+            self.state = OPEN
+            self.opened_at = now
+
+    async def execute(self, command, *args, data=None):
+        if self.writer._conn is None:
+            await self.writer.connect()
+        return await self.writer.execute(command, *args, data=data)
+
+    @property
+    def stats(self):
+        return {'state': self.state, 'outstanding': self.outstanding,
+                'latency': self.latency, 'published': self.published,
+                'errors': self.errors}
+
+
+class WriterPool:
+    """
+    :param strategy: ``round_robin``, ``least_outstanding`` or ``ewma``
+        (lowest latency average weighted by outstanding publishes)
+    :param failure_threshold: consecutive failures ejecting a node
+    :param reset_timeout: seconds before an ejected node is probed
+    :param publish_timeout: seconds a node has to respond to a publish
+    :param lookupd_poll_interval: seconds between ``/nodes`` queries
+    other parameters are passed to every ``Writer``
+    """
+
+    def __init__(self, nsqd_tcp_addresses=None, lookupd_http_addresses=None,
+                 strategy=ROUND_ROBIN, loop=None, failure_threshold=3,
+                 reset_timeout=5.0, publish_timeout=5.0,
+                 lookupd_poll_interval=30, **writer_config):
+        if strategy not in (ROUND_ROBIN, LEAST_OUTSTANDING, EWMA):
+            raise ValueError('Unknown strategy: {}'.format(strategy))
+        self._nsqd_tcp_addresses = nsqd_tcp_addresses or []
+        self._lookupd_http_addresses = lookupd_http_addresses or []
+        self._strategy = strategy
+        self._loop = loop or asyncio.get_event_loop()
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._publish_timeout = publish_timeout
+        self._lookupd_poll_interval = lookupd_poll_interval
+        self._writer_config = writer_config
+        self._nodes = {}
+        self._counter = itertools.count()
+        self._lookupd_conns = {}
+        self._lookupd_task = None
+
+    async def connect(self):
+        addresses = list(self._nsqd_tcp_addresses)
+        if self._lookupd_http_addresses:
+            addresses += await self._lookup_nodes() or []
+            self._lookupd_task = self._loop.create_task(self._poll_lookupd())
+        await self._add_nodes(addresses)
+        if not self._nodes:
+            raise NSQNoConnections('No nsqd to publish to')
+
+    async def _add_nodes(self, addresses):
+        new = []
+        for host, port in addresses:
+            endpoint = 'tcp://{}:{}'.format(host, port)
+            if endpoint not in self._nodes:
+                writer = Writer(host=host, port=port, loop=self._loop,
+                                **self._writer_config)
+                self._nodes[endpoint] = node = PoolNode(writer, endpoint)
+                new.append(node)
+        results = await asyncio.gather(
+            *[asyncio.wait_for(node.writer.connect(), self._publish_timeout)
+              for node in new], return_exceptions=True)
+        now = self._loop.time()
+        for node, result in zip(new, results):
+            if isinstance(result, Exception):
+                logger.error('Can not connect to %s: %r',
+                             node.endpoint, result)
+                # probed later like any ejected node
+                node.state, node.opened_at = OPEN, now
+
+    def _remove_node(self, endpoint):
+        node = self._nodes.pop(endpoint)
+        if node.writer._conn is not None:
+            node.writer.close()
+
+    async def _query_lookupd(self, address):
+        conn = self._lookupd_conns.get(address)
+        if conn is None:
+            conn = NsqLookupd(*address, loop=self._loop)
+            self._lookupd_conns[address] = conn
+        res = await asyncio.wait_for(conn.nodes(), self._publish_timeout)
+        res = res.get('data', res)
+        return {(p['broadcast_address'], p['tcp_port'])
+                for p in res['producers']}
+
+    async def _lookup_nodes(self):
+        """Nodes known to any lookupd, ``None`` if none responded."""
+        addresses = [tuple(address)
+                     for address in self._lookupd_http_addresses]
+        results = await asyncio.gather(
+            *[self._query_lookupd(address) for address in addresses],
+            return_exceptions=True)
+        nodes = None
+        for address, result in zip(addresses, results):
+            if isinstance(result, Exception):
+                logger.error('lookupd %s:%s query failed: %r',
+                             *address, result)
+            else:
+                nodes = (nodes or set()) | result
+        return sorted(nodes) if nodes is not None else None
+
+    async def _poll_lookupd(self):
+        static = {'tcp://{}:{}'.format(host, port)
+                  for host, port in self._nsqd_tcp_addresses}
+        while True:
+            jitter = random.uniform(-0.3, 0.3)
+            await asyncio.sleep(self._lookupd_poll_interval * (1 + jitter))
+            nodes = await self._lookup_nodes()
+            if nodes is None:
+                continue
+            endpoints = {'tcp://{}:{}'.format(*node) for node in nodes}
+            for endpoint in list(self._nodes):
+                if endpoint not in endpoints and endpoint not in static:
+                    logger.info('nsqd %s left cluster', endpoint)
+                    self._remove_node(endpoint)
+            await self._add_nodes(nodes)
+
+    def _pick(self, exclude):
+        now = self._loop.time()
+        nodes = [node for node in self._nodes.values()
+                 if node not in exclude
+                 and node.available(now, self._reset_timeout)]
+        if not nodes:
+            return None
+        # rotating start breaks ties evenly
+        start = next(self._counter) % len(nodes)
+        nodes = nodes[start:] + nodes[:start]
+        if self._strategy == LEAST_OUTSTANDING:
+            node = min(nodes, key=lambda n: n.outstanding)
+        elif self._strategy == EWMA:
+            # nodes without latency yet go first
+            node = min(nodes, key=lambda n: (n.latency or 0) *
+                       (n.outstanding + 1))
+        else:
+            node = nodes[0]
+        if node.state == OPEN:
+            node.state = HALF_OPEN
+        return node
+
+    async def execute(self, command, *args, data=None):
+        """Execute command on a node, failing over to the other nodes."""
+        tried = set()
+        error = None
+        while True:
+            node = self._pick(tried)
+            if node is None:
+                break
+            tried.add(node)
+            node.outstanding += 1
+            start = self._loop.time()
+            try:
+                result = await asyncio.wait_for(
+                    node.execute(command, *args, data=data),
+                    self._publish_timeout)
+            except FAILOVER_ERRORS as exc:
+                logger.warning('Publish to %s failed: %r', node.endpoint, exc)
+                node.failed(self._loop.time(), self._failure_threshold)
+                error = exc
+                continue
+            except NSQErrorCode:
+                if node.state == HALF_OPEN:
+                    # the node answered, only the publish was refused
+                    node.state, node.failures = CLOSED, 0
+                raise
+            except BaseException:
+                if node.state == HALF_OPEN:
+                    # probe did not tell anything, probe again later
+                    node.state, node.opened_at = OPEN, self._loop.time()
+                raise
+            finally:
+                node.outstanding -= 1
+            node.succeeded(self._loop.time() - start)
+            return result
+        raise NSQNoConnections('No nsqd available') from error
+
+    async def pub(self, topic, message):
+        return await self.execute(PUB, topic, data=message)
+
+    async def dpub(self, topic, delay_time, message):
+        """
+        :param delay_time: delayed time in millisecond
+        """
+        return await self.execute(DPUB, topic, delay_time or 0, data=message)
+
+    async def mpub(self, topic, *messages):
+        max_body_size = self._writer_config.get('max_body_size',
+                                                MAX_BODY_SIZE)
+        resp = None
+        for msgs in split_mpub(messages, max_body_size):
+            resp = await self.execute(MPUB, topic, data=msgs)
+            if resp != b'OK':
+                break
+        return resp
+
+    @property
+    def stats(self):
+        return {endpoint: node.stats for endpoint, node in self._nodes.items()}
+
+    async def close(self):
+        if self._lookupd_task is not None:
+            self._lookupd_task.cancel()
+        for endpoint in list(self._nodes):
+            self._remove_node(endpoint)
+        conns, self._lookupd_conns = self._lookupd_conns, {}
+        for conn in conns.values():
+            await conn.close()
+
+    def __repr__(self):
+        return '<WriterPool {} {}>'.format(self._strategy,
+                                           list(self._nodes))
@@ -0,0 +1,353 @@
+"""Disk spool of messages the writer could not publish.
+
+Messages are appended to a log of fixed size segment files mapped into
+memory with ``mmap``. Every record is::
+
+    magic (1) | topic size (2) | body size (4) | crc32 (4) | topic | body
+
+A zero or corrupted header marks the end of the data in a segment, so a
+torn write at a crash only loses the record being written. The position
+of the first message not published yet is kept in the ``cursor`` file,
+segments behind it are deleted.
+
+``fsync`` is one of ``always`` (sync every append), ``interval`` (sync
+at most every ``fsync_interval`` seconds, on append and ``sync()``) or
+``never`` (leave it to the OS). With ``interval`` the writer calls
+``sync()`` once ``fsync_interval`` passed after spooling, so records
+appended at the end of a burst do not stay unsynced.
+
+``overflow`` decides what happens to a message not fitting ``max_bytes``:
+``error`` raises ``NSQSpoolFull``, ``drop_new`` discards it and
+``drop_oldest`` discards the oldest messages to make room.
+
+Messages nsqd refuses to take are dropped with ``reject`` and counted
+in ``rejected``, they would block the spool forever otherwise.
+"""
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from ..utils import _convert_to_bytes
+from .exceptions import NSQSpoolFull
+
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+
+OVERFLOW_ERROR = 'error'
+OVERFLOW_DROP_NEW = 'drop_new'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+
+# returned instead of nsqd response for spooled messages
+SPOOLED = b'SPOOLED'
+
+_MAGIC = 0xa5
+_HEADER = struct.Struct('>BHII')
+_CURSOR = struct.Struct('>QQ')
+_SEGMENT_NAME = '{:016d}.seg'
+_CURSOR_NAME = 'cursor'
+
+
+class Segment:
+    """A segment file mapped into memory."""
+
+    def __init__(self, path, seq, size):
+        self.seq = seq
+        self.path = os.path.join(path, _SEGMENT_NAME.format(seq))
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.size = os.fstat(fd).st_size
+            self.mm = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        self.end = self._scan_end()
+
+    def skip(self, pos):
+        """Position of the record following the one at ``pos``."""
+        _, topic_size, body_size, _ = _HEADER.unpack_from(self.mm, pos)
+        return pos + _HEADER.size + topic_size + body_size
+
+    def read(self, pos):
+        """Record at ``pos``: ``(topic, body, next_pos)`` or ``None``."""
+        if pos + _HEADER.size > self.size:
+            return None
+        magic, topic_size, body_size, crc = _HEADER.unpack_from(self.mm, pos)
+        start = pos + _HEADER.size
+        stop = start + topic_size + body_size
+        if magic != _MAGIC or stop > self.size:
+            return None
+        data = self.mm[start:stop]
+        if zlib.crc32(data) != crc:
+            return None
+        return data[:topic_size], data[topic_size:], stop
+
+    def append(self, topic, body):
+        record_size = _HEADER.size + len(topic) + len(body)
+        if self.end + record_size > self.size:
+            return False
+        pos = self.end + _HEADER.size
+        self.mm[pos:pos + len(topic)] = topic
+        self.mm[pos + len(topic):pos + len(topic) + len(body)] = body
+        # header last, a crash in between leaves no valid record behind
+        _HEADER.pack_into(self.mm, self.end, _MAGIC, len(topic), len(body),
+                          zlib.crc32(topic + body))
+        self.end += record_size
+        return True
+
+    def _scan_end(self):
+        pos = 0
+        while True:
+            record = self.read(pos)
+            if record is None:
+                break
+            pos = record[2]
+        # a torn record is overwritten by the next append
+        return pos
+
+    def sync(self):
+        self.mm.flush()
+
+    def close(self):
+        self.mm.close()
+
+    def remove(self):
+        self.mm.close()
+        os.unlink(self.path)
+
+
+class Spool:
+    """
+    :param path: directory of the segment files, created if missing
+    :param segment_size: bytes of a segment file
+    :param max_bytes: bytes of spooled records
+    :param fsync: ``always``, ``interval`` or ``never``
+    :param fsync_interval: seconds between syncs with ``interval``
+    :param overflow: ``error``, ``drop_new`` or ``drop_oldest``
+    """
+
+    def __init__(self, path, segment_size=16 * 1024 * 1024,
+                 max_bytes=1024 * 1024 * 1024, fsync=FSYNC_INTERVAL,
+                 fsync_interval=1.0, overflow=OVERFLOW_ERROR):
+        if fsync not in (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER):
+            raise ValueError('Unknown fsync policy: {}'.format(fsync))
+        if overflow not in (OVERFLOW_ERROR, OVERFLOW_DROP_NEW,
+                            OVERFLOW_DROP_OLDEST):
+            raise ValueError('Unknown overflow policy: {}'.format(overflow))
+        self._path = path
+        self._segment_size = segment_size
+        self._max_bytes = max_bytes
+        self._fsync = fsync
+        self._fsync_interval = fsync_interval
+        self._overflow = overflow
+        self._last_sync = time.monotonic()
+        self._dirty = False
+
+        self._appended = self._replayed = self._dropped = 0
+        self._rejected = 0
+        self._replay_started = None
+        self._replayed_since = 0
+        self._replay_rate = 0.0
+
+        os.makedirs(path, exist_ok=True)
+        seqs = sorted(int(name[:-4]) for name in os.listdir(path)
+                      if name.endswith('.seg'))
+        self._read_seq, self._read_pos = self._load_cursor()
+        self._segments = []
+        for seq in seqs:
+            if seq < self._read_seq:
+                os.unlink(os.path.join(path, _SEGMENT_NAME.format(seq)))
+            else:
+                self._segments.append(Segment(path, seq, segment_size))
+        if not self._segments:
+            self._segments.append(
+                Segment(path, max(self._read_seq, 1), segment_size))
+        if self._segments[0].seq != self._read_seq:
+            self._read_seq, self._read_pos = self._segments[0].seq, 0
+        # messages and bytes not replayed yet
+        self._count = self._bytes = 0
+        for _, _, size in self._records():
+            self._count += 1
+            self._bytes += size
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self._path, _CURSOR_NAME), 'rb') as f:
+                return _CURSOR.unpack(f.read(_CURSOR.size))
+        except (OSError, struct.error):
+            return 0, 0
+
+    def _save_cursor(self):
+        path = os.path.join(self._path, _CURSOR_NAME)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(_CURSOR.pack(self._read_seq, self._read_pos))
+            if self._fsync == FSYNC_ALWAYS:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def _records(self):
+        """Spooled records from the cursor on: ``(topic, body, size)``."""
+        seq, pos = self._read_seq, self._read_pos
+        for segment in self._segments:
+            if segment.seq < seq:
+                continue
+            if segment.seq > seq:
+                pos = 0
+            while pos < segment.end:
+                topic, body, next_pos = segment.read(pos)
+                yield topic, body, next_pos - pos
+                pos = next_pos
+
+    def append(self, topic, message):
+        """Spool a message.
+
+        :return: ``False`` if the message was dropped by ``drop_new``
+        """
+        topic = _convert_to_bytes(topic)
+        message = _convert_to_bytes(message)
+        size = _HEADER.size + len(topic) + len(message)
+        if size > self._segment_size:
+            raise ValueError('message of {} bytes does not fit a spool '
+                             'segment'.format(len(message)))
+        if self._bytes + size > self._max_bytes:
+            if self._overflow == OVERFLOW_ERROR:
+                raise NSQSpoolFull('spool of {} bytes is full'.format(
+                    self._bytes))
+            if self._overflow == OVERFLOW_DROP_NEW:
+                self._dropped += 1
+                return False
+            self._drop_oldest(self._bytes + size - self._max_bytes)
+        segment = self._segments[-1]
+        if not segment.append(topic, message):
+            segment.sync()
+            segment = Segment(self._path, segment.seq + 1,
+                              self._segment_size)
+            self._segments.append(segment)
+            segment.append(topic, message)
+        self._appended += 1
+        self._count += 1
+        self._bytes += size
+        self._dirty = True
+        if self._fsync == FSYNC_ALWAYS:
+            self.sync()
+        elif self._fsync == FSYNC_INTERVAL:
+            self.sync(self._fsync_interval)
+        return True
+
+    def _drop_oldest(self, nbytes):
+        dropped = 0
+        for _, _, size in self._records():
+            if nbytes <= 0:
+                break
+            nbytes -= size
+            dropped += 1
+        self._advance(dropped)
+        self._dropped += dropped
+
+    def peek(self, max_count=100, max_bytes=1024 * 1024):
+        """Oldest messages of a single topic for one ``MPUB``.
+
+        :return: ``(topic, messages)``, ``None`` if the spool is empty,
+            ``messages`` is empty if the oldest record alone is over
+            ``max_bytes``
+        """
+        topic, messages, nbytes = None, [], 0
+        for record_topic, body, size in self._records():
+            if topic is None:
+                topic = record_topic
+            elif record_topic != topic or len(messages) >= max_count:
+                break
+            if nbytes + size > max_bytes:
+                break
+            messages.append(body)
+            nbytes += size
+        if topic is None:
+            return None
+        return topic.decode('utf-8'), messages
+
+    def ack(self, count):
+        """Mark ``count`` oldest messages as published."""
+        # rate of the current replay, from its first ack on
+        if self._replay_started is None:
+            self._replay_started = time.monotonic()
+            self._replayed_since = 0
+        self._advance(count)
+        self._replayed += count
+        self._replayed_since += count
+        elapsed = time.monotonic() - self._replay_started
+        if elapsed > 0:
+            self._replay_rate = self._replayed_since / elapsed
+        if not self._count:
+            self._replay_started = None
+
+    def reject(self, count):
+        """Drop ``count`` oldest messages nsqd refused."""
+        self._advance(count)
+        self._rejected += count
+
+    def _advance(self, count):
+        seq, pos = self._read_seq, self._read_pos
+        for segment in self._segments:
+            if segment.seq < seq:
+                continue
+            if segment.seq > seq:
+                seq, pos = segment.seq, 0
+            while count and pos < segment.end:
+                next_pos = segment.skip(pos)
+                self._count -= 1
+                self._bytes -= next_pos - pos
+                count -= 1
+                pos = next_pos
+            if not count:
+                break
+        # segments fully replayed, the one written to is kept
+        while len(self._segments) > 1 and (
+                self._segments[0].seq < seq or pos >= self._segments[0].end):
+            self._segments.pop(0).remove()
+            if self._segments[0].seq > seq:
+                seq, pos = self._segments[0].seq, 0
+        self._read_seq, self._read_pos = seq, pos
+        self._save_cursor()
+
+    def sync(self, interval=0):
+        """Flush appended records to disk, at most every ``interval``."""
+        now = time.monotonic()
+        if not self._dirty or now - self._last_sync < interval:
+            return
+        self._segments[-1].sync()
+        self._last_sync = now
+        self._dirty = False
+
+    def close(self):
+        if self._fsync != FSYNC_NEVER:
+            self.sync()
+        for segment in self._segments:
+            segment.close()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    @property
+    def stats(self):
+        return {
+            'depth': self._count,
+            'bytes': self._bytes,
+            'segments': len(self._segments),
+            'appended': self._appended,
+            'replayed': self._replayed,
+            'dropped': self._dropped,
+            'rejected': self._rejected,
+            'replay_rate': self._replay_rate,
+        }
+
+    def __repr__(self):
+        return '<Spool {} depth={}>'.format(self._path, self._count)
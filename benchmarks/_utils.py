@@ -0,0 +1,43 @@
+import asyncio
+import multiprocessing
+
+from tests._fakensqd import FakeNsqd
+
+
+def _serve(port_queue, topics, options):
+    async def go():
+        nsqd = await FakeNsqd(**options).start()
+        for topic, count, body in topics:
+            nsqd.put(topic, *[body] * count)
+        port_queue.put(nsqd.port)
+        await asyncio.Event().wait()
+
+    asyncio.run(go())
+
+
+class FakeNsqdProcess:
+    """Fake nsqd in a separate process so it does not compete with the
+    measured client for the event loop.
+
+    ``topics`` is a list of ``(topic, count, body)`` to pre-fill.
+    """
+
+    def __init__(self, topics=(), **options):
+        self._port_queue = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=_serve, args=(self._port_queue, list(topics), options),
+            daemon=True)
+        self.host, self.port = '127.0.0.1', None
+
+    @property
+    def address(self):
+        return '{}:{}'.format(self.host, self.port)
+
+    def __enter__(self):
+        self._process.start()
+        self.port = self._port_queue.get(timeout=30)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._process.terminate()
+        self._process.join()
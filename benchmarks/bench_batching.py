@@ -0,0 +1,58 @@
+"""Publishes per second from many coroutines calling ``Writer.pub()``,
+one PUB round trip per message compared with the batching mode sending
+one MPUB per batch, against a fake nsqd in a separate process.
+
+Usage: python -m benchmarks.bench_batching
+"""
+import asyncio
+import time
+
+from asyncnsq.tcp.writer import create_writer
+from ._utils import FakeNsqdProcess
+
+
+PUBLISHERS = 200
+MESSAGES = 50
+BODY = b'x' * 200
+
+
+async def publisher(writer, count):
+    for _ in range(count):
+        await writer.pub('bench', BODY)
+
+
+async def publish(nsqd, **kwargs):
+    writer = await create_writer(host=nsqd.host, port=nsqd.port,
+                                 loop=asyncio.get_running_loop(), **kwargs)
+    started = time.perf_counter()
+    await asyncio.gather(*[publisher(writer, MESSAGES)
+                           for _ in range(PUBLISHERS)])
+    elapsed = time.perf_counter() - started
+    stats = writer.stats['batching']
+    writer.close()
+    return elapsed, stats['batches'] if stats else PUBLISHERS * MESSAGES
+
+
+async def go(nsqd):
+    total = PUBLISHERS * MESSAGES
+    print('{} publishers, {} messages of {} bytes'.format(
+        PUBLISHERS, total, len(BODY)))
+    print('    {:<28} {:>12} {:>10}'.format('', 'msgs/sec', 'commands'))
+    for title, kwargs in (('pub', {}),
+                          ('batching linger=0', {'batching': True,
+                                                 'linger': 0}),
+                          ('batching linger=5ms', {'batching': True}),
+                          ('batching size=20 linger=5ms',
+                           {'batching': True, 'batch_size': 20})):
+        elapsed, commands = await publish(nsqd, **kwargs)
+        print('    {:<28} {:>12.0f} {:>10}'.format(
+            title, total / elapsed, commands))
+
+
+def main():
+    with FakeNsqdProcess() as nsqd:
+        asyncio.run(go(nsqd))
+
+
+if __name__ == '__main__':
+    main()
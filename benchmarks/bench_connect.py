@@ -0,0 +1,81 @@
+"""Reader startup time against N local fake nsqd: connecting, identifying
+and subscribing one node after another compared with ``Reader.connect()``
+and ``Reader.subscribe()`` doing it concurrently.
+
+Every fake nsqd answers IDENTIFY after ``DELAY`` seconds to stand for
+network latency, the last scenario has one node which never answers.
+
+Usage: python -m benchmarks.bench_connect
+"""
+import asyncio
+import time
+
+from asyncnsq.tcp.connection import create_connection
+from asyncnsq.tcp.reader import Reader
+from tests._fakensqd import FakeNsqd
+
+
+DELAY = 0.02
+NODES = [1, 10, 40]
+
+
+async def sequential(loop, nodes):
+    conns = []
+    for nsqd in nodes:
+        conn = await create_connection(nsqd.host, nsqd.port,
+                                       queue=asyncio.Queue(), loop=loop)
+        await conn.identify(feature_negotiation=True)
+        await conn.execute(b'SUB', 'foo', 'bar')
+        conns.append(conn)
+    for conn in conns:
+        conn.close()
+
+
+async def concurrent(loop, nodes):
+    reader = Reader(nsqd_tcp_addresses=[(n.host, n.port) for n in nodes],
+                    loop=loop, identify_timeout=1)
+    await reader.connect()
+    await reader.subscribe('foo', 'bar')
+    connected = reader.stats['connections']
+    reader._redistribute_task.cancel()
+    for task in list(reader._connect_tasks.values()):
+        task.cancel()
+    for conn in list(reader._connections.values()):
+        conn.close()
+    return connected
+
+
+async def measure(func, *args):
+    start = time.perf_counter()
+    result = await func(*args)
+    return time.perf_counter() - start, result
+
+
+async def run():
+    loop = asyncio.get_running_loop()
+    print('{:<22} {:>12} {:>12} {:>10}'.format(
+        'nsqd nodes', 'sequential', 'concurrent', 'connected'))
+    scenarios = [(str(n), n, 0) for n in NODES] + [('40, one stalled', 39, 1)]
+    for title, healthy, stalled in scenarios:
+        nodes = [await FakeNsqd(identify_delay=DELAY).start()
+                 for _ in range(healthy)]
+        nodes += [await FakeNsqd(identify_delay=3600).start()
+                  for _ in range(stalled)]
+        if stalled:
+            seq = 'stalls'
+        else:
+            seq = '{:>10.3f}s'.format((await measure(
+                sequential, loop, nodes))[0])
+        elapsed, connected = await measure(concurrent, loop, nodes)
+        print('{:<22} {:>12} {:>11.3f}s {:>10}'.format(
+            title, seq, elapsed, connected))
+        for nsqd in nodes:
+            await nsqd.stop()
+
+
+def main():
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
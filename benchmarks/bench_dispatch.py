@@ -0,0 +1,83 @@
+"""Messages per second, and client CPU time per message, handled through
+the ``Reader.messages()`` queue compared with ``Reader.consume()`` push
+dispatch. The fake nsqd runs in a separate process and is usually the
+bottleneck for wall clock numbers.
+
+Usage: python -m benchmarks.bench_dispatch
+"""
+import asyncio
+import time
+
+from asyncnsq.tcp.reader import create_reader
+from ._utils import FakeNsqdProcess
+
+
+COUNT = 50000
+
+
+async def via_queue(reader, done):
+    async for msg in reader.messages():
+        await msg.fin()
+        done()
+
+
+def via_consume(concurrency, sync=False):
+    async def run(reader, done):
+        async def handler(msg):
+            done()
+
+        def sync_handler(msg):
+            done()
+
+        await reader.consume(sync_handler if sync else handler,
+                             concurrency=concurrency)
+    return run
+
+
+async def measure(nsqd, topic, consumer):
+    reader = await create_reader(nsqd_tcp_addresses=[nsqd.address],
+                                 max_in_flight=2500)
+    finished = asyncio.get_event_loop().create_future()
+    handled = 0
+
+    def done():
+        nonlocal handled
+        handled += 1
+        if handled == COUNT:
+            finished.set_result(
+                (time.perf_counter(), time.process_time()))
+
+    started, cpu_started = time.perf_counter(), time.process_time()
+    await reader.subscribe(topic, 'bench')
+    task = asyncio.ensure_future(consumer(reader, done))
+    stopped, cpu_stopped = await finished
+    task.cancel()
+    for conn in reader._connections.values():
+        conn.close()
+    return stopped - started, cpu_stopped - cpu_started
+
+
+CONSUMERS = (('messages()', via_queue),
+             ('consume(), 1 task', via_consume(1)),
+             ('consume(), 16 tasks', via_consume(16)),
+             ('consume(), sync', via_consume(1, sync=True)))
+
+
+async def go(nsqd):
+    for i, (title, consumer) in enumerate(CONSUMERS):
+        elapsed, cpu = await measure(nsqd, 'bench{}'.format(i), consumer)
+        print('{:<20} {:>8.0f} msgs/sec {:>6.1f} us cpu/msg'.format(
+            title, COUNT / elapsed, cpu / COUNT * 1e6))
+
+
+def main():
+    topics = [('bench{}'.format(i), COUNT, b'x' * 100)
+              for i in range(len(CONSUMERS))]
+    with FakeNsqdProcess(topics) as nsqd:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(go(nsqd))
+
+
+if __name__ == '__main__':
+    main()
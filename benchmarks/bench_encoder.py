@@ -0,0 +1,51 @@
+"""Per command encode cost of the fast encoders compared with the generic
+``encode_command`` path.
+
+Usage: python -m benchmarks.bench_encoder
+"""
+import timeit
+
+from asyncnsq.tcp.protocol import Reader
+
+
+MSG_ID = b'06f6cbf50539f004'
+SMALL = b'x' * 100
+
+COMMANDS = [
+    ('FIN', (b'FIN', MSG_ID), None),
+    ('REQ', (b'REQ', MSG_ID, 1000), None),
+    ('TOUCH', (b'TOUCH', MSG_ID), None),
+    ('RDY', (b'RDY', 200), None),
+    ('PUB 100B', (b'PUB', b'topic'), SMALL),
+    ('DPUB 100B', (b'DPUB', b'topic', 1000), SMALL),
+    ('MPUB 100x100B', (b'MPUB', b'topic'), [SMALL] * 100),
+    ('MPUB 100x64KB', (b'MPUB', b'topic'), [b'x' * 65536] * 100),
+]
+
+
+def measure(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def main():
+    parser = Reader()
+    print('{:<15} {:>12} {:>12} {:>8}'.format(
+        'command', 'generic', 'fast', 'speedup'))
+    for title, (cmd, *args), data in COMMANDS:
+        number = 100 if 'KB' in title else 20000
+
+        def generic():
+            parser._encode_generic(cmd, *args, data=data)
+
+        def fast():
+            parser.encode_command(cmd, *args, data=data)
+
+        generic_cost, fast_cost = measure(generic, number), measure(
+            fast, number)
+        print('{:<15} {:>10.2f}us {:>10.2f}us {:>7.1f}x'.format(
+            title, generic_cost * 1e6, fast_cost * 1e6,
+            generic_cost / fast_cost))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Messages per second handled by ``Reader.consume(key=...)`` depending on
+the number of distinct keys, next to unordered ``consume()``. The handler
+waits 1ms like a database write would, messages of a key are handled one
+at a time so few keys leave workers idle.
+
+Usage: python -m benchmarks.bench_keyed
+"""
+import asyncio
+import time
+
+from asyncnsq.tcp.reader import create_reader
+from ._utils import FakeNsqdProcess
+
+
+COUNT = 5000
+CONCURRENCY = 64
+CARDINALITIES = (None, 1, 4, 16, 64, 1024)
+
+
+def key_function(cardinality):
+    # message ids of the fake nsqd are sequential
+    return lambda msg: int(msg.message_id, 16) % cardinality
+
+
+async def measure(nsqd, topic, cardinality):
+    reader = await create_reader(nsqd_tcp_addresses=[nsqd.address],
+                                 max_in_flight=500)
+    finished = asyncio.get_event_loop().create_future()
+    handled = 0
+
+    async def handler(msg):
+        nonlocal handled
+        await asyncio.sleep(0.001)
+        handled += 1
+        if handled == COUNT:
+            finished.set_result(time.perf_counter())
+
+    await reader.subscribe(topic, 'bench')
+    key = None if cardinality is None else key_function(cardinality)
+    started = time.perf_counter()
+    task = asyncio.ensure_future(
+        reader.consume(handler, concurrency=CONCURRENCY, key=key))
+    max_depth = 0
+    while not finished.done():
+        await asyncio.sleep(0.01)
+        stats = reader.stats['dispatcher'] or {}
+        max_depth = max(max_depth, stats.get('depth', 0))
+    task.cancel()
+    conns, reader._connections = reader._connections, {}
+    for conn in conns.values():
+        conn.close()
+    return finished.result() - started, max_depth
+
+
+async def go(nsqd):
+    for i, cardinality in enumerate(CARDINALITIES):
+        elapsed, max_depth = await measure(
+            nsqd, 'bench{}'.format(i), cardinality)
+        title = 'unordered' if cardinality is None else '{} keys'.format(
+            cardinality)
+        print('{:<12} {:>8.0f} msgs/sec  deepest lane {}'.format(
+            title, COUNT / elapsed, max_depth))
+
+
+def main():
+    topics = [('bench{}'.format(i), COUNT, b'x' * 100)
+              for i in range(len(CARDINALITIES))]
+    with FakeNsqdProcess(topics) as nsqd:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(go(nsqd))
+
+
+if __name__ == '__main__':
+    main()
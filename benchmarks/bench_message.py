@@ -0,0 +1,68 @@
+"""Memory per message and construction time of ``NsqMessage`` compared
+with the namedtuple based message it replaced.
+
+Usage: python -m benchmarks.bench_message
+"""
+import struct
+import time
+import tracemalloc
+from collections import namedtuple
+
+from asyncnsq.tcp.messages import NsqMessage
+
+
+BaseMessage = namedtuple('NsqMessage',
+                         'timestamp attempts message_id body conn')
+
+
+class TupleMessage(BaseMessage):
+    """Previous message class."""
+
+    def __new__(cls, *args, **kwargs):
+        self = super().__new__(cls, *args, **kwargs)
+        self._is_processed = False
+        return self
+
+
+HEADER = struct.Struct('>qh16s')
+
+
+# both builders start from the receive buffer, as the parser does
+
+
+def build_tuple(frame, body, conn):
+    return TupleMessage(*HEADER.unpack_from(frame), body, conn)
+
+
+def build_slots(frame, body, conn):
+    return NsqMessage.from_frame(bytes(frame), body, conn)
+
+
+class Connection:
+    pass
+
+
+def main(count=100000):
+    conn = Connection()
+    body = b'x' * 100
+    headers = [bytearray(HEADER.pack(time.time_ns(), 1, b'%016x' % i))
+               for i in range(count)]
+    print('{} messages with {} bytes body'.format(count, len(body)))
+    for title, build in (('namedtuple', build_tuple),
+                         ('__slots__', build_slots)):
+        tracemalloc.start()
+        messages = [build(h, body, conn) for h in headers]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del messages
+
+        started = time.perf_counter()
+        for header in headers:
+            build(header, body, conn)
+        elapsed = time.perf_counter() - started
+        print('    {:<11} {:>6.0f} bytes/msg {:>8.3f} us/msg'.format(
+            title, size / count, elapsed / count * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Compare the cursor based frame parser with the slicing one it replaced.
+
+Usage: python -m benchmarks.bench_parser
+"""
+import struct
+import time
+
+from asyncnsq.tcp import consts
+from asyncnsq.tcp.protocol import Reader
+
+
+class SlicingReader:
+    """Previous parser: cuts every parsed frame from the buffer head."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, chunk):
+        self._buffer.extend(chunk)
+
+    def gets(self):
+        if len(self._buffer) < consts.DATA_SIZE:
+            return False
+        size = struct.unpack('>l', self._buffer[:consts.DATA_SIZE])[0]
+        if len(self._buffer) < consts.DATA_SIZE + size:
+            return False
+        start, end = consts.HEADER_SIZE, consts.DATA_SIZE + size
+        fmt = '>qh16s{}s'.format(end - start - consts.MSG_HEADER)
+        resp = struct.unpack(fmt, self._buffer[start:end])
+        self._buffer = self._buffer[end:]
+        return consts.FRAME_TYPE_MESSAGE, resp
+
+
+def make_frame(body_size):
+    payload = struct.pack('>qh16s', 0, 1, b'0' * 16) + b'x' * body_size
+    return struct.pack('>ll', len(payload) + consts.FRAME_SIZE,
+                       consts.FRAME_TYPE_MESSAGE) + payload
+
+
+def run(parser, data, chunk_size):
+    count = 0
+    started = time.perf_counter()
+    for i in range(0, len(data), chunk_size):
+        parser.feed(data[i:i + chunk_size])
+        while parser.gets() is not False:
+            count += 1
+    return count, time.perf_counter() - started
+
+
+def bench(name, body_size, frames, chunk_size=65536):
+    data = make_frame(body_size) * frames
+    print('{}: {} frames of {} bytes'.format(name, frames, body_size))
+    for title, factory in (('slicing', SlicingReader),
+                           ('cursor', Reader),
+                           ('cursor zero_copy',
+                            lambda: Reader(zero_copy=True))):
+        count, elapsed = run(factory(), data, chunk_size)
+        assert count == frames
+        print('    {:<18} {:>10.0f} frames/sec {:>8.1f} MB/sec'.format(
+            title, count / elapsed, len(data) / elapsed / 2 ** 20))
+
+
+def main():
+    bench('small', 100, 200000)
+    bench('large', 2 ** 20, 200)
+
+
+if __name__ == '__main__':
+    main()
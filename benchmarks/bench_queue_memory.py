@@ -0,0 +1,68 @@
+"""Peak memory of a Reader consuming 1MB messages with a slow handler,
+with an unbounded queue and with queues bounded by body bytes. RDY lets
+nsqd deliver up to max in flight messages at once, which all pile up in
+the queue unless it holds RDY at 0 once full.
+
+Usage: python -m benchmarks.bench_queue_memory
+"""
+import asyncio
+import time
+import tracemalloc
+
+from asyncnsq.tcp.reader import create_reader
+from ._utils import FakeNsqdProcess
+
+
+COUNT = 100
+BODY = b'x' * 1024 * 1024
+MAX_IN_FLIGHT = 100
+LIMITS = (None, 32 * 1024 * 1024, 8 * 1024 * 1024)
+
+
+async def measure(nsqd, topic, max_queue_bytes):
+    reader = await create_reader(nsqd_tcp_addresses=[nsqd.address],
+                                 max_in_flight=MAX_IN_FLIGHT,
+                                 max_queue_bytes=max_queue_bytes)
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    await reader.subscribe(topic, 'bench')
+    handled = 0
+    async for msg in reader.messages():
+        # slow handler
+        await asyncio.sleep(0.01)
+        await msg.fin()
+        handled += 1
+        if handled == COUNT:
+            break
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    stats = reader.stats['queue']
+    conns, reader._connections = reader._connections, {}
+    for conn in conns.values():
+        conn.close()
+    return elapsed, peak, stats
+
+
+async def go(nsqd):
+    for i, limit in enumerate(LIMITS):
+        elapsed, peak, stats = await measure(nsqd, 'bench{}'.format(i), limit)
+        title = 'unbounded' if limit is None else '{}MB queue'.format(
+            limit // 1024 // 1024)
+        print('{:<12} peak {:>6.1f}MB  deepest queue {:>3} msgs  '
+              '{:>5.1f} msgs/sec'.format(title, peak / 1024 / 1024,
+                                         stats['max_depth'],
+                                         COUNT / elapsed))
+
+
+def main():
+    topics = [('bench{}'.format(i), COUNT, BODY) for i in range(len(LIMITS))]
+    with FakeNsqdProcess(topics) as nsqd:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        tracemalloc.start()
+        loop.run_until_complete(go(nsqd))
+        tracemalloc.stop()
+
+
+if __name__ == '__main__':
+    main()
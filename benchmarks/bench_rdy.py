@@ -0,0 +1,31 @@
+"""RDY commands sent per 1k messages by ``RdyControl`` in simulated
+scenarios, see ``tests._rdysim``.
+
+Usage: python -m benchmarks.bench_rdy
+"""
+from asyncnsq.tcp.reader_rdy import RdyControl
+from tests._rdysim import FakeLoop, RdySimulation
+
+
+SCENARIOS = [
+    ('3 even nsqd, mif 300', [2000] * 3, 300),
+    ('3 skewed nsqd, mif 100', [5000, 500, 0], 100),
+    ('10 nsqd, mif 1000', [1000] * 10, 1000),
+    ('6 nsqd, mif 2', [0] * 5 + [1000], 2),
+]
+
+
+def main():
+    print('{:<25} {:>10} {:>8} {:>12}'.format(
+        'scenario', 'messages', 'RDY', 'RDY per 1k'))
+    for title, rates, max_in_flight in SCENARIOS:
+        loop = FakeLoop()
+        control = RdyControl(idle_timeout=1, max_in_flight=max_in_flight,
+                             loop=loop)
+        sim = RdySimulation(control, loop, rates).run(10)
+        print('{:<25} {:>10} {:>8} {:>12.1f}'.format(
+            title, sim.messages, sim.rdy_commands, sim.rdy_per_1k))
+
+
+if __name__ == '__main__':
+    main()
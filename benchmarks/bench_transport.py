@@ -0,0 +1,48 @@
+"""Messages per second received through ``NsqProtocol`` compared with the
+``StreamReader`` fallback, against an in-process fake nsqd.
+
+Usage: python -m benchmarks.bench_transport
+"""
+import asyncio
+import time
+
+from asyncnsq.tcp.connection import create_connection
+from tests._fakensqd import FakeNsqd
+
+
+async def consume(nsqd, buffered, count, body):
+    topic = 'bench{}'.format(len(nsqd.topics))
+    nsqd.put(topic, *([body] * count))
+    conn = await create_connection(nsqd.host, nsqd.port, buffered=buffered)
+    await conn.identify(feature_negotiation=True)
+    await conn.execute(b'SUB', topic, b'bench')
+    started = time.perf_counter()
+    await conn.execute(b'RDY', count)
+    for _ in range(count):
+        await conn.queue.get()
+    elapsed = time.perf_counter() - started
+    conn.close()
+    return elapsed
+
+
+async def go():
+    nsqd = await FakeNsqd().start()
+    for size, count in ((100, 100000), (10000, 20000)):
+        body = b'x' * size
+        print('{} messages of {} bytes'.format(count, size))
+        for title, buffered in (('StreamReader', False),
+                                ('BufferedProtocol', True)):
+            elapsed = await consume(nsqd, buffered, count, body)
+            print('    {:<17} {:>10.0f} msgs/sec'.format(
+                title, count / elapsed))
+    await nsqd.stop()
+
+
+def main():
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(go())
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -68,7 +68,7 @@ setup(name='asyncnsq',
       author_email="aohan237@gmail.com",
       url="https://github.com/aohan237/asyncnsq",
       license="MIT",
-      packages=find_packages(exclude=["tests"]),
+      packages=find_packages(exclude=["tests", "benchmarks", "benchmarks.*"]),
       install_requires=install_requires,
       include_package_data=True,
       )
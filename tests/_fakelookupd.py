@@ -0,0 +1,49 @@
+"""nsqlookupd answering ``/lookup`` and ``/nodes`` from a mutable
+producer list."""
+from aiohttp import web
+
+
+class FakeLookupd:
+
+    def __init__(self, host='127.0.0.1'):
+        self.host, self.port = host, None
+        # (broadcast_address, tcp_port) of nsqd having the topic
+        self.producers = []
+        self.failing = False
+        self.requests = 0
+        self._runner = None
+
+    @property
+    def address(self):
+        return (self.host, self.port)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/lookup', self._lookup)
+        app.router.add_get('/nodes', self._nodes)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def _lookup(self, request):
+        return self._response({'channels': []})
+
+    async def _nodes(self, request):
+        return self._response({})
+
+    def _response(self, data):
+        self.requests += 1
+        if self.failing:
+            return web.json_response({'message': 'INTERNAL_ERROR'},
+                                     status=500)
+        data['producers'] = [
+            {'broadcast_address': host, 'tcp_port': port,
+             'hostname': host, 'http_port': 0, 'version': '1.2.0'}
+            for host, port in self.producers]
+        return web.json_response(data)
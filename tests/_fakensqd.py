@@ -0,0 +1,314 @@
+"""In-process nsqd speaking enough of the TCP protocol for tests and
+benchmarks, no real nsqd binary is required.
+
+:see: http://nsq.io/clients/tcp_protocol_spec.html
+"""
+import asyncio
+import json
+import struct
+import time
+import zlib
+from collections import defaultdict, deque
+
+import snappy
+
+from asyncnsq.tcp import consts
+
+
+def encode_frame(frame_type, data):
+    return struct.pack('>ll', len(data) + consts.FRAME_SIZE,
+                       frame_type) + data
+
+
+class FakeMessage:
+
+    def __init__(self, msg_id, body):
+        self.id = msg_id
+        self.body = body
+        self.attempts = 0
+        self.timestamp = time.time_ns()
+
+    def encode(self):
+        payload = struct.pack('>qh16s', self.timestamp, self.attempts,
+                              self.id) + self.body
+        return encode_frame(consts.FRAME_TYPE_MESSAGE, payload)
+
+
+class FakeNsqd:
+    """Single node nsqd, every topic has one shared channel.
+
+    ``identify_delay`` postpones the IDENTIFY response to emulate slow
+    nodes, ``identify_response`` updates the negotiated settings.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, *, identify_delay=0,
+                 identify_response=None, max_body_size=None):
+        self.host, self.port = host, port
+        self.identify_delay = identify_delay
+        # --max-body-size, MPUB over it fails with E_BAD_BODY
+        self.max_body_size = max_body_size
+        # error MPUB is answered with, e.g. E_MPUB_FAILED of an exiting nsqd
+        self.mpub_error = None
+        self.identify_response = {
+            'max_rdy_count': 2500,
+            'version': '1.2.0',
+            'max_msg_timeout': 900000,
+            'msg_timeout': 60000,
+            'tls_v1': False,
+            'deflate': False,
+            'deflate_level': 6,
+            'max_deflate_level': 6,
+            'snappy': False,
+            'sample_rate': 0,
+            'auth_required': False,
+            'output_buffer_size': 16384,
+            'output_buffer_timeout': 250,
+        }
+        self.identify_response.update(identify_response or {})
+        self.topics = defaultdict(deque)
+        self.published = defaultdict(list)
+        self.commands = []
+        self.clients = set()
+        self._handlers = set()
+        self._server = None
+        self._next_id = 0
+
+    @property
+    def address(self):
+        return '{}:{}'.format(self.host, self.port)
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        """Stop listening and drop all client connections."""
+        if self._server is None:
+            return
+        self._server.close()
+        for client in list(self.clients):
+            client.close()
+        for task in self._handlers:
+            task.cancel()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+
+    def put(self, topic, *bodies):
+        """Enqueue messages without going through a client connection."""
+        for body in bodies:
+            msg_id = '{:016x}'.format(self._next_id).encode('ascii')
+            self._next_id += 1
+            self.topics[topic].append(FakeMessage(msg_id, body))
+        for client in list(self.clients):
+            client.pump()
+
+    async def _handle(self, reader, writer):
+        client = FakeClient(self, reader, writer)
+        self.clients.add(client)
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            await client.run()
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.CancelledError):
+            # cancelled by stop()
+            pass
+        finally:
+            self.clients.discard(client)
+            client.close()
+            client.requeue_in_flight()
+            self._handlers.discard(task)
+
+
+class FakeClient:
+
+    def __init__(self, nsqd, reader, writer):
+        self._nsqd = nsqd
+        self._reader, self._writer = reader, writer
+        self._compressor = None
+        self._decompressor = None
+        self._buffer = bytearray()
+        self.topic = None
+        self.rdy = 0
+        self.in_flight = {}
+        self.closing = False
+
+    def close(self):
+        self._writer.close()
+
+    def requeue_in_flight(self):
+        queue = self._nsqd.topics[self.topic]
+        for msg in self.in_flight.values():
+            self._requeue(queue, msg)
+        self.in_flight.clear()
+
+    def write(self, data):
+        if self._writer.is_closing():
+            return
+        if self._compressor is not None:
+            data = self._compressor(data)
+        self._writer.write(data)
+
+    def respond(self, data):
+        self.write(encode_frame(consts.FRAME_TYPE_RESPONSE, data))
+
+    def error(self, data):
+        self.write(encode_frame(consts.FRAME_TYPE_ERROR, data))
+
+    async def _fill(self):
+        chunk = await self._reader.read(65536)
+        if not chunk:
+            raise asyncio.IncompleteReadError(bytes(self._buffer), None)
+        if self._decompressor is not None:
+            chunk = self._decompressor(chunk)
+        self._buffer.extend(chunk)
+
+    async def _readline(self):
+        while consts.NL not in self._buffer:
+            await self._fill()
+        pos = self._buffer.index(consts.NL)
+        line = bytes(self._buffer[:pos])
+        del self._buffer[:pos + 1]
+        return line
+
+    async def _readexactly(self, size):
+        while len(self._buffer) < size:
+            await self._fill()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    async def _read_body(self):
+        size = struct.unpack('>l', await self._readexactly(4))[0]
+        return await self._readexactly(size)
+
+    async def run(self):
+        magic = await self._readexactly(len(consts.MAGIC_V2))
+        assert magic == consts.MAGIC_V2, magic
+        while True:
+            line = await self._readline()
+            cmd, *params = line.split(b' ')
+            self._nsqd.commands.append((cmd, params))
+            handler = getattr(self, '_cmd_' + cmd.decode('ascii').lower())
+            await handler(*params)
+
+    async def _cmd_identify(self):
+        config = json.loads((await self._read_body()).decode('utf-8'))
+        if self._nsqd.identify_delay:
+            await asyncio.sleep(self._nsqd.identify_delay)
+        if not config.get('feature_negotiation'):
+            self.respond(b'OK')
+            return
+        resp = dict(self._nsqd.identify_response)
+        resp['deflate'] = bool(config.get('deflate'))
+        resp['snappy'] = bool(config.get('snappy')) and not resp['deflate']
+        resp['tls_v1'] = False
+        self.respond(json.dumps(resp).encode('utf-8'))
+        if resp['deflate']:
+            wbits = -zlib.MAX_WBITS
+            compressor = zlib.compressobj(
+                config.get('deflate_level') or 6, zlib.DEFLATED, wbits)
+            self._compressor = lambda data: compressor.compress(
+                data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._decompressor = zlib.decompressobj(wbits).decompress
+        elif resp['snappy']:
+            self._compressor = snappy.StreamCompressor().add_chunk
+            self._decompressor = snappy.StreamDecompressor().decompress
+        else:
+            return
+        self._buffer[:] = self._decompressor(bytes(self._buffer))
+        self.respond(b'OK')
+
+    async def _cmd_auth(self):
+        await self._read_body()
+        self.respond(b'{"identity": "fake"}')
+
+    async def _cmd_sub(self, topic, channel):
+        self.topic = topic.decode('utf-8')
+        self.respond(b'OK')
+
+    async def _cmd_rdy(self, count):
+        self.rdy = int(count)
+        self.pump()
+
+    async def _cmd_fin(self, msg_id):
+        if self.in_flight.pop(msg_id, None) is None:
+            self.error(b'E_FIN_FAILED FIN ' + msg_id + b' failed')
+        self.pump()
+
+    async def _cmd_req(self, msg_id, timeout=b'0'):
+        msg = self.in_flight.pop(msg_id, None)
+        if msg is None:
+            self.error(b'E_REQ_FAILED REQ ' + msg_id + b' failed')
+            return
+        delay = int(timeout) / 1000
+        queue = self._nsqd.topics[self.topic]
+        loop = asyncio.get_event_loop()
+        if delay:
+            loop.call_later(delay, self._requeue, queue, msg)
+        else:
+            self._requeue(queue, msg)
+        self.pump()
+
+    def _requeue(self, queue, msg):
+        queue.append(msg)
+        for client in list(self._nsqd.clients):
+            client.pump()
+
+    async def _cmd_touch(self, msg_id):
+        if msg_id not in self.in_flight:
+            self.error(b'E_TOUCH_FAILED TOUCH ' + msg_id + b' failed')
+
+    async def _cmd_nop(self):
+        pass
+
+    async def _cmd_cls(self):
+        self.closing = True
+        self.respond(b'CLOSE_WAIT')
+
+    async def _cmd_pub(self, topic):
+        self._publish(topic, [await self._read_body()])
+        self.respond(b'OK')
+
+    async def _cmd_dpub(self, topic, delay):
+        self._publish(topic, [await self._read_body()])
+        self.respond(b'OK')
+
+    async def _cmd_mpub(self, topic):
+        body = await self._read_body()
+        max_body_size = self._nsqd.max_body_size
+        if max_body_size is not None and len(body) > max_body_size:
+            self.error(b'E_BAD_BODY MPUB body too big')
+            return
+        if self._nsqd.mpub_error is not None:
+            self.error(self._nsqd.mpub_error)
+            return
+        num = struct.unpack('>l', body[:4])[0]
+        messages, pos = [], 4
+        for _ in range(num):
+            size = struct.unpack('>l', body[pos:pos + 4])[0]
+            messages.append(body[pos + 4:pos + 4 + size])
+            pos += 4 + size
+        self._publish(topic, messages)
+        self.respond(b'OK')
+
+    def _publish(self, topic, messages):
+        topic = topic.decode('utf-8')
+        self._nsqd.published[topic].extend(messages)
+        self._nsqd.put(topic, *messages)
+
+    def pump(self):
+        """Deliver queued messages while RDY allows."""
+        if self.topic is None or self.closing:
+            return
+        queue = self._nsqd.topics[self.topic]
+        chunks = []
+        while queue and len(self.in_flight) < self.rdy:
+            msg = queue.popleft()
+            msg.attempts += 1
+            self.in_flight[msg.id] = msg
+            chunks.append(msg.encode())
+        chunks and self.write(b''.join(chunks))
@@ -0,0 +1,131 @@
+"""Simulated nsqd connections driving a ``RdyControl`` on a fake loop.
+
+Every connection has a producer rate, nsqd delivers while the client has
+fewer messages in flight than its RDY, the consumer finishes a message
+``latency`` seconds after receiving it, or re-queues it when ``failing``
+returns true for the current time.
+"""
+import heapq
+import itertools
+from collections import deque
+
+from asyncnsq.tcp.consts import RDY
+
+
+class FakeTimer:
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop:
+    """Just ``time()`` and ``call_later()``, advanced by ``advance()``."""
+
+    def __init__(self):
+        self.now = 0.0
+        self._timers = []
+        self._seq = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, callback, *args):
+        timer = FakeTimer()
+        heapq.heappush(self._timers, (self.now + delay, next(self._seq),
+                                      timer, callback, args))
+        return timer
+
+    def advance(self, seconds):
+        self.now += seconds
+        while self._timers and self._timers[0][0] <= self.now:
+            _, _, timer, callback, args = heapq.heappop(self._timers)
+            if not timer.cancelled:
+                callback(*args)
+
+
+class SimConnection:
+
+    def __init__(self, conn_id, rate):
+        self.id = conn_id
+        self.rate = rate
+        self.rdy = 0
+        self.in_flight = 0
+        self.backlog = 0.0
+        self.received = 0
+        self.rdy_commands = []
+        self.closed = False
+        self.max_rdy_count = 2500
+
+    def execute(self, command, *args, data=None):
+        assert command == RDY, command
+        self.rdy = int(args[0])
+        self.rdy_commands.append(self.rdy)
+
+
+class RdySimulation:
+    """
+    :param rdy_control: ``RdyControl`` created with ``loop``
+    :param rates: messages per second produced for every connection
+    :param failing: ``failing(now)`` tells whether processing fails
+    """
+
+    def __init__(self, rdy_control, loop, rates, latency=0.005,
+                 step=0.001, redistribute_interval=1.0, failing=None):
+        self.rdy_control = rdy_control
+        self.loop = loop
+        self.failing = failing
+        self.failed = 0
+        self.latency = latency
+        self.step = step
+        self.redistribute_interval = redistribute_interval
+        self.connections = [SimConnection('conn{}'.format(i), rate)
+                            for i, rate in enumerate(rates)]
+        for conn in self.connections:
+            rdy_control.add_connection(conn)
+        self._processing = deque()
+        self._next_redistribute = loop.now
+        self.max_total_in_flight = 0
+
+    @property
+    def messages(self):
+        return sum(conn.received for conn in self.connections)
+
+    @property
+    def rdy_commands(self):
+        return sum(len(conn.rdy_commands) for conn in self.connections)
+
+    @property
+    def rdy_per_1k(self):
+        return self.rdy_commands * 1000 / max(1, self.messages)
+
+    def run(self, seconds):
+        end = self.loop.now + seconds
+        while self.loop.now < end:
+            self.loop.advance(self.step)
+            now = self.loop.now
+            while self._processing and self._processing[0][0] <= now:
+                conn = self._processing.popleft()[1]
+                conn.in_flight -= 1
+                success = not (self.failing and self.failing(now))
+                if not success:
+                    self.failed += 1
+                    conn.backlog += 1
+                self.rdy_control.message_processed(conn.id, success)
+            if now >= self._next_redistribute:
+                self.rdy_control.redistribute()
+                self._next_redistribute = now + self.redistribute_interval
+            for conn in self.connections:
+                conn.backlog += conn.rate * self.step
+                while conn.backlog >= 1 and conn.in_flight < conn.rdy:
+                    conn.backlog -= 1
+                    conn.in_flight += 1
+                    conn.received += 1
+                    self._processing.append((now + self.latency, conn))
+                    self.rdy_control.message_received(conn.id)
+            self.max_total_in_flight = max(
+                self.max_total_in_flight,
+                sum(conn.in_flight for conn in self.connections))
+        return self
@@ -2,6 +2,8 @@ import asyncio
 import unittest
 from functools import wraps
 
+from ._fakensqd import FakeNsqd
+
 
 def run_until_complete(fun):
     if not asyncio.iscoroutinefunction(fun):
@@ -24,5 +26,43 @@ class BaseTest(unittest.TestCase):
         self.loop = asyncio.new_event_loop()
 
     def tearDown(self):
+        # background tasks of readers and writers
+        pending = asyncio.all_tasks(self.loop)
+        while pending:
+            for task in pending:
+                task.cancel()
+            # cancelling may start new tasks or be swallowed by wait_for()
+            self.loop.run_until_complete(asyncio.wait(pending, timeout=0.1))
+            pending = asyncio.all_tasks(self.loop)
         self.loop.close()
         del self.loop
+
+    async def _wait_for(self, predicate, timeout=2):
+        """Poll ``predicate`` until it is true, fail after ``timeout``."""
+        for _ in range(int(timeout / 0.01)):
+            if predicate():
+                return
+            await asyncio.sleep(0.01)
+        self.fail('Condition not met in {} sec'.format(timeout))
+
+
+class FakeNsqdTest(BaseTest):
+    """Runs ``nodes_count`` fake nsqd created with ``nsqd_options``,
+    ``self.nsqd`` is the first of ``self.nodes``.
+    """
+
+    nodes_count = 1
+    nsqd_options = {}
+
+    def setUp(self):
+        super().setUp()
+        self.nodes = [FakeNsqd(**self.nsqd_options)
+                      for _ in range(self.nodes_count)]
+        for nsqd in self.nodes:
+            self.loop.run_until_complete(nsqd.start())
+        self.nsqd = self.nodes[0]
+
+    def tearDown(self):
+        for nsqd in self.nodes:
+            self.loop.run_until_complete(nsqd.stop())
+        super().tearDown()
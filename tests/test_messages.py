@@ -0,0 +1,46 @@
+import gc
+import unittest
+
+from asyncnsq.tcp.messages import NsqMessage
+from asyncnsq.tcp.protocol import Reader
+
+
+class FakeConnection:
+    pass
+
+
+class NsqMessageTest(unittest.TestCase):
+
+    raw = b'\x00\x00\x00&\x00\x00\x00\x02\x13\x8c4\xcd\x01x~\x83' \
+          b'\x00\x0106f6cbf50539f004test_msg'
+
+    def test_from_raw_frame(self):
+        parser = Reader(raw_messages=True)
+        parser.feed(self.raw)
+        frame_type, (header, body) = parser.gets()
+        conn = FakeConnection()
+        msg = NsqMessage.from_frame(header, body, conn)
+        self.assertEqual(msg.timestamp, 1408558838557736579)
+        self.assertEqual(msg.attempts, 1)
+        self.assertEqual(msg.message_id, b'06f6cbf50539f004')
+        self.assertEqual(msg.body, b'test_msg')
+        self.assertIs(msg.conn, conn)
+        self.assertFalse(hasattr(msg, '__dict__'))
+
+    def test_constructor(self):
+        conn = FakeConnection()
+        msg = NsqMessage(1408558838557736579, 3, b'06f6cbf50539f004',
+                         b'test_msg', conn)
+        self.assertEqual(msg.timestamp, 1408558838557736579)
+        self.assertEqual(msg.attempts, 3)
+        self.assertEqual(msg.message_id, b'06f6cbf50539f004')
+        self.assertIn('06f6cbf50539f004', repr(msg))
+
+    def test_weak_connection(self):
+        conn = FakeConnection()
+        msg = NsqMessage(0, 1, b'06f6cbf50539f004', b'test_msg', conn)
+        del conn
+        gc.collect()
+        self.assertIsNone(msg.conn)
+        with self.assertRaises(ConnectionError):
+            msg.fin()
@@ -1,6 +1,6 @@
 import unittest
-from asyncnsq.exceptions import ProtocolError
-from asyncnsq.protocol import Reader
+from asyncnsq.tcp.exceptions import ProtocolError
+from asyncnsq.tcp.protocol import Reader
 
 
 class ParserTest(unittest.TestCase):
@@ -79,6 +79,48 @@ class ParserTest(unittest.TestCase):
         self.assertEqual(b'E_BAD_TOPIC', code)
         self.assertEqual(b'PUB topic name "fo/o" is not valid', msg)
 
+    def test_gets_all(self):
+        msg = b'\x00\x00\x00&\x00\x00\x00\x02\x13\x8c4\xcd\x01x~\x83' \
+              b'\x00\x0106f6cbf50539f004test_msg\x00\x00\x00\x0f\x00' \
+              b'\x00\x00\x00_heartbeat_\x00\x00\x00\x06\x00\x00'
+        self.parser.feed(msg)
+        frames = self.parser.gets_all()
+        self.assertEqual(len(frames), 2)
+        msg_tuple = (1408558838557736579, 1, b'06f6cbf50539f004', b'test_msg')
+        self.assertEqual(frames[0], (2, msg_tuple))
+        self.assertEqual(frames[1], (0, b'_heartbeat_'))
+
+        # incomplete frame stays in the buffer
+        self.assertEqual(self.parser.gets_all(), [])
+        self.parser.feed(b'\x00\x00OK')
+        self.assertEqual(self.parser.gets_all(), [(0, b'OK')])
+
+    def test_buffer_compaction(self):
+        parser = Reader(compact_size=64)
+        ok_raw = b'\x00\x00\x00\x06\x00\x00\x00\x00OK'
+        for i in range(100):
+            parser.feed(ok_raw + ok_raw[:3])
+            self.assertEqual(parser.gets(), (0, b'OK'))
+            parser.feed(ok_raw[3:])
+            self.assertEqual(parser.gets(), (0, b'OK'))
+            self.assertLess(len(parser._buffer), 64 + len(ok_raw) * 2)
+        self.assertEqual(parser.buffer, b'')
+
+    def test_zero_copy_body(self):
+        parser = Reader(zero_copy=True, compact_size=1)
+        msg = b'\x00\x00\x00&\x00\x00\x00\x02\x13\x8c4\xcd\x01x~\x83' \
+              b'\x00\x0106f6cbf50539f004test_msg'
+        parser.feed(msg)
+        obj_type, obj = parser.gets()
+        body = obj[3]
+        self.assertIsInstance(body, memoryview)
+        self.assertEqual(body, b'test_msg')
+
+        # body keeps pointing to valid data after the buffer is reused
+        parser.feed(msg)
+        self.assertEqual(parser.gets()[1][3], b'test_msg')
+        self.assertEqual(body, b'test_msg')
+
     def test_protocol_error(self):
         ok_raw = b'\x00\x00\x00\x06\x00\x00\x00\x03OK'
         self.parser.feed(ok_raw)
@@ -133,3 +175,29 @@ class CommandEncoderTest(unittest.TestCase):
         command_raw = self.parser.encode_command(b'MPUB', 'topic',
                                                  data=['foo', 'bar'])
         self.assertEqual(command_raw, required_command)
+
+    def test_fast_encoders_match_generic(self):
+        msg_id = b'06f6cbf50539f004'
+        commands = [
+            ((b'FIN', msg_id), None),
+            (('FIN', msg_id.decode('ascii')), None),
+            ((b'REQ', msg_id, 10), None),
+            ((b'TOUCH', msg_id), None),
+            ((b'RDY', 42), None),
+            (('RDY', '3'), None),
+            ((b'PUB', 'foo'), 'test_msg'),
+            ((b'DPUB', b'foo', 1000), b'test_msg'),
+            ((b'MPUB', b'foo'), [b'foo', 'bar', 42]),
+            ((b'MPUB', b'foo'), (b'x' * 1000,)),
+        ]
+        for (cmd, *args), data in commands:
+            fast = self.parser.encode_command(cmd, *args, data=data)
+            generic = self.parser._encode_generic(cmd, *args, data=data)
+            self.assertEqual(fast, generic)
+
+    def test_fast_encoders(self):
+        self.assertEqual(self.parser.encode_rdy(1), b'RDY 1\n')
+        self.assertEqual(self.parser.encode_req(b'id', 0), b'REQ id 0\n')
+        self.assertEqual(self.parser.encode_mpub(b'foo', [b'a', b'bc']),
+                         b'MPUB foo\n\x00\x00\x00\x0f\x00\x00\x00\x02'
+                         b'\x00\x00\x00\x01a\x00\x00\x00\x02bc')
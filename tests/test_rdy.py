@@ -0,0 +1,215 @@
+import logging
+import unittest
+
+from ._rdysim import FakeLoop, RdySimulation
+from asyncnsq.tcp.reader_rdy import RdyControl
+
+
+logger = logging.getLogger(__name__)
+
+
+class RdyControlTest(unittest.TestCase):
+
+    def _simulation(self, rates, max_in_flight, idle_timeout=10, **kwargs):
+        loop = FakeLoop()
+        control = RdyControl(idle_timeout=idle_timeout,
+                             max_in_flight=max_in_flight, loop=loop)
+        return RdySimulation(control, loop, rates, **kwargs)
+
+    def _report(self, sim):
+        logger.info('%d messages, %d RDY, %.1f RDY per 1k messages',
+                    sim.messages, sim.rdy_commands, sim.rdy_per_1k)
+
+    def test_rdy_per_1k_messages(self):
+        sim = self._simulation([2000, 2000, 2000], max_in_flight=300)
+        sim.run(10)
+        self._report(sim)
+        self.assertGreater(sim.messages, 50000)
+        # previously one RDY per message, 1000 per 1k
+        self.assertLess(sim.rdy_per_1k, 20)
+        self.assertLessEqual(sim.max_total_in_flight, 300)
+
+    def test_weighted_by_rate(self):
+        sim = self._simulation([5000, 500, 0], max_in_flight=100)
+        sim.run(5)
+        self._report(sim)
+        fast, slow, idle = sim.connections
+        self.assertGreater(fast.rdy, slow.rdy)
+        self.assertGreater(slow.rdy, idle.rdy)
+        self.assertGreaterEqual(idle.rdy, 1)
+        self.assertLessEqual(sum(c.rdy for c in sim.connections), 100)
+        self.assertLessEqual(sim.max_total_in_flight, 100)
+        # the fast producer is not throttled by an even split
+        self.assertGreater(fast.received, 5000 * 5 * 0.9)
+
+    def test_rotate_rdy_over_idle_connections(self):
+        rates = [0] * 5 + [1000]
+        sim = self._simulation(rates, max_in_flight=2, idle_timeout=1,
+                               redistribute_interval=0.5)
+        sim.run(10)
+        self._report(sim)
+        busy = sim.connections[-1]
+        self.assertGreater(busy.received, 1000)
+        # idle connections gave RDY 1 away, the busy one kept it
+        self.assertEqual(busy.rdy, 1)
+        self.assertEqual(sum(c.rdy for c in sim.connections), 2)
+        self.assertTrue(all(c.rdy_commands for c in sim.connections))
+        self.assertLessEqual(sim.max_total_in_flight, 2)
+
+    def test_set_max_in_flight(self):
+        sim = self._simulation([1000, 1000], max_in_flight=10)
+        sim.run(1)
+        sim.rdy_control.set_max_in_flight(2)
+        self.assertEqual([c.rdy for c in sim.connections], [1, 1])
+        sim.rdy_control.set_max_in_flight(1)
+        self.assertEqual(sum(c.rdy for c in sim.connections), 1)
+
+    def test_backoff_state_machine(self):
+        sim = self._simulation([1000, 1000], max_in_flight=10)
+        control, loop = sim.rdy_control, sim.loop
+        sim.run(1)
+        control.message_processed('conn0', False)
+        self.assertTrue(control.in_backoff)
+        self.assertEqual(control.backoff_interval, 1)
+        self.assertEqual([c.rdy for c in sim.connections], [0, 0])
+        # failures of messages received earlier are ignored while paused
+        control.message_processed('conn1', False)
+        self.assertEqual(control.stats['backoff']['counter'], 1)
+        loop.advance(1)
+        # testing the waters with RDY 1 on a single connection
+        self.assertEqual(sorted(c.rdy for c in sim.connections), [0, 1])
+        control.message_processed('conn0', False)
+        self.assertEqual(control.backoff_interval, 2)
+        self.assertEqual([c.rdy for c in sim.connections], [0, 0])
+        loop.advance(2)
+        control.message_processed('conn1', True)
+        self.assertEqual([c.rdy for c in sim.connections], [0, 0])
+        self.assertEqual(control.backoff_interval, 1)
+        loop.advance(1)
+        control.message_processed('conn1', True)
+        self.assertFalse(control.in_backoff)
+        self.assertEqual(sum(c.rdy for c in sim.connections), 10)
+        stats = control.stats['backoff']
+        self.assertEqual(stats['count'], 1)
+        self.assertEqual(stats['time'], 4)
+
+    def test_backoff_ignores_successes_while_paused(self):
+        sim = self._simulation([1000], max_in_flight=100)
+        control, loop = sim.rdy_control, sim.loop
+        sim.run(1)
+        control.message_processed('conn0', False)
+        # a message received before RDY 0 does not end the interval
+        control.message_processed('conn0', True)
+        self.assertTrue(control.in_backoff)
+        self.assertEqual(sim.connections[0].rdy, 0)
+        loop.advance(1)
+        self.assertEqual(sim.connections[0].rdy, 1)
+        control.message_processed('conn0', True)
+        self.assertFalse(control.in_backoff)
+        self.assertEqual(sim.connections[0].rdy, 100)
+
+    def test_backoff_interval_limit(self):
+        loop = FakeLoop()
+        control = RdyControl(idle_timeout=10, max_in_flight=10, loop=loop,
+                             backoff_interval=0.5, backoff_multiplier=3,
+                             max_backoff=5)
+        RdySimulation(control, loop, [0])
+        intervals = []
+        for _ in range(5):
+            control.message_processed('conn0', False)
+            intervals.append(control.backoff_interval)
+            loop.advance(intervals[-1])
+        self.assertEqual(intervals, [0.5, 1.5, 4.5, 5, 5])
+
+    def test_backoff_on_failing_handler(self):
+        # downstream is broken for 5 seconds
+        sim = self._simulation(
+            [1000, 1000], max_in_flight=100,
+            failing=lambda now: 1 <= now < 6)
+        sim.run(20)
+        self._report(sim)
+        control = sim.rdy_control
+        self.assertFalse(control.in_backoff)
+        self.assertGreaterEqual(control.stats['backoff']['count'], 1)
+        # without backoff about 10k messages would fail
+        self.assertLess(sim.failed, 500)
+        self.assertEqual(sum(c.rdy for c in sim.connections), 100)
+
+    def test_backoff_disabled(self):
+        loop = FakeLoop()
+        control = RdyControl(idle_timeout=10, max_in_flight=10, loop=loop,
+                             max_backoff=0)
+        sim = RdySimulation(control, loop, [1000], failing=lambda now: True)
+        sim.run(1)
+        self.assertFalse(control.in_backoff)
+        self.assertGreater(sim.failed, 500)
+
+    def test_pause_resume(self):
+        sim = self._simulation([1000, 1000], max_in_flight=10)
+        control = sim.rdy_control
+        sim.run(1)
+        control.pause('lanes')
+        control.pause('queue')
+        self.assertEqual([c.rdy for c in sim.connections], [0, 0])
+        received = sim.messages
+        sim.run(1)
+        # only messages in flight when paused arrive
+        self.assertLessEqual(sim.messages - received, 10)
+        control.resume('lanes')
+        self.assertEqual([c.rdy for c in sim.connections], [0, 0])
+        self.assertEqual(control.stats['paused'], ['queue'])
+        control.resume('queue')
+        self.assertEqual(sum(c.rdy for c in sim.connections), 10)
+        sim.run(1)
+        self.assertGreater(sim.messages - received, 1000)
+
+    def _assert_rate(self, messages, rate, burst, seconds):
+        # a token bucket allows rate * seconds plus the burst it started
+        # with, the tolerance covers tokens not spent yet
+        self.assertLessEqual(messages, rate * seconds + burst)
+        self.assertGreaterEqual(messages, rate * seconds * 0.98)
+
+    def test_rate_limit(self):
+        loop = FakeLoop()
+        control = RdyControl(idle_timeout=10, max_in_flight=100, loop=loop,
+                             rate_limit=500, burst=50)
+        sim = RdySimulation(control, loop, [2000, 2000, 2000])
+        sim.run(10)
+        self._report(sim)
+        self._assert_rate(sim.messages, 500, 50, 10)
+        self.assertLessEqual(sim.max_total_in_flight, 50)
+        # adjusted at runtime
+        control.set_rate_limit(1000)
+        received = sim.messages
+        sim.run(10)
+        self._assert_rate(sim.messages - received, 1000, 1000, 10)
+        control.set_rate_limit(None)
+        received = sim.messages
+        sim.run(1)
+        self.assertGreater(sim.messages - received, 5000)
+        self.assertFalse(control.paused)
+
+    def test_rate_limit_slow_handler(self):
+        # handlers slower than the limit are not throttled further
+        loop = FakeLoop()
+        control = RdyControl(idle_timeout=10, max_in_flight=10, loop=loop,
+                             rate_limit=5000)
+        sim = RdySimulation(control, loop, [2000], latency=0.01)
+        sim.run(5)
+        self.assertEqual(control.stats['rate_limit']['throttles'], 0)
+        self.assertGreater(sim.messages, 900 * 5)
+
+    def test_cap(self):
+        sim = self._simulation([1000, 1000], max_in_flight=100)
+        control = sim.rdy_control
+        sim.run(1)
+        control.set_cap('bytes', 8)
+        self.assertLessEqual(sum(c.rdy for c in sim.connections), 8)
+        # messages in flight before the cap are processed
+        sim.run(0.1)
+        sim.max_total_in_flight = 0
+        sim.run(1)
+        self.assertLessEqual(sim.max_total_in_flight, 8)
+        self.assertEqual(control.stats['caps'], {'bytes': 8})
+        control.set_cap('bytes', None)
+        self.assertEqual(sum(c.rdy for c in sim.connections), 100)
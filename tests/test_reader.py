@@ -0,0 +1,665 @@
+import asyncio
+
+from ._fakelookupd import FakeLookupd
+from ._testutils import run_until_complete, FakeNsqdTest
+from asyncnsq.tcp.reader import create_reader, Reader
+
+
+class ReaderConsumeTest(FakeNsqdTest):
+
+    async def _reader(self, **kwargs):
+        reader = await create_reader(
+            nsqd_tcp_addresses=[self.nsqd.address], loop=self.loop,
+            **kwargs)
+        await reader.subscribe('foo', 'bar')
+        return reader
+
+    def _commands(self, name):
+        return [params for cmd, params in self.nsqd.commands if cmd == name]
+
+    @run_until_complete
+    async def test_consume_coroutine_handler(self):
+        bodies = [str(i).encode('utf-8') for i in range(100)]
+        self.nsqd.put('foo', *bodies)
+        reader = await self._reader(max_in_flight=10)
+        handled, running = [], []
+
+        async def handler(msg):
+            running.append(msg)
+            self.assertLessEqual(len(running), 4)
+            await asyncio.sleep(0.001)
+            running.remove(msg)
+            handled.append(msg.body)
+
+        task = self.loop.create_task(reader.consume(handler, concurrency=4))
+        await self._wait_for(lambda: len(handled) == len(bodies))
+        self.assertEqual(sorted(handled), sorted(bodies))
+        await self._wait_for(lambda: len(self._commands(b'FIN')) == 100)
+        task.cancel()
+
+    @run_until_complete
+    async def test_consume_sync_handler(self):
+        self.nsqd.put('foo', b'ok', b'fail', b'raise')
+        reader = await self._reader()
+        handled = []
+
+        def handler(msg):
+            handled.append(msg.body)
+            if msg.body == b'raise':
+                raise ValueError(msg.body)
+            return msg.body == b'ok'
+
+        task = self.loop.create_task(
+            reader.consume(handler, requeue_delay=0))
+        await self._wait_for(lambda: len(self._commands(b'REQ')) >= 4)
+        self.assertEqual(len(self._commands(b'FIN')), 1)
+        self.assertIn(b'fail', handled[3:])
+        self.assertEqual(self._commands(b'REQ')[0][1], b'0')
+        task.cancel()
+
+    @run_until_complete
+    async def test_handler_acks_itself(self):
+        self.nsqd.put('foo', b'msg')
+        reader = await self._reader()
+        handled = self.loop.create_future()
+
+        async def handler(msg):
+            await msg.req(0)
+            handled.set_result(msg)
+
+        task = self.loop.create_task(reader.consume(handler))
+        await handled
+        await self._wait_for(lambda: self._commands(b'REQ'))
+        self.assertEqual(self._commands(b'FIN'), [])
+        task.cancel()
+
+    @run_until_complete
+    async def test_pending_back_to_queue(self):
+        self.nsqd.put('foo', *[b'msg'] * 5)
+        reader = await self._reader(max_in_flight=5)
+        block = self.loop.create_future()
+
+        async def handler(msg):
+            await block
+
+        task = self.loop.create_task(reader.consume(handler))
+        await self._wait_for(
+            lambda: reader._dispatcher and reader._dispatcher.pending == 4)
+        task.cancel()
+        block.set_result(None)
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(reader._queue.qsize(), 4)
+        # handler that was running when consume() stopped still completes
+        await self._wait_for(lambda: len(self._commands(b'FIN')) == 1)
+
+    @run_until_complete
+    async def test_messages_batch(self):
+        bodies = [str(i).encode('utf-8') for i in range(25)]
+        self.nsqd.put('foo', *bodies)
+        # max in flight is raised to the batch size
+        reader = await self._reader(max_in_flight=5)
+        batches = reader.messages_batch(10, max_wait=0.05)
+        sizes, received = [], []
+        async for batch in batches:
+            sizes.append(len(batch))
+            received.extend(msg.body for msg in batch)
+            batch.fin_all()
+            self.assertTrue(all(msg.processed for msg in batch))
+            if len(received) == len(bodies):
+                break
+        await batches.aclose()
+        self.assertEqual(sizes, [10, 10, 5])
+        self.assertEqual(sorted(received), sorted(bodies))
+        await self._wait_for(lambda: len(self._commands(b'FIN')) == 25)
+        self.assertFalse(any(c.in_flight for c in self.nsqd.clients))
+
+    @run_until_complete
+    async def test_messages_batch_max_bytes(self):
+        self.nsqd.put('foo', *[b'x' * 10] * 5)
+        reader = await self._reader()
+        batches = reader.messages_batch(10, max_bytes=25, max_wait=0.05)
+        batch = await batches.__anext__()
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(batch.nbytes, 20)
+        batch[0].fin()
+        # skips the message finished on its own
+        batch.req_all(timeout=60000)
+        await self._wait_for(lambda: len(self._commands(b'REQ')) == 1)
+        self.assertEqual(self._commands(b'REQ')[0][1], b'60000')
+        self.assertEqual(len(self._commands(b'FIN')), 1)
+        await batches.aclose()
+        # carried over message is back in the queue
+        self.assertEqual(reader._queue.qsize(), 3)
+
+    @run_until_complete
+    async def test_backoff_on_failure(self):
+        self.nsqd.put('foo', b'fail')
+        reader = await self._reader(max_in_flight=10)
+        task = self.loop.create_task(reader.consume(lambda msg: False))
+        await self._wait_for(lambda: self._commands(b'REQ'))
+        self.assertTrue(reader.stats['rdy']['backoff']['in_backoff'])
+        await self._wait_for(lambda: self._commands(b'RDY')[-1] == [b'0'])
+        task.cancel()
+
+    @run_until_complete
+    async def test_rdy_capped_by_max_rdy_count(self):
+        self.nsqd.identify_response['max_rdy_count'] = 5
+        self.nsqd.put('foo', *[b'msg'] * 20)
+        reader = await self._reader(max_in_flight=100)
+        task = self.loop.create_task(reader.consume(lambda msg: True))
+        await self._wait_for(lambda: len(self._commands(b'FIN')) == 20)
+        rdy = [int(params[0]) for params in self._commands(b'RDY')]
+        self.assertEqual(max(rdy), 5)
+        task.cancel()
+
+    @run_until_complete
+    async def test_auto_touch(self):
+        self.nsqd.identify_response.update(msg_timeout=300,
+                                           max_msg_timeout=1000)
+        self.nsqd.put('foo', b'slow')
+        reader = await self._reader(auto_touch=True)
+
+        async def handler(msg):
+            await asyncio.sleep(0.8)
+
+        task = self.loop.create_task(reader.consume(handler))
+        await self._wait_for(lambda: self._commands(b'FIN'))
+        # touched about every 270ms while the slow handler runs
+        touches = self._commands(b'TOUCH')
+        self.assertIn(len(touches), (2, 3))
+        self.assertEqual(reader.stats['touches'], len(touches))
+        await asyncio.sleep(0.4)
+        self.assertEqual(len(self._commands(b'TOUCH')), len(touches))
+        task.cancel()
+
+    @run_until_complete
+    async def test_auto_touch_max_msg_timeout(self):
+        self.nsqd.identify_response.update(msg_timeout=300,
+                                           max_msg_timeout=500)
+        self.nsqd.put('foo', b'slow')
+        reader = await self._reader(auto_touch=True)
+
+        async def handler(msg):
+            await asyncio.sleep(1.2)
+
+        task = self.loop.create_task(reader.consume(handler))
+        await self._wait_for(lambda: self._commands(b'FIN'))
+        # no TOUCH past max_msg_timeout, nsqd would not extend it
+        self.assertEqual(len(self._commands(b'TOUCH')), 1)
+        task.cancel()
+
+    @run_until_complete
+    async def test_dead_letter(self):
+        self.nsqd.put('foo', b'poison', b'ok')
+        reader = await self._reader(max_attempts=3,
+                                    dead_letter_topic='foo_dlq')
+        handled = []
+
+        async def handler(msg):
+            handled.append(msg.body)
+            if msg.body == b'poison':
+                msg.req(0, backoff=False)
+
+        task = self.loop.create_task(reader.consume(handler))
+        await self._wait_for(lambda: self.nsqd.published['foo_dlq'])
+        await self._wait_for(lambda: not self.nsqd.topics['foo'])
+        # the hot requeue loop is cut off after max_attempts deliveries
+        self.assertEqual(handled.count(b'poison'), 3)
+        self.assertEqual(handled.count(b'ok'), 1)
+        self.assertEqual(self.nsqd.published['foo_dlq'], [b'poison'])
+        await self._wait_for(lambda: len(self._commands(b'FIN')) == 2)
+        self.assertEqual(reader.stats['dead_letter'],
+                         {'published': 1, 'dropped': 0, 'failed': 0})
+        task.cancel()
+        reader._close_dead_letter_writers()
+
+    @run_until_complete
+    async def test_max_attempts_without_dead_letter_topic(self):
+        self.nsqd.put('foo', b'poison')
+        reader = await self._reader(max_attempts=2)
+        handled = []
+
+        def handler(msg):
+            handled.append(msg.body)
+            msg.req(0, backoff=False)
+
+        task = self.loop.create_task(reader.consume(handler))
+        await self._wait_for(lambda: self._commands(b'FIN'))
+        self.assertEqual(handled, [b'poison'] * 2)
+        self.assertEqual(reader.stats['dead_letter']['dropped'], 1)
+        task.cancel()
+
+    @run_until_complete
+    async def test_consume_keyed(self):
+        bodies = ['{}:{}'.format(key, i).encode('utf-8')
+                  for i in range(20) for key in 'abcd']
+        self.nsqd.put('foo', *bodies)
+        reader = await self._reader(max_in_flight=20)
+        handled, running = [], set()
+        overlap = []
+
+        async def handler(msg):
+            key = msg.body.split(b':')[0]
+            self.assertNotIn(key, running)
+            running.add(key)
+            overlap.append(len(running))
+            await asyncio.sleep(0.001 * (ord(key) % 3))
+            running.discard(key)
+            handled.append(msg.body)
+
+        task = self.loop.create_task(reader.consume(
+            handler, concurrency=4, key=lambda msg: msg.body.split(b':')[0]))
+        await self._wait_for(lambda: len(handled) == len(bodies))
+        for key in 'abcd':
+            prefix = key.encode('utf-8') + b':'
+            self.assertEqual([b for b in handled if b.startswith(prefix)],
+                             [b for b in bodies if b.startswith(prefix)])
+        # keys ran in parallel
+        self.assertGreater(max(overlap), 1)
+        stats = reader.stats['dispatcher']
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['lanes'], 0)
+        task.cancel()
+
+    @run_until_complete
+    async def test_consume_keyed_backpressure(self):
+        self.nsqd.put('foo', *[b'hot'] * 30)
+        reader = await self._reader(max_in_flight=10)
+        release = asyncio.Event()
+        handled = []
+
+        async def handler(msg):
+            await release.wait()
+            handled.append(msg.body)
+
+        task = self.loop.create_task(reader.consume(
+            handler, concurrency=4, key=lambda msg: msg.body, lane_size=4))
+        await asyncio.sleep(0)
+        await self._wait_for(lambda: reader.stats['dispatcher']['full'])
+        await self._wait_for(
+            lambda: self._commands(b'RDY')[-1] == [b'0'])
+        self.assertEqual(reader.stats['rdy']['paused'], ['lanes'])
+        release.set()
+        await self._wait_for(lambda: len(handled) == 30)
+        self.assertEqual(reader.stats['rdy']['paused'], [])
+        self.assertGreaterEqual(reader.stats['dispatcher']['pauses'], 1)
+        self.assertGreaterEqual(reader.stats['dispatcher']['max_depth'], 4)
+        task.cancel()
+
+    @run_until_complete
+    async def test_adaptive_max_in_flight(self):
+        self.nsqd.put('foo', *[b'msg'] * 5000)
+        reader = await self._reader(max_in_flight=1, adaptive=True,
+                                    max_in_flight_limit=50)
+
+        async def handler(msg):
+            await asyncio.sleep(0.001)
+
+        task = self.loop.create_task(reader.consume(handler, concurrency=20))
+        # saturated and well under the queue wait target, it grows
+        await self._wait_for(lambda: reader.stats['max_in_flight'] > 1,
+                             timeout=3)
+        stats = reader.stats['adaptive']
+        self.assertEqual(stats['budget'], reader.stats['max_in_flight'])
+        self.assertEqual(stats['increases'], 1)
+        self.assertGreater(stats['rate'], 0)
+        # the new RDY is still on its way to nsqd
+        await self._wait_for(lambda: max(
+            int(params[0]) for params in self._commands(b'RDY')) > 1)
+        task.cancel()
+
+    @run_until_complete
+    async def test_queue_backpressure(self):
+        self.nsqd.put('foo', *[b'x' * 1000] * 30)
+        reader = await self._reader(max_in_flight=20, max_queue_bytes=5000)
+        # nobody reads, the queue fills up and RDY goes to 0
+        await self._wait_for(lambda: reader.stats['queue']['full'])
+        await self._wait_for(
+            lambda: self._commands(b'RDY')[-1] == [b'0'])
+        self.assertEqual(reader.stats['rdy']['paused'], ['queue'])
+        # what was in flight arrived, nothing more until drained
+        await asyncio.sleep(0.1)
+        self.assertLessEqual(reader.stats['queue']['depth'], 20)
+        self.assertEqual(reader.stats['queue']['depth'],
+                         reader.stats['rdy']['messages'])
+        received = []
+        async for msg in reader.messages():
+            received.append(msg)
+            await msg.fin()
+            if len(received) == 30:
+                break
+        stats = reader.stats['queue']
+        self.assertLessEqual(stats['max_bytes'], 20 * 1000)
+        self.assertEqual(stats['bytes'], 0)
+        self.assertGreaterEqual(stats['pauses'], 1)
+        self.assertEqual(reader.stats['rdy']['paused'], [])
+
+    @run_until_complete
+    async def test_close_drains_in_flight(self):
+        self.nsqd.put('foo', *[b'msg'] * 10)
+        reader = await self._reader(max_in_flight=10)
+        handled = []
+
+        async def handler(msg):
+            await asyncio.sleep(0.05)
+            handled.append(msg)
+
+        task = self.loop.create_task(reader.consume(handler, concurrency=2))
+        await self._wait_for(lambda: reader.stats['rdy']['messages'] == 10)
+        stats = await reader.close(drain_timeout=2)
+        # handlers kept running until all messages were finished
+        self.assertEqual(len(handled), 10)
+        self.assertEqual(len(self._commands(b'FIN')), 10)
+        self.assertEqual(stats['requeued'], 0)
+        self.assertEqual(stats['abandoned'], 0)
+        self.assertLess(stats['time'], 2)
+        self.assertEqual(reader.stats['drain'], stats)
+        self.assertEqual(self._commands(b'RDY')[-1], [b'0'])
+        self.assertEqual(len(self._commands(b'CLS')), 1)
+        self.assertEqual(reader.stats['connections'], 0)
+        await task
+
+    @run_until_complete
+    async def test_close_requeues_leftovers(self):
+        self.nsqd.put('foo', *[b'msg'] * 5)
+        reader = await self._reader(max_in_flight=5)
+        await self._wait_for(lambda: reader._queue.qsize() == 5)
+        # nobody reads the queue
+        stats = await reader.close(drain_timeout=0.1)
+        self.assertEqual(stats['requeued'], 5)
+        self.assertEqual(stats['abandoned'], 0)
+        self.assertGreaterEqual(stats['time'], 0.1)
+        await self._wait_for(lambda: len(self._commands(b'REQ')) == 5)
+        self.assertEqual([params[1] for params in self._commands(b'REQ')],
+                         [b'0'] * 5)
+        self.assertEqual(reader._queue.qsize(), 0)
+
+    @run_until_complete
+    async def test_close_abandons_stuck_handler(self):
+        self.nsqd.put('foo', *[b'msg'] * 5)
+        reader = await self._reader(max_in_flight=5)
+        block = self.loop.create_future()
+
+        async def handler(msg):
+            await block
+
+        task = self.loop.create_task(reader.consume(handler))
+        await self._wait_for(
+            lambda: reader._dispatcher and reader._dispatcher.pending == 4)
+        stats = await reader.close(drain_timeout=0.1)
+        self.assertEqual(stats['requeued'], 4)
+        self.assertEqual(stats['abandoned'], 1)
+        await self._wait_for(lambda: len(self._commands(b'REQ')) == 4)
+        self.assertEqual(self._commands(b'FIN'), [])
+        block.set_result(None)
+        await task
+
+    @run_until_complete
+    async def test_stop_twice(self):
+        reader = await self._reader()
+        task = self.loop.create_task(reader.consume(lambda msg: None))
+        await asyncio.sleep(0)
+        reader.stop()
+        reader.stop()
+        await task
+
+        reader = await self._reader()
+        task = self.loop.create_task(reader.consume(lambda msg: None))
+        await asyncio.sleep(0)
+        await reader.close(drain_timeout=0.1)
+        reader.stop()
+        await task
+
+    @run_until_complete
+    async def test_stop_in_running_loop(self):
+        self.nsqd.put('foo', b'msg')
+        reader = await self._reader()
+        await self._wait_for(lambda: reader._queue.qsize() == 1)
+        reader.stop()
+        self.assertEqual(reader.stats['connections'], 0)
+        await asyncio.sleep(0)
+
+
+class NodesTest(FakeNsqdTest):
+
+    nodes_count = 3
+
+    async def _reader(self, **kwargs):
+        addresses = [(nsqd.host, nsqd.port) for nsqd in self.nodes]
+        reader = Reader(nsqd_tcp_addresses=addresses, loop=self.loop,
+                        **kwargs)
+        await reader.connect()
+        return reader
+
+
+class ReaderConnectTest(NodesTest):
+
+    @run_until_complete
+    async def test_connect_all_nodes(self):
+        reader = await self._reader()
+        self.assertEqual(reader.stats['connections'], 3)
+        await reader.subscribe('foo', 'bar')
+        for nsqd in self.nodes:
+            self.assertIn((b'SUB', [b'foo', b'bar']), nsqd.commands)
+            self.assertEqual(nsqd.commands.count((b'SUB', [b'foo', b'bar'])),
+                             1)
+
+    @run_until_complete
+    async def test_partial_success(self):
+        slow = self.nodes[0]
+        slow.identify_delay = 10
+        start = self.loop.time()
+        reader = await self._reader(identify_timeout=0.2)
+        self.assertLess(self.loop.time() - start, 1)
+        self.assertEqual(reader.stats['connections'], 2)
+        self.assertEqual(reader.stats['connecting'], 1)
+        await reader.subscribe('foo', 'bar')
+        for nsqd in self.nodes:
+            nsqd.put('foo', nsqd.address.encode('utf-8'))
+        received = {(await reader._queue.get()).body for _ in range(2)}
+        self.assertNotIn(slow.address.encode('utf-8'), received)
+
+        # node comes back, the retry connects and subscribes to it
+        slow.identify_delay = 0
+        msg = await asyncio.wait_for(reader._queue.get(), 5)
+        self.assertEqual(msg.body, slow.address.encode('utf-8'))
+        self.assertEqual(reader.stats['connections'], 3)
+        self.assertEqual(reader.stats['connecting'], 0)
+
+    @run_until_complete
+    async def test_unexpected_error_on_one_node(self):
+        addresses = [(nsqd.host, nsqd.port) for nsqd in self.nodes]
+        reader = Reader(nsqd_tcp_addresses=addresses, loop=self.loop)
+        prepare_conn, broken, failures = (
+            reader.prepare_conn, self.nodes[0].port, [])
+
+        async def failing_prepare_conn(conn):
+            if conn._port == broken and not failures:
+                failures.append(1)
+                raise ValueError('bug')
+            await prepare_conn(conn)
+        reader.prepare_conn = failing_prepare_conn
+        await reader.connect()
+        self.assertEqual(reader.stats['connections'], 2)
+        self.assertEqual(reader.stats['connecting'], 1)
+        # retried like any other failure
+        await self._wait_for(lambda: reader.stats['connections'] == 3)
+        reader.stop()
+
+
+class ReaderLookupdTest(FakeNsqdTest):
+
+    nodes_count = 3
+
+    def setUp(self):
+        super().setUp()
+        self.lookupds = [FakeLookupd(), FakeLookupd()]
+        for lookupd in self.lookupds:
+            self.loop.run_until_complete(lookupd.start())
+
+    def tearDown(self):
+        for lookupd in self.lookupds:
+            self.loop.run_until_complete(lookupd.stop())
+        super().tearDown()
+
+    async def _reader(self, **kwargs):
+        reader = Reader(
+            lookupd_http_addresses=[lookupd.address
+                                    for lookupd in self.lookupds],
+            loop=self.loop, lookupd_poll_interval=0.05, **kwargs)
+        await reader.connect()
+        await reader.subscribe('foo', 'bar')
+        return reader
+
+    async def _close(self, reader):
+        for task in (reader._lookupd_task, reader._redistribute_task):
+            task.cancel()
+        await reader._close_lookupd()
+        for conn in list(reader._connections.values()):
+            conn.close()
+
+    def _endpoints(self, reader):
+        return sorted(reader._connections)
+
+    def _addresses(self, *nodes):
+        return sorted('tcp://' + nsqd.address for nsqd in nodes)
+
+    @run_until_complete
+    async def test_merge_producers(self):
+        a, b, c = self.nodes
+        first, second = self.lookupds
+        first.producers = [(a.host, a.port), (b.host, b.port)]
+        second.producers = [(b.host, b.port)]
+        reader = await self._reader()
+        self.assertEqual(self._endpoints(reader), self._addresses(a, b))
+        self.assertEqual((first.requests, second.requests), (1, 1))
+
+        # new node shows up in one of lookupd
+        second.producers.append((c.host, c.port))
+        await self._wait_for(
+            lambda: self._endpoints(reader) == self._addresses(a, b, c))
+        for nsqd in self.nodes:
+            self.assertEqual(
+                nsqd.commands.count((b'SUB', [b'foo', b'bar'])), 1)
+
+        # node left the topic, it is drained and closed
+        first.producers = []
+        second.producers = [(c.host, c.port)]
+        await self._wait_for(
+            lambda: self._endpoints(reader) == self._addresses(c))
+        await self._wait_for(lambda: not a.clients and not b.clients)
+        for nsqd in (a, b):
+            self.assertEqual(nsqd.commands[-2:],
+                             [(b'RDY', [b'0']), (b'CLS', [])])
+        await self._close(reader)
+
+    @run_until_complete
+    async def test_close_cancels_drain_of_left_node(self):
+        a, b, _ = self.nodes
+        first, second = self.lookupds
+        first.producers = [(a.host, a.port)]
+        second.producers = [(b.host, b.port)]
+        a.put('foo', b'msg')
+        reader = await self._reader()
+        await self._wait_for(lambda: reader._queue.qsize() == 1)
+        # the message is never finished, the drain waits for it
+        first.producers = []
+        await self._wait_for(
+            lambda: self._endpoints(reader) == self._addresses(b))
+        self.assertEqual(len(reader._drain_tasks), 1)
+        await reader.close(drain_timeout=0.1)
+        self.assertEqual(reader._drain_tasks, set())
+        await self._wait_for(lambda: not a.clients)
+
+    @run_until_complete
+    async def test_first_rdy_capped_by_queue_bytes(self):
+        a, b, _ = self.nodes
+        first, second = self.lookupds
+        first.producers = [(a.host, a.port)]
+        second.producers = [(b.host, b.port)]
+        reader = await self._reader(max_in_flight=100, max_queue_bytes=5000)
+        self.assertEqual(self._endpoints(reader), self._addresses(a, b))
+        # message size is not known yet, RDY 1 per node
+        for nsqd in (a, b):
+            await self._wait_for(
+                lambda: any(cmd == b'RDY' for cmd, _ in nsqd.commands))
+            rdy = [params for cmd, params in nsqd.commands if cmd == b'RDY']
+            self.assertEqual(rdy[0], [b'1'])
+        await self._close(reader)
+
+    @run_until_complete
+    async def test_failing_lookupd(self):
+        a, b, c = self.nodes
+        first, second = self.lookupds
+        first.producers = [(a.host, a.port)]
+        second.producers = [(b.host, b.port)]
+        reader = await self._reader(lookupd_cache_ttl=0.5)
+        self.assertEqual(self._endpoints(reader), self._addresses(a, b))
+
+        # last response is used until it expires
+        first.failing = True
+        requests = first.requests
+        await self._wait_for(lambda: first.requests > requests + 2)
+        self.assertEqual(self._endpoints(reader), self._addresses(a, b))
+        await self._wait_for(
+            lambda: self._endpoints(reader) == self._addresses(b))
+
+        # all lookupd down, connections are kept
+        second.failing = True
+        await asyncio.sleep(1)
+        self.assertEqual(self._endpoints(reader), self._addresses(b))
+
+        first.failing = second.failing = False
+        await self._wait_for(
+            lambda: self._endpoints(reader) == self._addresses(a, b))
+        await self._close(reader)
+
+
+class ReaderReconnectTest(NodesTest):
+
+    nodes_count = 4
+
+    async def _receive(self, reader, nodes, timeout=5):
+        for nsqd in nodes:
+            nsqd.put('foo', nsqd.address.encode('utf-8'))
+        expected = {nsqd.address.encode('utf-8') for nsqd in nodes}
+        received = set()
+        while received != expected:
+            msg = await asyncio.wait_for(reader._queue.get(), timeout)
+            await msg.fin()
+            received.add(msg.body)
+
+    @run_until_complete
+    async def test_half_of_nodes_flapping(self):
+        reader = await self._reader()
+        await reader.subscribe('foo', 'bar')
+        flapping, healthy = self.nodes[:2], self.nodes[2:]
+        await self._receive(reader, self.nodes)
+
+        for _ in range(2):
+            for nsqd in flapping:
+                await nsqd.stop()
+            await self._wait_for(lambda: reader.stats['connections'] == 2,
+                                 timeout=5)
+            # the others are not held back by the dead nodes
+            await self._receive(reader, healthy, timeout=1)
+            await asyncio.sleep(0.3)
+            start = self.loop.time()
+            for nsqd in flapping:
+                await nsqd.start()
+            await self._wait_for(lambda: reader.stats['connections'] == 4,
+                                 timeout=5)
+            recovery = self.loop.time() - start
+            self.assertLess(recovery, 2)
+            # subscribed again and got RDY back
+            await self._receive(reader, self.nodes)
+
+        stats = reader.stats['nodes']
+        for nsqd in flapping:
+            node = stats['tcp://' + nsqd.address]
+            self.assertEqual(node['reconnects'], 2)
+            self.assertTrue(node['connected'])
+            self.assertGreater(node['downtime'], 0.6)
+        for nsqd in healthy:
+            self.assertNotIn('tcp://' + nsqd.address, stats)
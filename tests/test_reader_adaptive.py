@@ -0,0 +1,99 @@
+import unittest
+from collections import deque
+
+from ._rdysim import FakeLoop
+from asyncnsq.tcp.reader_adaptive import AdaptiveInFlight
+
+
+class SimMessage:
+
+    __slots__ = ('_received_at', '_started_at')
+
+    def __init__(self):
+        self._received_at = self._started_at = None
+
+
+class SimRdyControl:
+
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+
+    def set_max_in_flight(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+
+
+class WorkerSimulation:
+    """Endless backlog handled by ``workers`` handlers taking ``latency``
+    seconds each, nsqd keeps max in flight messages delivered."""
+
+    def __init__(self, workers, latency, budget=1, step=0.002, **kwargs):
+        self.loop = FakeLoop()
+        self.rdy_control = SimRdyControl(budget)
+        self.in_flight = 0
+        self.adaptive = AdaptiveInFlight(
+            self.rdy_control, lambda: self.in_flight, self.loop, **kwargs)
+        self.workers = workers
+        self.latency = latency
+        self.step = step
+        self.queue = deque()
+        self.running = deque()
+        self.done = 0
+        self.budgets = []
+
+    def run(self, seconds):
+        self.adaptive.start()
+        end = self.loop.now + seconds
+        while self.loop.now < end:
+            self.loop.advance(self.step)
+            now = self.loop.now
+            while self.running and self.running[0][0] <= now:
+                msg = self.running.popleft()[1]
+                self.in_flight -= 1
+                self.done += 1
+                self.adaptive.message_done(msg)
+            while self.in_flight < self.rdy_control.max_in_flight:
+                msg = SimMessage()
+                self.in_flight += 1
+                self.adaptive.message_received(msg)
+                self.queue.append(msg)
+            while self.queue and len(self.running) < self.workers:
+                msg = self.queue.popleft()
+                self.adaptive.message_started(msg)
+                self.running.append((now + self.latency, msg))
+            self.budgets.append(self.rdy_control.max_in_flight)
+        return self
+
+
+class AdaptiveInFlightTest(unittest.TestCase):
+
+    def test_aimd(self):
+        # 10 workers of 20ms: 500 msgs/sec, with N messages in flight
+        # they wait (N - 10) * 2ms, 50ms at 35
+        sim = WorkerSimulation(10, 0.02, target_queue_wait=0.05)
+        sim.run(30)
+        stats = sim.adaptive.stats
+        # grew from 1 past the workers, cut when the queue got long
+        self.assertGreater(max(sim.budgets), 30)
+        self.assertGreater(stats['increases'], 5)
+        self.assertGreater(stats['decreases'], 0)
+        settled = sim.budgets[len(sim.budgets) // 2:]
+        self.assertLessEqual(max(settled), 45)
+        self.assertGreaterEqual(min(settled), 10)
+        self.assertGreater(stats['rate'], 400)
+        self.assertEqual(stats['budget'], sim.rdy_control.max_in_flight)
+
+    def test_bounds(self):
+        sim = WorkerSimulation(10, 0.02, budget=4, min_in_flight=4,
+                               max_in_flight=8, target_queue_wait=10)
+        sim.run(10)
+        self.assertEqual(max(sim.budgets), 8)
+        self.assertEqual(min(sim.budgets), 4)
+
+    def test_target_latency(self):
+        # handlers slower than the target, cut down to the minimum
+        sim = WorkerSimulation(100, 0.5, budget=100, min_in_flight=2,
+                               target_latency=0.2)
+        sim.run(10)
+        self.assertEqual(sim.rdy_control.max_in_flight, 2)
+        self.assertAlmostEqual(sim.adaptive.stats['latency'], 0.5,
+                               delta=0.01)
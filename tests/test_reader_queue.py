@@ -0,0 +1,57 @@
+import unittest
+
+from asyncnsq.tcp.reader_queue import MessageQueue
+
+
+class Message:
+
+    def __init__(self, size):
+        self.body = b'x' * size
+
+
+class MessageQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+
+    def _queue(self, **kwargs):
+        return MessageQueue(on_full=lambda: self.events.append('full'),
+                            on_drained=lambda: self.events.append('drained'),
+                            **kwargs)
+
+    def test_max_bytes(self):
+        queue = self._queue(max_bytes=1000)
+        for _ in range(3):
+            queue.put_nowait(Message(300))
+        self.assertEqual(self.events, [])
+        queue.put_nowait(Message(300))
+        # never refused, messages in flight still arrive
+        queue.put_nowait(Message(300))
+        self.assertEqual(self.events, ['full'])
+        self.assertEqual(queue.nbytes, 1500)
+        for _ in range(3):
+            queue.get_nowait()
+        self.assertTrue(queue.is_full)
+        # low water is half the limit
+        queue.get_nowait()
+        self.assertEqual(self.events, ['full', 'drained'])
+        self.assertEqual(queue.stats, {
+            'depth': 1, 'bytes': 300, 'max_depth': 5, 'max_bytes': 1500,
+            'full': False, 'pauses': 1})
+
+    def test_max_count(self):
+        queue = self._queue(max_count=4, max_bytes=10 ** 6)
+        for _ in range(4):
+            queue.put_nowait(Message(1))
+        self.assertEqual(self.events, ['full'])
+        queue.get_nowait()
+        self.assertEqual(self.events, ['full'])
+        queue.get_nowait()
+        self.assertEqual(self.events, ['full', 'drained'])
+
+    def test_unbounded(self):
+        queue = self._queue()
+        for _ in range(1000):
+            queue.put_nowait(Message(1000))
+        self.assertEqual(self.events, [])
+        self.assertEqual(queue.nbytes, 10 ** 6)
@@ -0,0 +1,71 @@
+import unittest
+
+from ._rdysim import FakeLoop
+from asyncnsq.tcp.timer_wheel import TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.wheel = TimerWheel(self.loop, tick=0.1, slots=8)
+        self.fired = []
+
+    def _run(self, seconds, step=0.01):
+        for _ in range(int(round(seconds / step))):
+            self.loop.advance(step)
+
+    def _fire(self, name):
+        self.fired.append((name, self.loop.time()))
+
+    def test_fire_within_a_tick(self):
+        for delay in (0.05, 0.1, 0.35, 1.0, 2.5):
+            self.wheel.call_later(delay, self._fire, delay)
+        self._run(3)
+        self.assertEqual([name for name, _ in self.fired],
+                         [0.05, 0.1, 0.35, 1.0, 2.5])
+        for delay, at in self.fired:
+            # never early, at most one tick late
+            self.assertGreaterEqual(at, delay - 1e-9)
+            self.assertLessEqual(at, delay + 0.1 + 1e-9)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancel(self):
+        timer = self.wheel.call_later(0.5, self._fire, 'cancelled')
+        self.wheel.call_later(0.5, self._fire, 'kept')
+        timer.cancel()
+        self.assertFalse(timer.active)
+        self.assertEqual(len(self.wheel), 1)
+        self._run(1)
+        self.assertEqual([name for name, _ in self.fired], ['kept'])
+
+    def test_single_loop_timer(self):
+        for i in range(10000):
+            self.wheel.call_later(i % 300 / 100, self._fire, i)
+        # one pending call_later whatever the number of timers
+        self.assertEqual(len(self.loop._timers), 1)
+        self._run(3.2)
+        self.assertEqual(len(self.fired), 10000)
+        # idle wheel does not wake up
+        self._run(1)
+        self.assertFalse([t for t in self.loop._timers
+                          if not t[2].cancelled])
+
+    def test_reschedule_from_callback(self):
+        def again(count):
+            self._fire(count)
+            if count:
+                self.wheel.call_later(0, again, count - 1)
+        self.wheel.call_later(0.2, again, 3)
+        self._run(1)
+        self.assertEqual([name for name, _ in self.fired], [3, 2, 1, 0])
+        # a timer scheduled while firing goes to the next tick
+        ticks = [round(at, 2) for _, at in self.fired]
+        self.assertEqual(ticks, sorted(set(ticks)))
+
+    def test_after_idle(self):
+        self.wheel.call_later(0.1, self._fire, 'first')
+        self._run(10)
+        self.wheel.call_later(0.3, self._fire, 'second')
+        self._run(1)
+        self.assertAlmostEqual(self.fired[1][1], 10.4, delta=0.11)
@@ -0,0 +1,177 @@
+import asyncio
+
+from ._testutils import run_until_complete, FakeNsqdTest
+from asyncnsq.tcp.connection import create_connection
+from asyncnsq.tcp.exceptions import NSQBadBody, NSQCommandTimeout
+from asyncnsq.tcp.protocol import Reader, SnappyReader, DeflateReader
+
+
+class BufferedConnectionTest(FakeNsqdTest):
+
+    buffered = True
+
+    async def _connect(self, **kwargs):
+        conn = await create_connection(self.nsqd.host, self.nsqd.port,
+                                       loop=self.loop, buffered=self.buffered,
+                                       **kwargs)
+        self.assertEqual(self.buffered, conn._protocol is not None)
+        return conn
+
+    async def _pub_sub_rdy_fin(self, conn):
+        ok = await conn.execute(b'PUB', b'foo', data=b'msg foo')
+        self.assertEqual(ok, b'OK')
+        await conn.execute(b'SUB', b'foo', b'bar')
+        await conn.execute(b'RDY', 1)
+        msg = await conn.queue.get()
+        self.assertEqual(msg.body, b'msg foo')
+        self.assertEqual(msg.processed, False)
+        await msg.fin()
+        self.assertEqual(msg.processed, True)
+        resp = await conn.execute(b'CLS')
+        self.assertEqual(resp, b'CLOSE_WAIT')
+
+    @run_until_complete
+    async def test_plain(self):
+        conn = await self._connect()
+        await conn.identify(feature_negotiation=True)
+        self.assertIsInstance(conn._parser, Reader)
+        await self._pub_sub_rdy_fin(conn)
+        conn.close()
+        self.assertTrue(conn.closed)
+
+    @run_until_complete
+    async def test_snappy(self):
+        conn = await self._connect()
+        await conn.identify(feature_negotiation=True, snappy=True)
+        self.assertIsInstance(conn._parser, SnappyReader)
+        await self._pub_sub_rdy_fin(conn)
+        conn.close()
+
+    @run_until_complete
+    async def test_deflate(self):
+        conn = await self._connect()
+        await conn.identify(feature_negotiation=True, deflate=True)
+        self.assertIsInstance(conn._parser, DeflateReader)
+        await self._pub_sub_rdy_fin(conn)
+        conn.close()
+
+    @run_until_complete
+    async def test_many_frames_in_one_read(self):
+        conn = await self._connect()
+        await conn.identify(feature_negotiation=True)
+        bodies = [str(i).encode('utf-8') * 100 for i in range(500)]
+        self.nsqd.put('foo', *bodies)
+        await conn.execute(b'SUB', b'foo', b'bar')
+        await conn.execute(b'RDY', len(bodies))
+        received = [(await conn.queue.get()).body for _ in bodies]
+        self.assertEqual(received, bodies)
+        conn.close()
+
+    @run_until_complete
+    async def test_server_close(self):
+        conn = await self._connect()
+        await self.nsqd.stop()
+        await self._wait_for(lambda: conn.closed)
+
+    @run_until_complete
+    async def test_command_timeout(self):
+        self.nsqd.identify_delay = 1
+        conn = await self._connect(command_timeout=0.2)
+        identify = asyncio.ensure_future(
+            conn.identify(feature_negotiation=True))
+        await asyncio.sleep(0.01)
+        with self.assertRaises(NSQCommandTimeout):
+            # queued behind the late command, fails with it
+            await conn.execute(b'PUB', b'foo', data=b'msg')
+        with self.assertRaises(NSQCommandTimeout):
+            await identify
+        self.assertTrue(conn.closed)
+
+    @run_until_complete
+    async def test_error_frame(self):
+        self.nsqd.max_body_size = 10
+        conn = await self._connect(command_timeout=1)
+        await conn.identify(feature_negotiation=True)
+        with self.assertRaises(NSQBadBody):
+            await conn.execute(b'MPUB', b'foo', data=[b'x' * 100])
+        # FIN of an unknown message fails without a waiter of its own
+        await conn.execute(b'FIN', b'0' * 16)
+        ok = await conn.execute(b'PUB', b'foo', data=b'msg')
+        self.assertEqual(ok, b'OK')
+        self.assertFalse(conn.closed)
+        conn.close()
+
+    @run_until_complete
+    async def test_response_to_no_command(self):
+        conn = await self._connect()
+        await conn.identify(feature_negotiation=True)
+        pub = asyncio.ensure_future(
+            conn.execute(b'PUB', b'foo', data=b'msg'))
+        await asyncio.sleep(0)
+        # responses can not be matched to commands anymore
+        conn._cmd_waiters.clear()
+        await self._wait_for(lambda: conn.closed)
+        self.assertFalse(pub.done())
+        pub.cancel()
+
+
+class StreamConnectionTest(BufferedConnectionTest):
+
+    buffered = False
+
+
+class WriteCoalescingTest(FakeNsqdTest):
+
+    async def _consume(self, conn, count):
+        self.nsqd.put('foo', *[b'msg'] * count)
+        await conn.execute(b'SUB', b'foo', b'bar')
+        await conn.execute(b'RDY', count)
+        return [await conn.queue.get() for _ in range(count)]
+
+    @run_until_complete
+    async def test_fin_in_one_write(self):
+        conn = await create_connection(self.nsqd.host, self.nsqd.port,
+                                       loop=self.loop, write_coalescing=True)
+        await conn.identify(feature_negotiation=True, deflate=True)
+        msgs = await self._consume(conn, 50)
+        flushes = conn.write_stats['flushes']
+        for msg in msgs:
+            await msg.fin()
+        await asyncio.sleep(0.01)
+        stats = conn.write_stats
+        self.assertEqual(stats['flushes'], flushes + 1)
+        # IDENTIFY, SUB and RDY were flushed earlier
+        self.assertEqual(stats['commands'], 3 + 50)
+        client, = self.nsqd.clients
+        self.assertEqual(client.in_flight, {})
+        conn.close()
+
+    @run_until_complete
+    async def test_flush_on_close(self):
+        conn = await create_connection(self.nsqd.host, self.nsqd.port,
+                                       loop=self.loop, write_coalescing=True)
+        await conn.identify(feature_negotiation=True)
+        msgs = await self._consume(conn, 3)
+        for msg in msgs:
+            await msg.fin()
+        self.assertEqual(len(conn._write_buffer), 3)
+        conn.close()
+        self.assertEqual(conn._write_buffer, [])
+        await asyncio.sleep(0.01)
+        fins = [c for c, _ in self.nsqd.commands if c == b'FIN']
+        self.assertEqual(len(fins), 3)
+
+    @run_until_complete
+    async def test_max_bytes(self):
+        conn = await create_connection(self.nsqd.host, self.nsqd.port,
+                                       loop=self.loop, write_coalescing=True,
+                                       coalesce_max_bytes=100)
+        await conn.identify(feature_negotiation=True)
+        msgs = await self._consume(conn, 10)
+        flushes = conn.write_stats['flushes']
+        for msg in msgs:
+            await msg.fin()
+        # FIN command takes 21 bytes
+        self.assertEqual(conn.write_stats['flushes'], flushes + 2)
+        self.assertEqual(len(conn._write_buffer), 0)
+        conn.close()
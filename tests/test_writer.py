@@ -0,0 +1,184 @@
+import asyncio
+import gc
+
+from ._testutils import run_until_complete, FakeNsqdTest
+from asyncnsq.tcp.exceptions import NSQBadMessage, NSQBadBody
+from asyncnsq.tcp.writer import create_writer
+
+
+class WriterBatchingTest(FakeNsqdTest):
+
+    async def _writer(self, **kwargs):
+        return await create_writer(host=self.nsqd.host, port=self.nsqd.port,
+                                   loop=self.loop, batching=True, **kwargs)
+
+    @run_until_complete
+    async def test_coalesce_pub(self):
+        writer = await self._writer(batch_size=10, linger=10)
+        results = await asyncio.gather(
+            *[writer.pub('foo', 'msg{}'.format(i)) for i in range(30)])
+        self.assertEqual(results, [b'OK'] * 30)
+        self.assertEqual(self.nsqd.published['foo'],
+                         [('msg%d' % i).encode() for i in range(30)])
+        self.assertEqual(writer.stats['batching']['batches'], 3)
+        writer.close()
+
+    @run_until_complete
+    async def test_linger(self):
+        writer = await self._writer(linger=0.05)
+        start = self.loop.time()
+        results = await asyncio.gather(writer.pub('foo', b'a'),
+                                       writer.pub('bar', b'b'))
+        self.assertEqual(results, [b'OK', b'OK'])
+        self.assertGreaterEqual(self.loop.time() - start, 0.04)
+        self.assertEqual(writer.stats['batching']['batches'], 2)
+        writer.close()
+
+    @run_until_complete
+    async def test_body_size_limit(self):
+        writer = await self._writer(batch_bytes=10 ** 6, linger=10,
+                                    max_msg_size=100, max_body_size=250)
+        # 4 + 2 * (4 + 100) fits, the third one starts a new batch
+        pubs = [self.loop.create_task(writer.pub('foo', b'x' * 100))
+                for _ in range(5)]
+        await asyncio.sleep(0)
+        with self.assertRaises(NSQBadMessage):
+            await writer.pub('foo', b'x' * 101)
+        await writer.flush()
+        self.assertEqual(await asyncio.gather(*pubs), [b'OK'] * 5)
+        self.assertEqual(len(self.nsqd.published['foo']), 5)
+        self.assertEqual(writer.stats['batching']['batches'], 3)
+        writer.close()
+
+    @run_until_complete
+    async def test_cancelled_pub_is_dropped(self):
+        writer = await self._writer(linger=10)
+        kept = self.loop.create_task(writer.pub('foo', b'kept'))
+        dropped = self.loop.create_task(writer.pub('foo', b'dropped'))
+        await asyncio.sleep(0)
+        dropped.cancel()
+        await asyncio.sleep(0)
+        await writer.flush()
+        self.assertEqual(await kept, b'OK')
+        self.assertEqual(self.nsqd.published['foo'], [b'kept'])
+        writer.close()
+
+    @run_until_complete
+    async def test_close_fails_buffered(self):
+        writer = await self._writer(linger=10)
+        pub = self.loop.create_task(writer.pub('foo', b'msg'))
+        await asyncio.sleep(0)
+        writer.close()
+        with self.assertRaises(ConnectionError):
+            await pub
+
+
+class WriterPipelineTest(FakeNsqdTest):
+
+    async def _writer(self, **kwargs):
+        return await create_writer(host=self.nsqd.host, port=self.nsqd.port,
+                                   loop=self.loop, **kwargs)
+
+    @run_until_complete
+    async def test_publish_stream_window(self):
+        writer = await self._writer(window=8)
+        waiters = writer._conn._cmd_waiters
+        outstanding = []
+
+        async def messages():
+            for i in range(500):
+                outstanding.append(len(waiters))
+                yield str(i).encode()
+
+        self.assertEqual(await writer.publish_stream('foo', messages()), 500)
+        self.assertEqual(self.nsqd.published['foo'],
+                         [str(i).encode() for i in range(500)])
+        self.assertLessEqual(max(outstanding), 8)
+        self.assertGreater(max(outstanding), 1)
+        # plain iterables too, also with batching
+        self.assertEqual(await writer.publish_stream('bar', [b'a', b'b']), 2)
+        writer.close()
+
+        writer = await self._writer(window=8, batching=True, batch_size=4)
+        self.assertEqual(await writer.publish_stream('baz', [b'x'] * 40), 40)
+        self.assertEqual(len(self.nsqd.published['baz']), 40)
+        self.assertEqual(writer.stats['batching']['batches'], 10)
+        writer.close()
+
+    @run_until_complete
+    async def test_pub_pipelined_drain(self):
+        writer = await self._writer()
+        conn = writer._conn
+        conn._protocol.pause_writing()
+        pub = self.loop.create_task(writer.pub_pipelined('foo', b'msg'))
+        await asyncio.sleep(0.01)
+        self.assertFalse(pub.done())
+        conn._protocol.resume_writing()
+        self.assertEqual(await (await pub), b'OK')
+
+        # closing wakes up writers waiting for a drain and the responses
+        conn._protocol.pause_writing()
+        pub = self.loop.create_task(writer.pub_pipelined('foo', b'msg'))
+        await asyncio.sleep(0.01)
+        writer.close()
+        with self.assertRaises(ConnectionError):
+            await pub
+
+
+class WriterLimitsTest(FakeNsqdTest):
+
+    nsqd_options = {'max_body_size': 250}
+
+    @run_until_complete
+    async def test_mpub_split(self):
+        writer = await create_writer(host=self.nsqd.host, port=self.nsqd.port,
+                                     loop=self.loop, max_body_size=250)
+        bodies = [b'%0100d' % i for i in range(9)]
+        self.assertEqual(await writer.mpub('foo', *bodies), b'OK')
+        # 4 + 2 * (4 + 100) bytes fit, three do not
+        mpubs = [cmd for cmd, _ in self.nsqd.commands if cmd == b'MPUB']
+        self.assertEqual(len(mpubs), 5)
+        self.assertEqual(self.nsqd.published['foo'], bodies)
+        with self.assertRaises(NSQBadMessage):
+            await writer.mpub('foo', b'small', b'x' * 243)
+        self.assertEqual(len(self.nsqd.published['foo']), 9)
+        writer.close()
+
+    @run_until_complete
+    async def test_identify_limits(self):
+        self.nsqd.identify_response.update(
+            max_rdy_count=3, msg_timeout=1000, max_msg_timeout=5000)
+        writer = await create_writer(host=self.nsqd.host, port=self.nsqd.port,
+                                     loop=self.loop)
+        conn = writer._conn
+        self.assertEqual(conn.max_rdy_count, 3)
+        self.assertEqual(conn.msg_timeout, 1000)
+        self.assertEqual(conn.max_msg_timeout, 5000)
+        self.assertEqual(conn.server_config['version'], '1.2.0')
+        writer.close()
+        # defaults of nsqd without feature negotiation
+        writer = await create_writer(host=self.nsqd.host, port=self.nsqd.port,
+                                     loop=self.loop,
+                                     feature_negotiation=False)
+        self.assertEqual(writer._conn.max_rdy_count, 2500)
+        self.assertEqual(writer._conn.msg_timeout, 60000)
+        writer.close()
+
+    @run_until_complete
+    async def test_publish_stream_failure(self):
+        errors = []
+        self.loop.set_exception_handler(
+            lambda loop, context: errors.append(context))
+        writer = await create_writer(host=self.nsqd.host, port=self.nsqd.port,
+                                     loop=self.loop, batching=True,
+                                     batch_size=3, window=30)
+        # every batch is over the --max-body-size of nsqd
+        with self.assertRaises(NSQBadBody):
+            await writer.publish_stream('foo', [b'%0100d' % i
+                                                for i in range(30)])
+        # responses of the other batches arrive
+        await asyncio.sleep(0.1)
+        gc.collect()
+        # the other failed publishes were retrieved too
+        self.assertEqual(errors, [])
+        writer.close()
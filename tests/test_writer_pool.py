@@ -0,0 +1,163 @@
+import asyncio
+
+from ._fakelookupd import FakeLookupd
+from ._testutils import run_until_complete, BaseTest, FakeNsqdTest
+from asyncnsq.tcp.exceptions import (
+    NSQNoConnections, NSQBadBody, ProtocolError)
+from asyncnsq.tcp.writer_pool import (
+    create_writer_pool, WriterPool, PoolNode, LEAST_OUTSTANDING, EWMA,
+    CLOSED, OPEN)
+
+
+class WriterPoolTest(FakeNsqdTest):
+
+    nodes_count = 3
+
+    async def _pool(self, **kwargs):
+        return await create_writer_pool(
+            nsqd_tcp_addresses=[nsqd.address for nsqd in self.nodes],
+            loop=self.loop, **kwargs)
+
+    def _published(self):
+        return [len(nsqd.published['foo']) for nsqd in self.nodes]
+
+    @run_until_complete
+    async def test_round_robin(self):
+        pool = await self._pool()
+        for i in range(30):
+            self.assertEqual(await pool.pub('foo', str(i)), b'OK')
+        await pool.mpub('foo', b'a', b'b')
+        await pool.dpub('foo', 1000, b'c')
+        self.assertEqual(sum(self._published()), 33)
+        self.assertTrue(all(count >= 10 for count in self._published()))
+        await pool.close()
+
+    @run_until_complete
+    async def test_failover_and_circuit_breaker(self):
+        pool = await self._pool(failure_threshold=2, reset_timeout=0.3)
+        down = self.nodes[0]
+        endpoint = 'tcp://' + down.address
+        await down.stop()
+        # every publish succeeds on the nodes which are up
+        for i in range(12):
+            self.assertEqual(await pool.pub('foo', str(i)), b'OK')
+        published = self._published()
+        self.assertEqual(published[0], 0)
+        self.assertEqual(sum(published), 12)
+        self.assertTrue(all(published[1:]))
+        stats = pool.stats[endpoint]
+        self.assertEqual(stats['state'], OPEN)
+        self.assertEqual(stats['errors'], 2)
+
+        # node is back, probe closes the circuit
+        await down.start()
+        await asyncio.sleep(0.3)
+        for i in range(6):
+            await pool.pub('foo', str(i))
+        self.assertEqual(pool.stats[endpoint]['state'], CLOSED)
+        self.assertEqual(self._published()[0], 2)
+        await pool.close()
+
+    async def _probing(self):
+        # a pool of a single node due for a probe
+        pool = await create_writer_pool(
+            nsqd_tcp_addresses=[self.nsqd.address], loop=self.loop,
+            reset_timeout=0.3)
+        node = pool._nodes['tcp://' + self.nsqd.address]
+        node.state, node.opened_at = OPEN, self.loop.time() - 1
+        return pool, node
+
+    @run_until_complete
+    async def test_probe_refused_closes_circuit(self):
+        self.nsqd.max_body_size = 10
+        pool, node = await self._probing()
+        with self.assertRaises(NSQBadBody):
+            await pool.mpub('foo', b'x' * 20, b'y')
+        # nsqd answered, the node is healthy
+        self.assertEqual(node.state, CLOSED)
+        self.nsqd.max_body_size = None
+        self.assertEqual(await pool.pub('foo', b'msg'), b'OK')
+        await pool.close()
+
+    @run_until_complete
+    async def test_probe_error_reopens_circuit(self):
+        pool, node = await self._probing()
+
+        async def broken(command, *args, data=None):
+            raise ProtocolError('garbage')
+        execute, node.execute = node.execute, broken
+        start = self.loop.time()
+        with self.assertRaises(ProtocolError):
+            await pool.pub('foo', b'msg')
+        self.assertEqual(node.state, OPEN)
+        self.assertGreaterEqual(node.opened_at, start)
+        # probed again once reset_timeout passed
+        node.execute = execute
+        with self.assertRaises(NSQNoConnections):
+            await pool.pub('foo', b'msg')
+        await asyncio.sleep(0.3)
+        self.assertEqual(await pool.pub('foo', b'msg'), b'OK')
+        self.assertEqual(node.state, CLOSED)
+        await pool.close()
+
+    @run_until_complete
+    async def test_all_nodes_down(self):
+        pool = await self._pool(reset_timeout=10)
+        for nsqd in self.nodes:
+            await nsqd.stop()
+        with self.assertRaises(NSQNoConnections):
+            for _ in range(10):
+                await pool.pub('foo', b'msg')
+        await pool.close()
+
+    @run_until_complete
+    async def test_lookupd_nodes(self):
+        lookupd = await FakeLookupd().start()
+        lookupd.producers = [(n.host, n.port) for n in self.nodes[:2]]
+        pool = await create_writer_pool(
+            lookupd_http_addresses=[lookupd.address], loop=self.loop,
+            lookupd_poll_interval=0.05)
+        self.assertEqual(len(pool.stats), 2)
+        lookupd.producers = [(n.host, n.port) for n in self.nodes[1:]]
+        await self._wait_for(
+            lambda: 'tcp://' + self.nodes[2].address in pool.stats)
+        self.assertEqual(sorted(pool.stats), sorted(
+            'tcp://' + nsqd.address for nsqd in self.nodes[1:]))
+        await pool.close()
+        await lookupd.stop()
+
+
+class WriterPoolStrategyTest(BaseTest):
+
+    def _pool(self, strategy, nodes):
+        pool = WriterPool(strategy=strategy, loop=self.loop)
+        for endpoint, outstanding, latency in nodes:
+            node = PoolNode(None, endpoint)
+            node.outstanding, node.latency = outstanding, latency
+            pool._nodes[endpoint] = node
+        return pool
+
+    def test_least_outstanding(self):
+        pool = self._pool(LEAST_OUTSTANDING, [
+            ('a', 3, None), ('b', 1, None), ('c', 2, None)])
+        self.assertEqual(pool._pick(set()).endpoint, 'b')
+        self.assertEqual(pool._pick({pool._nodes['b']}).endpoint, 'c')
+
+    def test_ewma(self):
+        pool = self._pool(EWMA, [
+            ('a', 0, 0.010), ('b', 0, 0.002), ('c', 0, 0.005)])
+        self.assertEqual(pool._pick(set()).endpoint, 'b')
+        # a busy fast node loses to an idle slower one
+        pool._nodes['b'].outstanding = 4
+        self.assertEqual(pool._pick(set()).endpoint, 'c')
+        # nodes without latency are tried first
+        pool._nodes['a'].latency = None
+        self.assertEqual(pool._pick(set()).endpoint, 'a')
+
+    def test_probe_single_request(self):
+        pool = self._pool(LEAST_OUTSTANDING, [('a', 0, None)])
+        node = pool._nodes['a']
+        node.state, node.opened_at = OPEN, self.loop.time() - 10
+        self.assertIs(pool._pick(set()), node)
+        # half open, no second probe until the first one is done
+        self.assertIsNone(pool._pick(set()))
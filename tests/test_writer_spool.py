@@ -0,0 +1,264 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from ._testutils import run_until_complete, FakeNsqdTest
+from asyncnsq.tcp.exceptions import (
+    NSQException, NSQSpoolFull, NSQBadMessage, NSQBadTopic)
+from asyncnsq.tcp.writer import create_writer
+from asyncnsq.tcp.writer_spool import (
+    Spool, SPOOLED, FSYNC_ALWAYS, OVERFLOW_DROP_NEW, OVERFLOW_DROP_OLDEST)
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.path = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _segments(self):
+        return sorted(n for n in os.listdir(self.path) if n.endswith('.seg'))
+
+    def test_append_peek_ack(self):
+        spool = Spool(self.path, fsync=FSYNC_ALWAYS)
+        for i in range(5):
+            spool.append('foo', 'msg{}'.format(i))
+        spool.append('bar', b'other')
+        spool.append('foo', b'last')
+        self.assertEqual(len(spool), 7)
+        # a batch never mixes topics
+        self.assertEqual(spool.peek(max_count=3),
+                         ('foo', [b'msg0', b'msg1', b'msg2']))
+        spool.ack(3)
+        self.assertEqual(spool.peek(), ('foo', [b'msg3', b'msg4']))
+        spool.ack(2)
+        self.assertEqual(spool.peek(), ('bar', [b'other']))
+        spool.close()
+
+        # the cursor survives a restart
+        spool = Spool(self.path)
+        self.assertEqual(len(spool), 2)
+        self.assertEqual(spool.peek(), ('bar', [b'other']))
+        spool.ack(2)
+        self.assertIsNone(spool.peek())
+        self.assertEqual(spool.stats['replayed'], 2)
+        spool.close()
+
+    def test_segments_truncated(self):
+        spool = Spool(self.path, segment_size=100)
+        # 11 bytes header, 3 bytes topic, 10 bytes body: 4 per segment
+        for i in range(10):
+            spool.append('foo', b'%010d' % i)
+        self.assertEqual(len(self._segments()), 3)
+        spool.ack(5)
+        self.assertEqual(len(self._segments()), 2)
+        spool.ack(5)
+        self.assertEqual(len(self._segments()), 1)
+        self.assertEqual(spool.nbytes, 0)
+        spool.append('foo', b'new')
+        spool.close()
+
+        spool = Spool(self.path, segment_size=100)
+        self.assertEqual(spool.peek(), ('foo', [b'new']))
+        spool.close()
+
+    def test_torn_record(self):
+        spool = Spool(self.path)
+        spool.append('foo', b'one')
+        spool.append('foo', b'two')
+        spool.close()
+        # crash while writing the second record
+        name = os.path.join(self.path, self._segments()[0])
+        with open(name, 'r+b') as f:
+            f.seek(11 + 3 + 3 + 11 + 3)
+            f.write(b'XX')
+        spool = Spool(self.path)
+        self.assertEqual(spool.peek(), ('foo', [b'one']))
+        spool.append('foo', b'three')
+        self.assertEqual(spool.peek(), ('foo', [b'one', b'three']))
+        spool.close()
+
+    def test_overflow(self):
+        # every record takes 11 + 3 + 5 bytes
+        spool = Spool(self.path, max_bytes=19 * 3)
+        for i in range(3):
+            spool.append('foo', b'msg%02d' % i)
+        with self.assertRaises(NSQSpoolFull):
+            spool.append('foo', b'msg03')
+        spool.close()
+
+        spool = Spool(self.path, max_bytes=19 * 3,
+                      overflow=OVERFLOW_DROP_NEW)
+        self.assertFalse(spool.append('foo', b'msg03'))
+        self.assertEqual(spool.peek()[1], [b'msg00', b'msg01', b'msg02'])
+        spool.close()
+
+        spool = Spool(self.path, max_bytes=19 * 3,
+                      overflow=OVERFLOW_DROP_OLDEST)
+        self.assertTrue(spool.append('foo', b'msg03'))
+        self.assertEqual(spool.peek()[1], [b'msg01', b'msg02', b'msg03'])
+        self.assertEqual(spool.stats['dropped'], 1)
+        spool.close()
+
+    def test_peek_record_over_max_bytes(self):
+        spool = Spool(self.path)
+        spool.append('foo', b'x' * 100)
+        spool.append('foo', b'y')
+        # the oldest record alone does not fit
+        self.assertEqual(spool.peek(max_bytes=50), ('foo', []))
+        spool.reject(1)
+        self.assertEqual(spool.peek(max_bytes=50), ('foo', [b'y']))
+        self.assertEqual(spool.stats['rejected'], 1)
+        spool.close()
+
+
+class WriterSpoolTest(FakeNsqdTest):
+
+    def setUp(self):
+        super().setUp()
+        self._tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        super().tearDown()
+        self._tmp.cleanup()
+
+    async def _replayed(self, writer):
+        await self._wait_for(lambda: not writer.stats['spool']['depth'],
+                             timeout=5)
+
+    @run_until_complete
+    async def test_spool_while_nsqd_down(self):
+        writer = await create_writer(host=self.nsqd.host, port=self.nsqd.port,
+                                     loop=self.loop, spool_dir=self._tmp.name)
+        self.assertEqual(await writer.pub('foo', b'0'), b'OK')
+        await self.nsqd.stop()
+        await asyncio.sleep(0.01)
+        for i in range(1, 250):
+            self.assertIn(await writer.pub('foo', str(i)), (b'OK', SPOOLED))
+        self.assertEqual(await writer.mpub('foo', b'250', b'251'), SPOOLED)
+        self.assertGreater(writer.stats['spool']['depth'], 200)
+
+        await self.nsqd.start()
+        await self._replayed(writer)
+        # published in order, in MPUB batches of batch_size
+        self.assertEqual(self.nsqd.published['foo'],
+                         [str(i).encode() for i in range(252)])
+        stats = writer.stats['spool']
+        self.assertEqual(stats['replayed'], 251)
+        self.assertEqual(stats['segments'], 1)
+        self.assertEqual(await writer.pub('foo', b'direct'), b'OK')
+        writer.close()
+
+    @run_until_complete
+    async def test_nsqd_down_at_start(self):
+        await self.nsqd.stop()
+        writer = await create_writer(host=self.nsqd.host, port=self.nsqd.port,
+                                     loop=self.loop, spool_dir=self._tmp.name)
+        fut = await writer.pub_pipelined('foo', b'early')
+        self.assertEqual(await fut, SPOOLED)
+        await self.nsqd.start()
+        await self._replayed(writer)
+        self.assertEqual(self.nsqd.published['foo'], [b'early'])
+        writer.close()
+
+    @run_until_complete
+    async def test_refused_message_dropped(self):
+        writer = await create_writer(host=self.nsqd.host, port=self.nsqd.port,
+                                     loop=self.loop, spool_dir=self._tmp.name,
+                                     max_msg_size=3000)
+        await self.nsqd.stop()
+        await asyncio.sleep(0.01)
+        # nsqd is restarted with a lower --max-body-size
+        self.assertEqual(await writer.pub('foo', b'x' * 2000), SPOOLED)
+        self.nsqd.max_body_size = 1000
+        await self.nsqd.start()
+        self.assertIn(await writer.pub('foo', b'ok'), (b'OK', SPOOLED))
+        await self._replayed(writer)
+        self.assertEqual(self.nsqd.published['foo'], [b'ok'])
+        self.assertEqual(writer.stats['spool']['rejected'], 1)
+        self.assertEqual(await writer.pub('foo', b'direct'), b'OK')
+        writer.close()
+
+    @run_until_complete
+    async def test_transient_error_retried(self):
+        writer = await create_writer(host=self.nsqd.host, port=self.nsqd.port,
+                                     loop=self.loop, spool_dir=self._tmp.name)
+        await self.nsqd.stop()
+        await asyncio.sleep(0.01)
+        self.assertEqual(await writer.pub('foo', b'kept'), SPOOLED)
+        # nsqd can not store messages for now
+        self.nsqd.mpub_error = b'E_MPUB_FAILED exiting'
+        await self.nsqd.start()
+        await self._wait_for(lambda: any(
+            cmd == b'MPUB' for cmd, _ in self.nsqd.commands))
+        await asyncio.sleep(0.1)
+        self.assertEqual(writer.stats['spool']['depth'], 1)
+        self.assertEqual(writer.stats['spool']['rejected'], 0)
+        self.nsqd.mpub_error = None
+        await self._replayed(writer)
+        self.assertEqual(self.nsqd.published['foo'], [b'kept'])
+        writer.close()
+
+    @run_until_complete
+    async def test_trailing_messages_synced(self):
+        await self.nsqd.stop()
+        writer = await create_writer(host=self.nsqd.host, port=self.nsqd.port,
+                                     loop=self.loop, spool_dir=self._tmp.name,
+                                     spool_fsync_interval=0.05)
+        await asyncio.sleep(0.05)
+        for i in range(3):
+            self.assertEqual(await writer.pub('foo', str(i)), SPOOLED)
+        # the first append synced, the burst stopped right after it
+        self.assertTrue(writer._spool._dirty)
+        await self._wait_for(lambda: not writer._spool._dirty, timeout=0.5)
+        writer.close()
+
+    @run_until_complete
+    async def test_invalid_message_not_spooled(self):
+        await self.nsqd.stop()
+        writer = await create_writer(host=self.nsqd.host, port=self.nsqd.port,
+                                     loop=self.loop, spool_dir=self._tmp.name,
+                                     max_msg_size=1000)
+        with self.assertRaises(NSQBadMessage):
+            await writer.pub('foo', b'x' * 2000)
+        with self.assertRaises(NSQBadTopic):
+            await writer.pub('bad topic', b'msg')
+        self.assertEqual(writer.stats['spool']['depth'], 0)
+        writer.close()
+
+    @run_until_complete
+    async def test_execute_while_nsqd_down_at_start(self):
+        await self.nsqd.stop()
+        writer = await create_writer(host=self.nsqd.host, port=self.nsqd.port,
+                                     loop=self.loop, spool_dir=self._tmp.name)
+        # not spooled, the connection error is raised
+        with self.assertRaises(OSError):
+            await writer.dpub('foo', 100, b'late')
+        await self.nsqd.start()
+        self.assertEqual(await writer.dpub('foo', 100, b'late'), b'OK')
+        writer.close()
+
+    @run_until_complete
+    async def test_reconnect_after_failed_identify(self):
+        writer = await create_writer(host=self.nsqd.host, port=self.nsqd.port,
+                                     loop=self.loop, spool_dir=self._tmp.name)
+        connect, failures = writer.connect, []
+
+        async def failing_connect():
+            if not failures:
+                failures.append(1)
+                raise NSQException('IDENTIFY failed')
+            await connect()
+        writer.connect = failing_connect
+        await self.nsqd.stop()
+        await asyncio.sleep(0.01)
+        self.assertEqual(await writer.pub('foo', b'spooled'), SPOOLED)
+        await self.nsqd.start()
+        await self._replayed(writer)
+        self.assertEqual(failures, [1])
+        self.assertEqual(self.nsqd.published['foo'], [b'spooled'])
+        writer.close()